@@ -0,0 +1,154 @@
+# What the answers of a board mean, for all of its drivers: the reader
+# thread of test_executor.Device, the event loop of async_device.AsyncDevice
+# and the state machine of reactor.ReactorDevice. A driver waits for the
+# answer its own way and hands it to these functions, which put the message
+# together, check it, keep what it changes on the device (joined, mode and
+# the transmit and read summaries) and fill device_result.
+
+import logging
+
+import pytest_check as check
+
+from hello.matcher import Match, EXPECTED, ERROR, join_events
+
+# Version lines of the board: marker, device_result field, device attribute
+IDENTITY_LINES = (("IDN: ", "DeviceType", "devtype"),
+                  ("EXECUTIVE VER:", "ExecVersion", "execversion"),
+                  ("RF STACK  VER:", "StackVersion", "stackversion"))
+
+# Commands not sent again once the device has joined
+JOIN_COMMANDS = ("lwjoin", "lwstatus")
+
+
+##########
+## Join ##
+##########
+
+def skips_command(device, command):
+    """True if command is not sent, the device has joined already"""
+    return device.joined and command in JOIN_COMMANDS
+
+
+def skips_answer(device):
+    """True if the answers of the last command are not read, it was not sent"""
+    return device.joined and device.last_command == "lwstatus"
+
+
+def skips_event(device, event):
+    """True if event is not waited for, the device has joined already"""
+    return device.joined and event in join_events
+
+
+##############
+## Messages ##
+##############
+
+def expects_more(raw, candidates):
+    """True if the binary frames read so far, raw, are the start of an
+    expected value (see frames.expected_candidates) still incomplete"""
+    return any(len(raw) < len(expected_raw) and expected_raw.startswith(raw) for expected_raw in candidates)
+
+
+def binary_message(raw, candidates):
+    """Binary frames as a string: the expected value they are, else hex"""
+    if raw in candidates:
+        return candidates[raw]  # No need to render what is already known
+    return raw.hex(" ").upper()
+
+
+def identify_line(device, line):
+    """Take the type or a version of the board from a line of its version"""
+    for marker, field, attribute in IDENTITY_LINES:
+        if marker in line:
+            setattr(device, attribute, line.split(marker)[1])
+            device.device_result[field] = getattr(device, attribute)
+            logging.info(line)
+            return
+
+
+def event_match(device, matcher, message, predicate=None):
+    """Match of a message read while waiting for the events of matcher;
+    a message satisfying predicate counts as expected"""
+    match = matcher.classify(message)
+    if predicate is not None and predicate(message):
+        match = Match(EXPECTED, None, message)
+    if match.kind not in (EXPECTED, ERROR):
+        logging.info(f"[{device.id}]<<{message} (waiting for {' or '.join(matcher.expected)})")
+    return match
+
+
+############
+## Checks ##
+############
+
+def response_result(device, read_from_radio, expected_response, check_response=True, soft_check=True):
+    """Check the response to the last command (~)
+    If the last command was successful the device responds with 'OK00'.
+    soft_check also reports a failure with pytest_check"""
+    logging.info(f"[{device.id}]<<{read_from_radio}")
+    result = None
+    if check_response:
+        if soft_check:
+            check.equal(read_from_radio, expected_response)
+        if read_from_radio != expected_response:
+            result = "FAILED"
+            logging.info(f'\tFAILED : {read_from_radio} != {expected_response}')
+            if "sendb" in device.last_command:
+                device.transmit_status.append(["No-Tx", device.mode])
+        else:
+            result = "PASSED"
+            logging.info('\tPASSED')
+            if "sendb" in device.last_command:
+                device.transmit_status.append(["Tx-Ok", device.mode])
+    device.device_result.update({"Expected": expected_response, "Actual": read_from_radio, "Result": result})
+    return device.device_result
+
+
+def return_value_result(device, read_from_radio, return_value, check_return=True, soft_check=True):
+    """Check the value returned for the last command (#)
+    A pass after lwstatus means the device has joined, after mode it is the
+    mode of the following results. soft_check also reports a failure with
+    pytest_check"""
+    logging.info(f"[{device.id}]<<{read_from_radio}")
+    if check_return and soft_check:
+        check.equal(read_from_radio, return_value)
+
+    if device.last_command == "geta":
+        if read_from_radio:
+            read_string = [read_from_radio, device.mode] if read_from_radio == return_value else [
+                read_from_radio + " --- fail", device.mode]
+        else:
+            read_string = ["No-Rx", device.mode]
+        device.read_strings.append(read_string)
+
+    if return_value and read_from_radio != return_value:
+        result = "FAILED"
+        logging.info(f'\tFAILED : {read_from_radio} != {return_value}')
+    else:
+        result = "PASSED"
+        logging.info('\tPASSED')
+        device.joined = device.last_command == "lwstatus"
+        if device.last_command == "rssi":
+            rssi = read_from_radio if device.read_strings[-1][0] != "No-Rx" else "--"
+            device.rssi_list.append(rssi)
+        if device.last_command == "mode":
+            device.mode = read_from_radio
+            device.device_result.update({"Mode": device.mode})
+
+    device.device_result.update({"Expected": return_value, "Actual": read_from_radio, "Result": result})
+    return device.device_result
+
+
+def event_result(device, match, event, test_line="", line=0):
+    """Check the match that ended the wait for event (?); a failure is
+    stored with line, the number of test_line"""
+    read_from_radio = match.message
+    logging.info(f"[{device.id}]<<{read_from_radio}")
+    if match.kind != EXPECTED:
+        result = "FAILED"
+        logging.info(f"\tFAILED : {read_from_radio} != {event}, at line {line}")
+        device.tfailed.append((line, test_line))  # Store the line that failed
+    else:
+        result = "PASSED"
+    device.device_result.update({"Expected": event, "Actual": read_from_radio, "Result": result})
+    return device.device_result
@@ -0,0 +1,299 @@
+# asyncio counterpart of test_executor.Device: one event loop can drive
+# every port, each read waits on its own deadline and can be cancelled.
+
+import asyncio
+import csv
+import logging
+import time
+
+from hello import answers, test_executor
+from hello.commands import CmdRtrn, Codec, SendBytes, encode_line
+from hello.frames import FrameDecoder, expected_candidates
+from hello.replay import open_port
+from hello.test_executor import (Device, end_string, serial_timeout, response_timeout, return_timeout,
+                                 event_timeout, timeout_model, results_files, results_files_lock, _sendChar_)
+from hello.matcher import EventMatcher, Match, EXPECTED, ERROR, OTHER
+
+
+class AsyncDevice(object):
+    """
+    Single test device driven from an asyncio event loop.
+    """
+
+    def __init__(self, newid, newport, newbaud, results_filepath="Results.csv", mode=None, timeouts=None,
+                 transport=None):
+        """Properties of the device
+        transport is an open port object to use instead of opening newport,
+        see Device; it needs a descriptor for the loop to watch"""
+        self.devtype = "Unknown"
+        self.stackversion = None
+        self.execversion = None
+        self.id = newid
+        self.port = newport
+        self.baud = newbaud
+        # Opened like the ports of Device (transport, recording); the loop
+        # watches the descriptor and reads through the port without waiting
+        self.device = transport if transport is not None else open_port(newport, newbaud, 0)
+        self.fd = None
+        self.read_chunk = getattr(self.device, "read_chunk", None)
+        self.timeouts = timeouts if timeouts is not None else timeout_model
+        self.decoder = FrameDecoder()
+        self.frames = None  # Queue of the loop, made by open()
+        self.loop = None
+        self.idle_handle = None
+        self.tfailed = []  # List with failed test lines
+        self.joined = False  # Store whether the device has joined a LoRaWAN network
+        self.codec = Codec(mode)  # Parser mode of this device, encodes the Cmd objects
+        self.last_command = None
+        self.read_strings = []
+        self.rssi_list = []
+        self.transmit_status = []
+        self.transmit_strings = []
+        self.mode = "-"
+        self.device_result = {
+            "DeviceID": self.id,
+            "DeviceType": self.devtype,
+            "ExecVersion": self.execversion,
+            "StackVersion": self.stackversion,
+            "Mode": self.mode,
+            "Command": self.last_command,
+            "Actual": None,
+            "Expected": None,
+            "Result": None,
+        }
+        self.results_filepath = results_filepath
+        self.fieldnames = ['DeviceID', 'DeviceType', 'ExecVersion', 'StackVersion', 'Mode', 'Command', 'Actual',
+                           'Expected', 'Result']
+        # The header is written once per file, like Device.retarget
+        with results_files_lock:
+            if results_filepath not in results_files:
+                results_files.add(results_filepath)
+                with open(self.results_filepath, mode="w", newline="") as result_file:
+                    csv.DictWriter(result_file, fieldnames=self.fieldnames, restval='',
+                                   extrasaction='ignore').writeheader()
+
+    async def open(self):
+        """Start watching the port on the running loop"""
+        # A recording port has no fileno(), so that nothing writes past it
+        fileno = getattr(self.device, "read_fileno", None) or getattr(self.device, "fileno", None)
+        if fileno is None:
+            raise ValueError(f"{self.port}: AsyncDevice needs a port with a descriptor")
+        self.loop = asyncio.get_running_loop()
+        self.frames = asyncio.Queue()
+        self.fd = fileno()
+        self.loop.add_reader(self.fd, self._on_readable)
+        self.loop.call_soon(self._on_readable)  # Input that came in before, e.g. with a mux lease
+        return self
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the port the device is connected to"""
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+        self.device.close()
+
+    def _on_readable(self):
+        try:
+            data = self.read_chunk() if self.read_chunk is not None else self.device.read(self.device.in_waiting or 1)
+        except OSError:
+            self.loop.remove_reader(self.fd)  # Port went away
+            return
+        if not data:
+            return  # Flushed by reset_input_buffer() meanwhile
+        self._put(self.decoder.feed(data))
+        # Unterminated text is handed out once the port stays quiet
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+        self.idle_handle = self.loop.call_later(serial_timeout, self._on_idle)
+
+    def _on_idle(self):
+        self.idle_handle = None
+        self._put(self.decoder.flush())
+
+    def _put(self, frames):
+        for frame in frames:
+            self.frames.put_nowait(frame)
+
+    async def _write(self, data):
+        # Through the port, which takes a command at once; the port waits
+        # for room itself if a long write fills its buffer
+        self.device.write(data)
+
+    def reset_input_buffer(self):
+        """Discard unread input, both in the port and in the frame queue"""
+        self.device.reset_input_buffer()
+        self.decoder.reset()
+        if self.frames is not None:
+            while not self.frames.empty():
+                self.frames.get_nowait()
+
+    # Keyed like the reads of Device, so both learn the same deadlines
+    _latency_key = Device._latency_key
+
+    async def _timed_read(self, kind, default, read):
+        """await read(timeout) with the learned deadline, see Device._timed_read"""
+        key = self._latency_key(kind)
+        started = time.monotonic()
+        message = await read(self.timeouts.deadline(key, default))
+        if message:
+            self.timeouts.observe(key, time.monotonic() - started)
+        else:
+            self.timeouts.miss(key, time.monotonic() - started)
+        return message
+
+    async def read_frame(self, timeout):
+        """Next frame that is not a blank line, or None on timeout"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                frame = await asyncio.wait_for(self.frames.get(), max(0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                return None
+            if frame.binary or frame.payload.strip():
+                return frame
+
+    async def readline(self, timeout):
+        """Next non-blank line, stripped, or b"" on timeout"""
+        frame = await self.read_frame(timeout)
+        return frame.raw.strip() if frame else b""
+
+    async def read_message(self, expected, timeout):
+        """Next message as a string, see Device.read_message"""
+        deadline = time.monotonic() + timeout
+        frame = await self.read_frame(timeout)
+        if frame is None:
+            return ""
+        if not frame.binary:
+            return bytes.decode(frame.raw.strip(), errors="ignore")
+        raw = frame.raw
+        candidates = expected_candidates(expected)
+        while answers.expects_more(raw, candidates):
+            frame = await self.read_frame(max(0, deadline - time.monotonic()))
+            if frame is None:
+                break
+            raw += frame.raw if frame.binary else frame.raw.strip()
+        return answers.binary_message(raw, candidates)
+
+    async def identify(self):
+        """Get the details of the device connected to the port"""
+        logging.info("DEVICE " + self.id + ", " + self.port)
+        self.reset_input_buffer()
+        await self._write(str.encode("version" + end_string))
+        while True:
+            read_from_radio = bytes.decode(await self.readline(serial_timeout), errors="ignore")
+            if read_from_radio == "":
+                break
+            answers.identify_line(self, read_from_radio)
+        return self.device_result
+
+    async def send_command(self, command, wire=None):
+        """Send the command to the device (>)"""
+        if answers.skips_command(self, command):
+            return
+        self.reset_input_buffer()
+        logging.info(f"[{self.id}]>>{command}")
+        await self._write(wire if wire is not None else encode_line(command))
+        self.last_command = command
+        self.device_result.update({"Command": command, "Expected": None, "Actual": None, "Result": "Discard"})
+        return self.device_result
+
+    async def read_response(self, expected_response="OK00>", test_line="", check_response=True):
+        """Read the response from the device (~)"""
+        if answers.skips_answer(self):
+            return
+        read_from_radio = bytes.decode(await self._timed_read("response", response_timeout, self.readline),
+                                       errors="ignore")
+        return answers.response_result(self, read_from_radio, expected_response, check_response)
+
+    async def read_event(self, event, test_line="", timeout=None, predicate=None, settle=0):
+        """Read the event message from the device (?), see Device.read_event"""
+        if answers.skips_event(self, event):
+            return
+        match = await self.wait_event(EventMatcher.of(event), timeout, predicate)
+        device_result = answers.event_result(self, match, event, test_line, test_executor.line_num + 1)
+        if settle:
+            await asyncio.sleep(settle)
+        return device_result
+
+    async def wait_event(self, matcher, timeout=None, predicate=None):
+        """See Device.wait_event"""
+        key = self._latency_key("event")
+        started = time.monotonic()
+        deadline = started + (timeout if timeout is not None else self.timeouts.deadline(key, event_timeout))
+        match = Match(OTHER, None, "")
+        while time.monotonic() < deadline:
+            message = await self.read_message(matcher.expected, max(0, deadline - time.monotonic()))
+            if not message:
+                break
+            match = answers.event_match(self, matcher, message, predicate)
+            if match.kind == EXPECTED:
+                self.timeouts.observe(key, time.monotonic() - started)
+            if match.kind in (EXPECTED, ERROR):
+                break
+        if match.kind not in (EXPECTED, ERROR) and timeout is None:
+            self.timeouts.miss(key, time.monotonic() - started)
+        return match
+
+    async def read_return_value(self, return_value, test_line="", check_return=True):
+        """Read the return value from the device (#)"""
+        if answers.skips_answer(self):
+            return
+        read_from_radio = await self._timed_read("return", return_timeout,
+                                                 lambda timeout: self.read_message(return_value, timeout))
+        return answers.return_value_result(self, read_from_radio, return_value, check_return)
+
+    async def send_string(self, string_to_send, test_line=""):
+        """Send a string to the device ($)"""
+        read_from_radio = bytes.decode(await self.readline(response_timeout), errors="ignore")
+        if read_from_radio != _sendChar_:
+            result = "FAILED"
+            logging.info(f"\tFAILED : string send : Expected $; Rcvd << {read_from_radio}")
+        else:
+            self.reset_input_buffer()
+            result = "PASSED"
+            logging.info(f"[{self.id}]<<{read_from_radio}{string_to_send}")
+            await self._write(str.encode(string_to_send + end_string))
+            self.transmit_strings.append(string_to_send)
+
+        self.device_result.update({"Expected": "$", "Actual": read_from_radio, "Result": result})
+        return self.device_result
+
+    async def send_receive(self, command):
+        logging.info(f"Send/Receive [{self.id}]: {command}")
+
+        rows = []
+
+        def record(device_result):
+            # device_result is updated in place, keep a copy of each step
+            if device_result and device_result["Result"] != "Discard":
+                rows.append(dict(device_result))
+
+        text = self.codec.command(command)
+        if text is not None:
+            record(await self.send_command(text, wire=self.codec.encode(command)))
+            if self.codec.mode != "binary" and type(command) is SendBytes:
+                record(await self.send_string(command.string))
+
+        if isinstance(command, CmdRtrn):
+            return_value = self.codec.return_value(command)
+            check_return = False if return_value is None else True
+            record(await self.read_return_value(return_value, check_return=check_return))
+
+        response = self.codec.response(command)
+        if response:
+            if self.codec.mode == "binary":
+                record(await self.read_return_value(response))
+            else:
+                record(await self.read_response(response))
+
+        with open(self.results_filepath, mode="a", newline="") as result_file:
+            result_writer = csv.DictWriter(result_file, fieldnames=self.fieldnames, restval='',
+                                           extrasaction='ignore')
+            result_writer.writerows(rows)
@@ -0,0 +1,267 @@
+# Throughput and latency benchmark of the Device.send_receive path,
+# run against the pty simulator so it needs no hardware:
+#
+#   python -m hello.benchmark --modes ascii binary --families set get -n 50
+#
+# Reports commands/sec and p50/p99 latency per transport, parser mode and
+# command family. To compare the transports, take serial_timeout out:
+#
+#   python -m hello.benchmark --transports serial fd tcp --serial-timeout 0
+#
+# With --reactor, measures instead how one Reactor thread copes with
+# farms of simulated boards of the given sizes:
+#
+#   python -m hello.benchmark --reactor 1 8 32 64 -n 50
+
+import argparse
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+
+from hello import matcher, test_executor
+from hello.commands import Sappeui, Gappeui, SendBytes, Lwjoin, Lwjoinbin
+from hello.matcher import text_event, binary_event
+from hello.reactor import Reactor, ReactorDevice
+from hello.simulator import DeviceSimulator, TcpBridge
+from hello.test_executor import Device
+from hello.timeouts import percentile
+from hello.transports import open_transport
+
+MODES = ("ascii", "at", "binary")
+TRANSPORTS = ("serial", "fd", "pty", "tcp")  # tcp goes through a TcpBridge to the simulator
+
+# Events up to a completed OTAA join, per parser family
+JOIN_EVENTS = {
+    "text": [text_event(event) for event in matcher.JOIN_EVENTS],
+    "binary": [binary_event("Joined network")],  # Joining comes with the response
+}
+
+
+def _set(device, mode):
+    device.send_receive(Sappeui("12 34 56 78 12 34 56 78"))
+
+
+def _get(device, mode):
+    device.send_receive(Gappeui("12 34 56 78 12 34 56 78"))
+
+
+def _sendb(device, mode):
+    device.send_receive(SendBytes(5, "12345"))
+
+
+def _join(device, mode):
+    device.joined = False  # Rejoin every iteration
+    if mode == "binary":
+        device.send_receive(Lwjoinbin("1B 50 1B 51 01"))
+    else:
+        device.send_receive(Lwjoin())
+    for event in JOIN_EVENTS["binary" if mode == "binary" else "text"]:
+        device.read_event(event)
+
+
+# Command families: operation timed per iteration, and the share of the
+# iterations it runs (joins include the event wait and are slow)
+FAMILIES = {
+    "set": (_set, 1),
+    "get": (_get, 1),
+    "sendb": (_sendb, 1),
+    "join": (_join, 0.1),
+}
+
+
+def run_family(device, mode, family, iterations):
+    """Per-iteration latencies (s) of one command family"""
+    operation, share = FAMILIES[family]
+    if family == "get":
+        _set(device, mode)  # Something to read back
+    latencies = []
+    for _ in range(max(1, int(iterations * share))):
+        start = time.perf_counter()
+        operation(device, mode)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def open_simulated(stack, simulator, kind):
+    """Transport of kind to the simulator, closed with stack"""
+    if kind == "tcp":
+        return open_transport(stack.enter_context(TcpBridge(simulator.port)).url, 115200, test_executor.serial_timeout)
+    return open_transport(simulator.port, 115200, test_executor.serial_timeout, kind)
+
+
+def benchmark(modes=MODES, families=tuple(FAMILIES), iterations=20, latency=0.0, jitter=0.0,
+              transports=("serial",)):
+    """Run every family in every mode and over every transport on a fresh
+    simulator, one row each"""
+    rows = []
+    with tempfile.TemporaryDirectory() as results_dir:
+        for kind in transports:
+            for mode in modes:
+                with contextlib.ExitStack() as stack:
+                    simulator = stack.enter_context(DeviceSimulator(mode=mode, latency=latency, jitter=jitter,
+                                                                    join_delay=0, tx_delay=0))
+                    device = Device("1", simulator.port, 115200, mode=mode,
+                                    results_filepath=os.path.join(results_dir, f"{kind}_{mode}.csv"),
+                                    transport=open_simulated(stack, simulator, kind))
+                    device.shadow.enabled = False  # Every set is timed on the wire, not elided
+                    try:
+                        for family in families:
+                            latencies = run_family(device, mode, family, iterations)
+                            rows.append({
+                                "transport": kind,
+                                "mode": mode,
+                                "family": family,
+                                "commands": len(latencies),
+                                "commands_per_sec": len(latencies) / sum(latencies),
+                                "p50_ms": percentile(latencies, 50) * 1000,
+                                "p99_ms": percentile(latencies, 99) * 1000,
+                            })
+                    finally:
+                        device.close()
+    return rows
+
+
+def roundtrips(transports=TRANSPORTS, iterations=200):
+    """p50/p99 (us) of raw ascii ping round trips per transport, without
+    Device and its reader thread: the cost of the transport itself"""
+    rows = []
+    for kind in transports:
+        with contextlib.ExitStack() as stack:
+            simulator = stack.enter_context(DeviceSimulator(mode="ascii"))
+            port = stack.enter_context(contextlib.closing(open_simulated(stack, simulator, kind)))
+            read = getattr(port, "read_chunk", None) or (lambda: port.read(port.in_waiting or 1))
+            latencies = []
+            for _ in range(iterations):
+                start = time.perf_counter()
+                port.write(b"ping\r\n")
+                answer = b""
+                while not answer.endswith(b"OK00>\r\n"):
+                    answer += read()
+                latencies.append(time.perf_counter() - start)
+            rows.append({
+                "transport": kind,
+                "roundtrips": iterations,
+                "p50_us": percentile(latencies, 50) * 1e6,
+                "p99_us": percentile(latencies, 99) * 1e6,
+            })
+    return rows
+
+
+def _serve_simulators(count, latency, jitter, connection):
+    """Body of the farm process: count simulators, served until the
+    benchmark closes its end of connection"""
+    simulators = [DeviceSimulator(latency=latency, jitter=jitter) for _ in range(count)]
+    connection.send([simulator.port for simulator in simulators])
+    try:
+        connection.recv()
+    except EOFError:
+        pass
+    for simulator in simulators:
+        simulator.close()
+
+
+def scaling(counts=(1, 8, 32, 64), iterations=20, latency=0.0, jitter=0.0, guard=0.0):
+    """Set/response pairs on farms of count boards served by one Reactor,
+    one row per count. The simulators run in another process, so cpu_share
+    is the share of a core the reactor thread used"""
+    rows = []
+    for count in counts:
+        connection, farm_connection = multiprocessing.Pipe()
+        farm = multiprocessing.Process(target=_serve_simulators, args=(count, latency, jitter, farm_connection),
+                                       daemon=True)
+        farm.start()
+        reactor = Reactor()
+        try:
+            results = []
+            for number, port in enumerate(connection.recv(), 1):
+                device = ReactorDevice(str(number), port, 115200, guard=guard)
+                reactor.add(device)
+                device.start([(0, f"[{number}]>sappeui 12 34 56 78 12 34 56 78"), (1, f"[{number}]~")] * iterations,
+                             results.append)
+            wall, cpu = time.perf_counter(), time.process_time()
+            reactor.run()
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            latencies = [latency for device in reactor.devices for latency in device.latencies]
+            rows.append({
+                "devices": count,
+                "commands": len(latencies),
+                "passed": sum(row["Result"] == "PASSED" for row in results),
+                "commands_per_sec": len(latencies) / wall,
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "cpu_share": cpu / wall,
+            })
+        finally:
+            reactor.close()
+            connection.close()
+            farm.join(5)
+    return rows
+
+
+def report_scaling(rows):
+    logging.info(f"{'devices':>8}{'n':>8}{'passed':>8}{'cmd/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'cpu':>8}")
+    for row in rows:
+        logging.info(f"{row['devices']:>8}{row['commands']:>8}{row['passed']:>8}{row['commands_per_sec']:>10.1f}"
+                     f"{row['p50_ms']:>10.1f}{row['p99_ms']:>10.1f}{row['cpu_share']:>8.0%}")
+
+
+def report(rows):
+    logging.info(f"serial_timeout = {test_executor.serial_timeout} s")
+    logging.info(f"{'transport':<10}{'mode':<8}{'family':<8}{'n':>6}{'cmd/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for row in rows:
+        logging.info(f"{row['transport']:<10}{row['mode']:<8}{row['family']:<8}{row['commands']:>6}{row['commands_per_sec']:>10.2f}"
+                     f"{row['p50_ms']:>10.1f}{row['p99_ms']:>10.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Device.send_receive path on a simulated EVK")
+    parser.add_argument("--transports", nargs="+", choices=TRANSPORTS, default=["serial"])
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--families", nargs="+", choices=list(FAMILIES), default=list(FAMILIES))
+    parser.add_argument("-n", "--iterations", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated device latency (s)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Simulated latency jitter (s)")
+    parser.add_argument("--serial-timeout", type=float, default=None,
+                        help="Override test_executor.serial_timeout to see its cost")
+    parser.add_argument("--roundtrips", action="store_true",
+                        help="Also time raw ping round trips over each of the transports")
+    parser.add_argument("--reactor", nargs="+", type=int, default=None, metavar="DEVICES",
+                        help="Instead, measure one Reactor serving farms of this many simulated boards")
+    parser.add_argument("--json", default=None, help="Also write the rows to this file")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.serial_timeout is not None:
+        test_executor.serial_timeout = args.serial_timeout
+    # Only the report goes to the console
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.reactor:
+        rows = scaling(args.reactor, args.iterations, args.latency, args.jitter)
+        logging.getLogger().setLevel(logging.INFO)
+        report_scaling(rows)
+        if args.json:
+            with open(args.json, "w") as json_file:
+                json.dump({"reactor": rows}, json_file, indent=2)
+        return rows
+    rows = benchmark(args.modes, args.families, args.iterations, args.latency, args.jitter, args.transports)
+    logging.getLogger().setLevel(logging.INFO)
+    report(rows)
+    raw_rows = []
+    if args.roundtrips:
+        raw_rows = roundtrips(args.transports, args.iterations)
+        logging.info(f"{'transport':<10}{'n':>6}{'p50 us':>10}{'p99 us':>10}")
+        for row in raw_rows:
+            logging.info(f"{row['transport']:<10}{row['roundtrips']:>6}{row['p50_us']:>10.1f}{row['p99_us']:>10.1f}")
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump({"serial_timeout": test_executor.serial_timeout, "rows": rows, "roundtrips": raw_rows},
+                      json_file, indent=2)
+    return rows
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,6 @@
+from contextlib import contextmanager
 from enum import IntEnum
+from functools import lru_cache
 
 
 COMMAND_MAP = {
@@ -40,6 +42,27 @@ RESPONSE_MAP = {
 }
 
 
+# Line terminator of the ascii / AT parsers
+END_STRING = "\r\n"
+
+# Binary parser command framing: 1B 2A <command> <args> 1B 42
+BINARY_START = b"\x1B\x2A"
+BINARY_END = b"\x1B\x42"
+
+# Wire bytes and command string per (command class, args, mode)
+_ENCODING_CACHE = {}
+_ENCODING_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=1024)
+def encode_line(command):
+    """Wire bytes for a command string as written in test scripts:
+    "0x1B 0x2A ..." hex notation for the binary parser, text otherwise"""
+    if command[0:2] != "0x":
+        return str.encode(command + END_STRING)
+    return bytes(int(x, 16) for x in command.split())
+
+
 class AutoRxMode(IntEnum):
     OFF = 0x00
     DATA_BIN = 0x01
@@ -95,6 +118,13 @@ class Cmd(metaclass=CmdMeta):
     ascii: str
     at: str
     binary: bytes
+    # Whether the command may be written while earlier responses are unread
+    pipelined = True
+    # Board state for the shadow (hello.shadow): the parameter a set command
+    # sets, the stack a command selects, and whether it resets everything
+    parameter = None
+    selects_stack = None
+    invalidates = False
 
     def __init__(self, command, args=(), response="OK00>"):
         self._command = command
@@ -109,51 +139,95 @@ class Cmd(metaclass=CmdMeta):
             parts.append(f"response: \"{self._response}\"")
         return " ".join(parts)
 
-    def command_property(self):
+    def binary_args(self):
+        """Argument bytes of the binary command"""
+        # if COMMAND_MAP[self._command]["args"] == 1:
+        if len(self._args) == 1:
+            return bytes((int(self._args[0]),))
+        return b""
+
+    def cache_key(self):
+        """Everything the encoding depends on besides the mode"""
+        return type(self), self._command, self._args
+
+    def shadow_value(self):
+        """Value set by the command, as compared by the shadow"""
+        args = (self._args,) if isinstance(self._args, str) else self._args
+        return "".join(str(arg) for arg in args).replace(" ", "").upper()
+
+    def command_property(self, mode=None):
         if self._command is None:
             return
-        if Cmd.mode == "ascii":
+        mode = mode or Cmd.mode
+        if mode == "ascii":
             # cmd = f"{COMMAND_MAP[self._command]['ascii']}"
             cmd = self.ascii
             for arg in self._args:
                 cmd += f" {arg}"
             return cmd
-        elif Cmd.mode == "at":
+        elif mode == "at":
             # cmd = f"{COMMAND_MAP[self._command]['at']}"
             cmd = self.at
             for arg in self._args:
                 cmd += f" {arg}"
             return cmd
-        elif Cmd.mode == "binary":
-            cmd = f"0x1B 0x2A "
-            # binary_cmd = COMMAND_MAP[self._command]['binary']
-            # cmd += f"0x{int(binary_cmd.hex(), 16):>02X} " if binary_cmd else ""
-            if self.binary:
-                cmd += f"0x{int(self.binary.hex(), 16):>02X} "
-            # if COMMAND_MAP[self._command]["args"] == 1:
-            if len(self._args) == 1:
-                cmd += f"0x{int(self._args[0]):>02X} "
-            cmd += "0x1B 0x42"
-            return cmd
+        elif mode == "binary":
+            return " ".join(f"0x{byte:02X}" for byte in self.encode(mode))
+
+        raise ValueError(f"Invalid command mode: {mode}")
+
+    def _encoded(self, mode):
+        """(command string, wire bytes), built once per class, args and mode"""
+        key = (self.cache_key(), mode)
+        encoded = _ENCODING_CACHE.get(key)
+        if encoded is None:
+            if mode == "binary":
+                # binary_cmd = COMMAND_MAP[self._command]['binary']
+                wire = BINARY_START + self.binary + self.binary_args() + BINARY_END
+                # "0x1B 0x2A ..." in bulk, not byte by byte: payloads can be long
+                encoded = ("0x" + wire.hex(" ").upper().replace(" ", " 0x"), wire)
+            else:
+                command = self.command_property(mode)
+                encoded = (command, None if command is None else encode_line(command))
+            if len(_ENCODING_CACHE) >= _ENCODING_CACHE_SIZE:
+                _ENCODING_CACHE.clear()
+            _ENCODING_CACHE[key] = encoded
+        return encoded
+
+    def command_for(self, mode):
+        """Command string for a parser mode"""
+        if self._command is None:
+            return
+        return self._encoded(mode)[0]
 
-        raise ValueError(f"Invalid command mode: {self._mode}")
+    def encode(self, mode=None):
+        """Bytes written to the device for this command"""
+        if self._command is None:
+            return
+        return self._encoded(mode or Cmd.mode)[1]
+
+    def response_for(self, mode):
+        """Expected response for a parser mode"""
+        if mode == "binary":
+            if self._response == "OK00>":
+                return "1B 50 1B 51 01"
+        return self._response
+
+    # The properties below use the process-wide Cmd.mode; devices encode
+    # through their own Codec instead
 
     @property
     def command(self):
-        return self.command_property()
+        return self.command_for(Cmd.mode)
 
     @property
     def response(self):
-        if Cmd.mode == "binary":
-            if self._response == "OK00>":
-                return "1B 50 1B 51 01"
-        return self._response
+        return self.response_for(Cmd.mode)
 
 
 class CmdRtrn(Cmd):
     def __init__(self, command, return_value, args=()):
-        response = "" if Cmd.mode == "binary" else "OK00>"
-        super().__init__(command, args, response=response)
+        super().__init__(command, args, response="OK00>")
         self._return_value = return_value
 
     def __str__(self):
@@ -166,11 +240,17 @@ class CmdRtrn(Cmd):
             parts.append(f"response: \"{self._response}\"")
         return " ".join(parts)
 
-    @property
-    def return_value(self):
+    def response_for(self, mode):
+        # Binary return values carry the status, there is no separate response
+        if mode == "binary":
+            return ""
+        return super().response_for(mode)
+
+    def return_value_for(self, mode):
+        """Expected return value for a parser mode"""
         if self._return_value is None:
             return
-        if Cmd.mode == "binary":
+        if mode == "binary":
             _return_value_parts = ["1B 50"]
             if self._command in RESPONSE_MAP:
                 _return_value_parts.append(RESPONSE_MAP[self._command][self._return_value].strip())
@@ -183,11 +263,57 @@ class CmdRtrn(Cmd):
         else:
             return self._return_value
 
+    @property
+    def return_value(self):
+        return self.return_value_for(Cmd.mode)
+
+
+class Codec(object):
+    """
+    Parser mode of one device, and the encoding of commands for it.
+    Without a mode of its own the codec follows the process-wide Cmd.mode.
+    """
+
+    def __init__(self, mode=None):
+        self._mode = mode
+
+    @property
+    def mode(self):
+        return self._mode or Cmd.mode
+
+    @mode.setter
+    def mode(self, value):
+        self._mode = value
+
+    @contextmanager
+    def using(self, mode):
+        """Temporarily encode in another mode, e.g. to switch parsers"""
+        old_mode = self._mode
+        self._mode = mode
+        try:
+            yield self
+        finally:
+            self._mode = old_mode
+
+    def command(self, cmd):
+        return cmd.command_for(self.mode)
+
+    def encode(self, cmd):
+        return cmd.encode(self.mode)
+
+    def response(self, cmd):
+        return cmd.response_for(self.mode)
+
+    def return_value(self, cmd):
+        if isinstance(cmd, CmdRtrn):
+            return cmd.return_value_for(self.mode)
+
 
 class WakeUp(Cmd):
     ascii = ""
     at = ""
     binary = b""
+    pipelined = False
 
     def __init__(self):
         super().__init__("", response=None)
@@ -199,6 +325,7 @@ class Lorawan(Cmd):
     ascii = " lorawan"
     at = " AT+l"
     binary =  b"\x9D"
+    selects_stack = "lorawan"
 
     def __init__(self):
         super().__init__("lorawan")
@@ -220,11 +347,10 @@ class Ping(CmdRtrn):
     def __init__(self,return_value):
         super().__init__("ping", return_value)
 
-    @property
-    def return_value(self):
+    def return_value_for(self, mode):
         if self._return_value is None:
             return
-        if Cmd.mode == "binary":
+        if mode == "binary":
             _return_value_parts = ["1B 50 1B 51 01"]
             return " ".join(_return_value_parts)
         else:
@@ -235,6 +361,7 @@ class Sevent(Cmd):
     ascii = " sevent"  
     at = " AT&E"
     binary =  b"\x4F"
+    parameter = "event"
 
     def __init__(self, enabled):
         self.enabled = enabled
@@ -244,6 +371,7 @@ class Sconfirm(Cmd):
     ascii = " sconfirm"
     at = " AT+F"
     binary =  b"\x9C"
+    parameter = "confirm"
 
     def __init__(self, enabled):
         self.enabled = enabled
@@ -266,11 +394,10 @@ class Devid(CmdRtrn):
     def __init__(self, return_value):
         super().__init__("devid", return_value)  
 
-    @property
-    def return_value(self):
+    def return_value_for(self, mode):
         if self._return_value is None:
             return
-        if Cmd.mode == "binary":
+        if mode == "binary":
             _return_value_parts = ["1B 50", self._return_value, "1B 51 01"]
             return " ".join(_return_value_parts)
         else:
@@ -284,11 +411,10 @@ class Lwstatus(CmdRtrn):
     def __init__(self, return_value):
         super().__init__("lwstatus", return_value)  
 
-    @property
-    def return_value(self):
+    def return_value_for(self, mode):
         if self._return_value is None:
             return
-        if Cmd.mode == "binary":
+        if mode == "binary":
             _return_value_parts = ["1B 50 01 1B 51 01"]
             return " ".join(_return_value_parts)
         else:
@@ -307,23 +433,14 @@ class Sappeui(Cmd):
     ascii = " sAppEUI"
     at = " AT+O"
     binary =  b"\xA7"
+    parameter = "appeui"
 
     def __init__(self, sappeui):
         self.sappeui = sappeui
         super().__init__("sAppEUI", args=(self.sappeui,))
     
-    @property
-    def command(self):
-        if Cmd.mode == "binary":
-            cmd = f"0x1B 0x2A "
-            cmd += f"0x{int(self.binary.hex(), 16):>02X} "
-            # binary_cmd = COMMAND_MAP[self._command]['binary']
-            # cmd += f"0x{int(binary_cmd.hex(), 16):>02X} " if binary_cmd else ""
-            _sappeui = (self.sappeui).split()
-            cmd += " ".join(f"0x{sappeui}" for sappeui in _sappeui)
-            cmd += " 0x1B 0x42"
-            return cmd
-        return self.command_property()
+    def binary_args(self):
+        return bytes.fromhex(self.sappeui)
 
 class Gappeui(CmdRtrn):
     ascii = " gAppEUI"
@@ -333,11 +450,10 @@ class Gappeui(CmdRtrn):
     def __init__(self, return_value):
         super().__init__("gAppEUI", return_value)  
 
-    @property
-    def return_value(self):
+    def return_value_for(self, mode):
         if self._return_value is None:
             return
-        if Cmd.mode == "binary":
+        if mode == "binary":
             _return_value_parts = ["1B 50", self._return_value, "1B 51 01"]
             return " ".join(_return_value_parts)
         else:
@@ -347,23 +463,14 @@ class Sappkey(Cmd):
     ascii = " sAppKey"
     at = " AT+K"
     binary =  b"\xA9"
+    parameter = "appkey"
 
     def __init__(self, sappkey):
         self.sappkey = sappkey
         super().__init__("sAppKey", args=(self.sappkey,))
     
-    @property
-    def command(self):
-        if Cmd.mode == "binary":
-            cmd = f"0x1B 0x2A "
-            cmd += f"0x{int(self.binary.hex(), 16):>02X} "
-            # binary_cmd = COMMAND_MAP[self._command]['binary']
-            # cmd += f"0x{int(binary_cmd.hex(), 16):>02X} " if binary_cmd else ""
-            _sappkey = (self.sappkey).split()
-            cmd += " ".join(f"0x{sappkey}" for sappkey in _sappkey)
-            cmd += " 0x1B 0x42"
-            return cmd
-        return self.command_property()
+    def binary_args(self):
+        return bytes.fromhex(self.sappkey)
 
 class Gappkey(CmdRtrn):
     ascii = " gAppKey"
@@ -373,11 +480,10 @@ class Gappkey(CmdRtrn):
     def __init__(self, return_value):
         super().__init__("gAppKey", return_value)
 
-    @property
-    def return_value(self):
+    def return_value_for(self, mode):
         if self._return_value is None:
             return
-        if Cmd.mode == "binary":
+        if mode == "binary":
             _return_value_parts = ["1B 50", self._return_value, "1B 51 01"]
             return " ".join(_return_value_parts)
         else:
@@ -388,23 +494,14 @@ class Sappskey(Cmd):
     ascii = " sAppSKey"
     at = " AT+k"
     binary =  b"\xAE"
+    parameter = "appskey"
 
     def __init__(self, sappskey):
         self.sappskey = sappskey
         super().__init__("sAppSKey", args=(self.sappskey,))
     
-    @property
-    def command(self):
-        if Cmd.mode == "binary":
-            cmd = f"0x1B 0x2A "
-            cmd += f"0x{int(self.binary.hex(), 16):>02X} "
-            # binary_cmd = COMMAND_MAP[self._command]['binary']
-            # cmd += f"0x{int(binary_cmd.hex(), 16):>02X} " if binary_cmd else ""
-            _sappskey = (self.sappskey).split()
-            cmd += " ".join(f"0x{sappskey}" for sappskey in _sappskey)
-            cmd += " 0x1B 0x42"
-            return cmd
-        return self.command_property()
+    def binary_args(self):
+        return bytes.fromhex(self.sappskey)
 
 class Gappskey(CmdRtrn):
     ascii = " gAppSKey"
@@ -414,11 +511,10 @@ class Gappskey(CmdRtrn):
     def __init__(self, return_value):
         super().__init__("gAppSKey", return_value)  
 
-    @property
-    def return_value(self):
+    def return_value_for(self, mode):
         if self._return_value is None:
             return
-        if Cmd.mode == "binary":
+        if mode == "binary":
             _return_value_parts = ["1B 50", self._return_value, "1B 51 01"]
             return " ".join(_return_value_parts)
         else:
@@ -428,23 +524,14 @@ class Snwkskey(Cmd):
     ascii = " sNwkSKey"
     at = " AT+N"
     binary =  b"\xAD"
+    parameter = "nwkskey"
 
     def __init__(self, snwkskey):
         self.snwkskey = snwkskey
         super().__init__("sNwkSKey", args=(self.snwkskey,))
     
-    @property
-    def command(self):
-        if Cmd.mode == "binary":
-            cmd = f"0x1B 0x2A "
-            cmd += f"0x{int(self.binary.hex(), 16):>02X} "
-            # binary_cmd = COMMAND_MAP[self._command]['binary']
-            # cmd += f"0x{int(binary_cmd.hex(), 16):>02X} " if binary_cmd else ""
-            _snwkskey = (self.snwkskey).split()
-            cmd += " ".join(f"0x{snwkskey}" for snwkskey in _snwkskey)
-            cmd += " 0x1B 0x42"
-            return cmd
-        return self.command_property()
+    def binary_args(self):
+        return bytes.fromhex(self.snwkskey)
 
 class Gnwkskey(CmdRtrn):
     ascii = " gNwkSKey"
@@ -454,11 +541,10 @@ class Gnwkskey(CmdRtrn):
     def __init__(self, return_value):
         super().__init__("gNwkSKey", return_value)
 
-    @property
-    def return_value(self):
+    def return_value_for(self, mode):
         if self._return_value is None:
             return
-        if Cmd.mode == "binary":
+        if mode == "binary":
             _return_value_parts = ["1B 50", self._return_value, "1B 51 01"]
             return " ".join(_return_value_parts)
         else:
@@ -468,23 +554,14 @@ class Sdevaddr(Cmd):
     ascii = " sDevAddr"
     at = " AT+V"
     binary =  b"\xAC"
+    parameter = "devaddr"
 
     def __init__(self, sdevaddr):
         self.sdevaddr = sdevaddr
         super().__init__("sDevAddr", args=(self.sdevaddr,))
     
-    @property
-    def command(self):
-        if Cmd.mode == "binary":
-            cmd = f"0x1B 0x2A "
-            cmd += f"0x{int(self.binary.hex(), 16):>02X} "
-            # binary_cmd = COMMAND_MAP[self._command]['binary']
-            # cmd += f"0x{int(binary_cmd.hex(), 16):>02X} " if binary_cmd else ""
-            _sdevaddr = (self.sdevaddr).split()
-            cmd += " ".join(f"0x{sdevaddr}" for sdevaddr in _sdevaddr)
-            cmd += " 0x1B 0x42"
-            return cmd
-        return self.command_property()
+    def binary_args(self):
+        return bytes.fromhex(self.sdevaddr)
 
 class Gdevaddr(CmdRtrn):
     ascii = " gDevAddr"
@@ -494,11 +571,10 @@ class Gdevaddr(CmdRtrn):
     def __init__(self, return_value):
         super().__init__("gDevAddr", return_value)
 
-    @property
-    def return_value(self):
+    def return_value_for(self, mode):
         if self._return_value is None:
             return
-        if Cmd.mode == "binary":
+        if mode == "binary":
             _return_value_parts = ["1B 50", self._return_value, "1B 51 01"]
             return " ".join(_return_value_parts)
         else:
@@ -508,6 +584,7 @@ class Sotaa(Cmd):
     ascii = " sOTAA"
     at = " AT+T"
     binary =  b"\xA8"
+    parameter = "otaa"
 
     def __init__(self, enabled):
         self.enabled = enabled
@@ -525,29 +602,37 @@ class SendBytes(Cmd):
     ascii = "sendb"
     at = "AT+X"
     binary = b"\x20"
+    pipelined = False  # Waits for the "$" prompt
 
     def __init__(self, length, string: str):
         self.length = length
-        self.string = string
+        self.string = string  # str, or bytes for binary payloads
         super().__init__("sendb", args=(f"{self.length:02X}",))
 
     @property
-    def command(self):
-        if Cmd.mode == "binary":
-            cmd = f"0x1B 0x2A "
-            # binary_cmd = COMMAND_MAP[self._command]['binary']
-            # cmd += f"0x{int(binary_cmd.hex(), 16):>02X} " if binary_cmd else ""
-            cmd += f"0x{int(self.binary.hex(), 16):>02X} "
-            for char in self.string.encode():
-                cmd += f"0x{int(char):>02X} "
-            cmd += "0x1B 0x42"
-            return cmd
-        return self.command_property()
+    def payload(self):
+        return self.string if isinstance(self.string, bytes) else self.string.encode()
+
+    def binary_args(self):
+        return self.payload
+
+    def cache_key(self):
+        return super().cache_key() + (self.string,)
+
+    def stream_parts(self, mode):
+        """(command bytes, payload bytes) as written by a streaming send,
+        built in bulk and without the encoding cache. The payload follows
+        the "$" prompt of the text parsers; in binary it is in the command
+        and the second part is None"""
+        if mode == "binary":
+            return b"".join((BINARY_START, self.binary, self.payload, BINARY_END)), None
+        return encode_line(self.command_for(mode)), self.payload + END_STRING.encode()
 
 class Lwjoin(Cmd):
     ascii = " lwjoin"
     at = " AT+J"
     binary =  b"\xA6"
+    pipelined = False  # Events follow the response
 
     def __init__(self):
         super().__init__("lwjoin")
@@ -556,15 +641,15 @@ class Lwjoinbin(CmdRtrn):
     ascii = " lwjoin"
     at = " AT+J"
     binary =  b"\xA6"
+    pipelined = False  # Events follow the response
 
     def __init__(self, return_value):
         super().__init__("lwjoin", return_value)
 
-    @property
-    def return_value(self):
+    def return_value_for(self, mode):
         if self._return_value is None:
             return
-        if Cmd.mode == "binary":
+        if mode == "binary":
             self._return_value = "1B 51 01 1B 53 4A 6F 69 6E 69 6E 67 20 74 68 65 20 4C 6F 52 61 57 41 4E 20 6E 65 74 77 6F 72 6B 2E 2E 2E"
             _return_value_parts = ["1B 50", self._return_value, "1B 54"]
             return " ".join(_return_value_parts)
@@ -575,15 +660,15 @@ class Lwjoinbinabp(CmdRtrn):
     ascii = " lwjoin"
     at = " AT+J"
     binary =  b"\xA6"
+    pipelined = False  # Events follow the response
 
     def __init__(self, return_value):
         super().__init__("lwjoin", return_value)
 
-    @property
-    def return_value(self):
+    def return_value_for(self, mode):
         if self._return_value is None:
             return
-        if Cmd.mode == "binary":
+        if mode == "binary":
             self._return_value = "1B 51 01 1B 53 4A 6F 69 6E 69 6E 67 20 74 68 65 20 4C 6F 52 61 57 41 4E 20 6E 65 74 77 6F 72 6B 2E 2E 2E 1B 54 1B 53 44 65 76 69 63 65 20 73 65 74 20 62 79 20 41 42 50"
             _return_value_parts = ["1B 50", self._return_value, "1B 54"]
             return " ".join(_return_value_parts)
@@ -594,6 +679,8 @@ class SetParser(Cmd):
     ascii = "sparser"
     at = "AT!P"
     binary = b"\xFB"
+    pipelined = False
+    invalidates = True
 
     def __init__(self):
         super().__init__("sparser", response="")
@@ -602,29 +689,38 @@ class SendBytes(Cmd):
     ascii = "sendb"
     at = "AT+X"
     binary = b"\x20"
+    pipelined = False  # Waits for the "$" prompt
 
     def __init__(self, length, string: str):
         self.length = length
-        self.string = string
+        self.string = string  # str, or bytes for binary payloads
         super().__init__("sendb", args=(f"{self.length:02X}",))
 
     @property
-    def command(self):
-        if Cmd.mode == "binary":
-            cmd = f"0x1B 0x2A "
-            # binary_cmd = COMMAND_MAP[self._command]['binary']
-            # cmd += f"0x{int(binary_cmd.hex(), 16):>02X} " if binary_cmd else ""
-            cmd += f"0x{int(self.binary.hex(), 16):>02X} "
-            for char in self.string.encode():
-                cmd += f"0x{int(char):>02X} "
-            cmd += "0x1B 0x42"
-            return cmd
-        return self.command_property()
+    def payload(self):
+        return self.string if isinstance(self.string, bytes) else self.string.encode()
+
+    def binary_args(self):
+        return self.payload
+
+    def cache_key(self):
+        return super().cache_key() + (self.string,)
+
+    def stream_parts(self, mode):
+        """(command bytes, payload bytes) as written by a streaming send,
+        built in bulk and without the encoding cache. The payload follows
+        the "$" prompt of the text parsers; in binary it is in the command
+        and the second part is None"""
+        if mode == "binary":
+            return b"".join((BINARY_START, self.binary, self.payload, BINARY_END)), None
+        return encode_line(self.command_for(mode)), self.payload + END_STRING.encode()
 
 class Reset(Cmd):
     ascii = " reset"
     at = " AT!!"
     binary =  b"\x12"
+    pipelined = False
+    invalidates = True
 
     def __init__(self):
         super().__init__("reset", response=None)
\ No newline at end of file
@@ -10,6 +10,9 @@ import pandas as pd
 import pytest
 import yaml
 
+from hello import replay, shadow, transports
+from hello.pool import DevicePool
+
 
 cur_path = os.path.dirname(os.path.realpath(__file__))
 log_path = os.path.join(cur_path, "logs")
@@ -56,6 +59,51 @@ def pytest_addoption(parser):
         type=valid_config_file
     )
 
+    parser.addoption(
+        "--record-dir",
+        action="store",
+        default=None,
+        help="Record the serial traffic of every device to transcripts in this directory",
+    )
+
+    parser.addoption(
+        "--transport",
+        action="store",
+        default=None,
+        choices=["serial", *transports.TRANSPORTS],
+        help="How to open the serial ports: serial (pyserial), fd (raw termios) or pty",
+    )
+
+    parser.addoption(
+        "--mux",
+        action="store",
+        default=None,
+        help="Socket of a hello.mux daemon to lease the configured devices from, instead of opening their ports",
+    )
+
+    parser.addoption(
+        "--farm",
+        action="store",
+        default=None,
+        help="Farm inventory: lease a free device pair from it as device1 and device2, one pair per xdist worker",
+        type=valid_config_file
+    )
+
+    parser.addoption(
+        "--farm-wait",
+        action="store",
+        default=0,
+        type=float,
+        help="Seconds to wait for a device pair of the farm to become free",
+    )
+
+    parser.addoption(
+        "--no-shadow",
+        action="store_true",
+        default=False,
+        help="Send every set command, even when the device has the value already",
+    )
+
     parser.addoption(
         "--parser_mode",
         action="store",
@@ -65,6 +113,15 @@ def pytest_addoption(parser):
     )
 
 
+def pytest_configure(config):
+    if config.getoption("--record-dir"):
+        replay.record_dir = config.getoption("--record-dir")
+    if config.getoption("--transport"):
+        transports.default_kind = config.getoption("--transport")
+    if config.getoption("--no-shadow"):
+        shadow.enabled = False
+
+
 def valid_com_port(value):
     if not value.startswith("COM") and not value.startswith("/dev/tty"):
         raise pytest.UsageError("COM port must be specified like COMX")
@@ -105,13 +162,47 @@ def lorawan_application_key(request):
     return application_key
 
 
+@pytest.fixture(scope="session")
+def farm_lease(request):
+    """Device pair of the --farm inventory leased to this worker, None without a farm"""
+    inventory = request.config.getoption("--farm")
+    if not inventory:
+        yield None
+        return
+    from hello.farm import FarmLease, load_inventory  # POSIX only (fcntl)
+    lease = FarmLease(load_inventory(inventory), wait=request.config.getoption("--farm-wait"))
+    pair = lease.acquire()
+    yield pair
+    lease.release()
+
+
 @pytest.fixture(scope='session')
-def config_data(request):
+def config_data(request, farm_lease):
     config_file = request.config.getoption('--configuration')
     logging.info(f'Configuration file path: {config_file}')
-    with open(config_file) as file:
-        data = yaml.safe_load(file)
-        return data
+    if config_file is None and farm_lease is not None:
+        data = {}
+    else:
+        with open(config_file) as file:
+            data = yaml.safe_load(file)
+    mux_socket = request.config.getoption("--mux")
+    if mux_socket:
+        from hello.mux import mux_url  # POSIX only (Unix sockets)
+        for name, entry in data.items():
+            if name.startswith("device"):
+                entry['port'] = mux_url(mux_socket, name)
+    if farm_lease is not None:
+        # The pair replaces device1 and device2; its ports may be mux:// urls
+        data.update({name: dict(entry) for name, entry in farm_lease.items()})
+    return data
+
+
+@pytest.fixture(scope="session")
+def device_pool(config_data):
+    """Configured devices, opened once and leased to each test"""
+    pool = DevicePool(config_data)
+    yield pool
+    pool.close()
 
 
 @pytest.fixture(scope="session")
@@ -0,0 +1,125 @@
+# Allocation of the boards of a farm to parallel test processes, e.g. the
+# workers of pytest-xdist: each process leases a pair of boards from the
+# inventory for its session, with an exclusive lock file per board. The
+# locks go with the process, so a crashed worker frees its boards.
+#
+# Inventory (YAML), pairs in the device1/device2 form of --configuration:
+#
+#   lock_dir: /tmp/hello-farm  # Optional, $HELLO_FARM_LOCK_DIR by default
+#   pairs:
+#     - device1: {port: /dev/ttyUSB0, baudrate: 115200}
+#       device2: {port: /dev/ttyUSB1, baudrate: 115200}
+#     - device1: {port: /dev/ttyUSB2, baudrate: 115200}
+#       device2: {port: /dev/ttyUSB3, baudrate: 115200}
+#
+#   pytest hello --farm farm.yaml -n 2
+
+import fcntl
+import logging
+import os
+import re
+import time
+
+import yaml
+
+
+def default_lock_dir():
+    return os.environ.get("HELLO_FARM_LOCK_DIR", "/tmp/hello-farm")
+
+
+def worker_id():
+    """Name of the pytest-xdist worker running this process, "master" outside xdist"""
+    return os.environ.get("PYTEST_XDIST_WORKER", "master")
+
+
+def load_inventory(filepath):
+    with open(filepath) as file:
+        inventory = yaml.safe_load(file)
+    if not isinstance(inventory, dict) or not inventory.get("pairs"):
+        raise Exception(f"Farm inventory {filepath} lists no device pairs")
+    return inventory
+
+
+class BoardLock(object):
+    """
+    Exclusive lock of one board: a file in lock_dir named after its port,
+    which holds the owner of the lock while it is taken.
+    """
+
+    def __init__(self, lock_dir, port):
+        self.filepath = os.path.join(lock_dir, re.sub(r"\W+", "_", port).strip("_") + ".lock")
+        self.file = None
+
+    def acquire(self, owner):
+        lock_file = open(self.filepath, "a+")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(owner)
+        lock_file.flush()
+        self.file = lock_file
+        return True
+
+    def release(self):
+        if self.file is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+
+class FarmLease(object):
+    """
+    Pair of boards of the inventory leased to this process. acquire() takes
+    the first pair whose boards are all free, starting at the pair of the
+    worker's number so that workers rarely contend, and waits up to wait
+    seconds for one to be released.
+    """
+
+    def __init__(self, inventory, owner=None, wait=0, poll=0.5):
+        self.pairs = inventory["pairs"]
+        self.lock_dir = inventory.get("lock_dir") or default_lock_dir()
+        self.owner = owner or worker_id()
+        self.wait = wait
+        self.poll = poll
+        self.locks = []
+        self.pair = None
+
+    def _first(self):
+        number = re.search(r"\d+$", self.owner)
+        return int(number.group()) % len(self.pairs) if number else 0
+
+    def _try(self, pair):
+        owner = f"{self.owner} {os.getpid()}"
+        for entry in pair.values():
+            lock = BoardLock(self.lock_dir, entry['port'])
+            if not lock.acquire(owner):
+                self.release()
+                return False
+            self.locks.append(lock)
+        self.pair = pair
+        return True
+
+    def acquire(self):
+        """The leased pair, {"device1": {...}, "device2": {...}}"""
+        os.makedirs(self.lock_dir, exist_ok=True)
+        deadline = time.monotonic() + self.wait
+        first = self._first()
+        while True:
+            for index in range(first, first + len(self.pairs)):
+                if self._try(self.pairs[index % len(self.pairs)]):
+                    logging.info(f"Farm pair {index % len(self.pairs)} leased to {self.owner}: "
+                                 f"{', '.join(entry['port'] for entry in self.pair.values())}")
+                    return self.pair
+            if time.monotonic() >= deadline:
+                raise Exception(f"No free device pair in the farm for {self.owner}")
+            time.sleep(self.poll)
+
+    def release(self):
+        for lock in self.locks:
+            lock.release()
+        self.locks.clear()
+        self.pair = None
@@ -0,0 +1,148 @@
+from collections import namedtuple
+from functools import lru_cache
+
+
+# Binary parser framing: every frame starts with an escape byte
+ESC = 0x1B
+RESPONSE_START = 0x50  # 1B 50 <payload> 1B 51 <status>
+STATUS = 0x51
+EVENT_START = 0x53  # 1B 53 <text> 1B 54
+EVENT_END = 0x54
+
+# Frame kinds
+TEXT = "text"  # Line of ascii / AT parser output, terminator included
+RESPONSE = "response"  # Binary response, with or without payload
+STATUS_ONLY = "status"  # 1B 51 <status> without a response start
+EVENT = "event"  # Binary event text
+
+
+class Frame(namedtuple("Frame", "kind payload status raw")):
+    """
+    One message from the device.
+    payload is the bytes between the delimiters, raw the bytes as received.
+    """
+
+    @property
+    def binary(self):
+        return self.kind != TEXT
+
+    @property
+    def text(self):
+        return bytes.decode(self.payload.strip(), errors="ignore")
+
+    def hex(self):
+        """Same notation as the expected values, e.g. '1B 50 1B 51 01'"""
+        return self.raw.hex(" ").upper()
+
+
+@lru_cache(maxsize=1024)
+def expected_bytes(value):
+    """Bytes for an expected value written in hex notation, None otherwise"""
+    if not value or not value.startswith(("1B", "1b")):
+        return None
+    try:
+        return bytes.fromhex(value)
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=1024)
+def expected_candidates(expected):
+    """{bytes: value} for an expected value, or a tuple of values, in hex notation"""
+    candidates = {}
+    for value in expected if isinstance(expected, tuple) else (expected,):
+        expected_raw = expected_bytes(value)
+        if expected_raw is not None:
+            candidates[expected_raw] = value
+    return candidates
+
+
+class FrameDecoder(object):
+    """
+    Incremental decoder splitting a byte stream into frames.
+    Text lines end at a newline, binary frames at their closing escape
+    sequence, so they do not need a newline after them.
+    """
+
+    _IDLE = 0
+    _RESPONSE = 1
+    _STATUS = 2
+    _EVENT = 3
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._state = self._IDLE
+        self._escape = False
+        self._start = None  # Kind of the frame the pending status closes
+        self._payload = bytearray()
+        self._raw = bytearray()
+
+    def feed(self, data):
+        """Decode data and return the list of frames it completes"""
+        frames = []
+        for byte in data:
+            self._raw.append(byte)
+            if self._state == self._STATUS:
+                kind = RESPONSE if self._start == RESPONSE_START else STATUS_ONLY
+                frames.append(self._frame(kind, status=byte))
+            elif self._escape:
+                self._escape = False
+                self._escaped(byte, frames)
+            elif byte == ESC:
+                self._escape = True
+            elif self._state == self._IDLE:
+                self._payload.append(byte)
+                if byte == 0x0A:  # "\n"
+                    frames.append(self._frame(TEXT))
+            else:
+                self._payload.append(byte)
+        return frames
+
+    def _escaped(self, byte, frames):
+        if byte in (RESPONSE_START, STATUS, EVENT_START):
+            if self._state == self._IDLE and self._payload:
+                # Text without terminator right before a binary frame
+                self._raw = self._raw[:-2]
+                frames.append(self._frame(TEXT))
+                self._raw += bytes((ESC, byte))
+            elif self._state == self._RESPONSE and byte == EVENT_START:
+                # Response closed without status
+                self._raw = self._raw[:-2]
+                frames.append(self._frame(RESPONSE))
+                self._raw += bytes((ESC, byte))
+
+        if byte == RESPONSE_START and self._state == self._IDLE:
+            self._state = self._RESPONSE
+            self._start = RESPONSE_START
+        elif byte == STATUS and self._state in (self._IDLE, self._RESPONSE):
+            if self._state == self._IDLE:
+                self._start = STATUS
+            self._state = self._STATUS
+        elif byte == EVENT_START and self._state in (self._IDLE, self._RESPONSE):
+            self._state = self._EVENT
+        elif byte == EVENT_END and self._state == self._EVENT:
+            frames.append(self._frame(EVENT))
+        else:
+            # Not a delimiter: keep both bytes as data
+            self._payload += bytes((ESC, byte))
+
+    def _frame(self, kind, status=None):
+        frame = Frame(kind, bytes(self._payload), status, bytes(self._raw))
+        self._state = self._IDLE
+        self._start = None
+        self._payload.clear()
+        self._raw = bytearray()
+        return frame
+
+    @property
+    def pending(self):
+        """True while a frame has started but is not complete"""
+        return bool(self._raw)
+
+    def flush(self):
+        """Hand out an unterminated text line; partial binary frames are kept"""
+        if self._state == self._IDLE and self._payload and not self._escape:
+            return [self._frame(TEXT)]
+        return []
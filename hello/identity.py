@@ -0,0 +1,81 @@
+# On-disk cache of the "version" answers of the boards, so identify() can
+# skip the query for a board it has seen before. Entries are keyed by port
+# and the USB serial number of the board, which list_ports gives without
+# any I/O on the port; ports that are not USB devices (ptys, sockets) are
+# never cached. A firmware update is not noticed: identify(refresh=True)
+# queries the board again.
+#
+# The cache file is $HELLO_IDENTITY_CACHE, ~/.cache/hello/identity.json
+# by default.
+
+import json
+import logging
+import os
+import threading
+
+from serial.tools import list_ports
+
+
+def default_cache_filepath():
+    return os.environ.get("HELLO_IDENTITY_CACHE",
+                          os.path.join(os.path.expanduser("~"), ".cache", "hello", "identity.json"))
+
+
+def usb_serial_number(port):
+    """Serial number of the USB device behind port, None if there is none"""
+    try:
+        for info in list_ports.comports():
+            if info.device == port:
+                return info.serial_number
+    except OSError:
+        pass
+    return None
+
+
+class IdentityCache(object):
+    """
+    Version lines per board, loaded from and saved to filepath.
+    """
+
+    def __init__(self, filepath=None):
+        self.filepath = filepath or default_cache_filepath()
+        self.lock = threading.Lock()
+        self.entries = None  # Loaded on first use
+
+    def key(self, port):
+        """Key of the board on port, None if it has no USB serial number"""
+        serial_number = usb_serial_number(port)
+        return f"{port}|{serial_number}" if serial_number else None
+
+    def _load(self):
+        if self.entries is None:
+            try:
+                with open(self.filepath) as cache_file:
+                    self.entries = json.load(cache_file)
+            except (OSError, ValueError):
+                self.entries = {}
+        return self.entries
+
+    def get(self, key):
+        """Cached version lines of key, or None"""
+        with self.lock:
+            return self._load().get(key)
+
+    def put(self, key, lines):
+        with self.lock:
+            entries = self._load()
+            if entries.get(key) == lines:
+                return
+            entries[key] = lines
+            try:
+                os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+                temp_filepath = f"{self.filepath}.{os.getpid()}"
+                with open(temp_filepath, "w") as cache_file:
+                    json.dump(entries, cache_file, indent=2)
+                os.replace(temp_filepath, self.filepath)
+            except OSError as error:
+                logging.warning(f"Identity cache not saved: {error}")
+
+
+# Shared by all devices
+identity_cache = IdentityCache()
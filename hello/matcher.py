@@ -0,0 +1,107 @@
+# Classification of the messages a device sends without being asked:
+# expected events, error codes and other events, in text or in the hex
+# notation of binary frames. A matcher compiles all of its patterns into
+# one regular expression, so each message is classified in a single pass.
+
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+# Kinds of message
+EXPECTED = "expected"
+ERROR = "error"
+EVENT = "event"
+OTHER = "other"
+
+# Error codes of the text parsers; the binary parser sends the same code
+# as the status byte of its response, e.g. ERFA> -> 1B 51 FA
+ERROR_CODES = (
+    "ERFE>",  # Invalid command
+    "ERFD>",  # Empty token
+    "ERFC>",  # Malformed token
+    "ERFB>",  # Parser timeout
+    "ERFA>",  # Modem busy
+    "ERF9>",  # Not enough arguments
+    "ERF8>",  # Arguments out of bounds
+    "ERF7>",  # Modem unable to execute command
+)
+
+# Unsolicited event lines: "EVENT <text>", or 1B 53 <text> 1B 54
+EVENT_PREFIXES = ("EVENT ", "1B 53 ")
+
+JOIN_EVENTS = ("Joining the LoRaWAN network...", "Joined network")
+
+
+def text_event(text):
+    return "EVENT " + text
+
+
+def binary_event(text):
+    return (b"\x1bS" + text.encode() + b"\x1bT").hex(" ").upper()
+
+
+class Match(namedtuple("Match", "kind name message")):
+    """
+    Classified message. name is the expected event or error code that
+    matched, or the event text, message the message as read.
+    """
+
+
+class EventMatcher(object):
+    """
+    Matcher compiled once from the expected events, the error codes and the
+    prefixes of unsolicited events. classify() checks the patterns in that
+    order of priority.
+    """
+
+    def __init__(self, expected=(), errors=ERROR_CODES, prefixes=EVENT_PREFIXES):
+        self.expected = tuple(expected)
+        self.groups = {}  # Regex group -> (kind, name)
+        alternatives = []
+        for kind, patterns in ((EXPECTED, [(event, re.escape(event)) for event in self.expected]),
+                               (ERROR, [(code, self._error_pattern(code)) for code in errors]),
+                               (EVENT, [(prefix, re.escape(prefix) + ".*") for prefix in prefixes])):
+            for name, pattern in patterns:
+                group = f"g{len(self.groups)}"
+                self.groups[group] = (kind, name)
+                alternatives.append(f"(?P<{group}>{pattern})")
+        self.regex = re.compile("|".join(alternatives) or "(?!)", re.DOTALL)
+
+    @staticmethod
+    def _error_pattern(code):
+        status = code[2:4] if re.fullmatch(r"ER[0-9A-F]{2}>", code) else None
+        if status is None:
+            return re.escape(code)
+        return f"{re.escape(code)}|(?:1B 50 )?1B 51 {status}"
+
+    @classmethod
+    @lru_cache(maxsize=256)
+    def of(cls, *expected):
+        """Matcher for the expected events, built once per set of events"""
+        return cls(expected)
+
+    def classify(self, message):
+        match = self.regex.fullmatch(message) if message else None
+        if match is None:
+            return Match(OTHER, None, message)
+        kind, name = self.groups[match.lastgroup]
+        if kind == EVENT:
+            name = self._event_text(message)
+        return Match(kind, name, message)
+
+    @staticmethod
+    def _event_text(message):
+        if message.startswith("EVENT "):
+            return message[len("EVENT "):]
+        try:
+            return bytes.fromhex(message)[2:-2].decode(errors="ignore")
+        except ValueError:
+            return message
+
+    def __contains__(self, message):
+        return self.classify(message).kind == EXPECTED
+
+
+# Events read_event skips once the device has joined, as the scripts spell
+# them: the Joining event of the text parsers and the binary Joined event
+join_events = frozenset((JOIN_EVENTS[0], binary_event(JOIN_EVENTS[1])))
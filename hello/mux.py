@@ -0,0 +1,298 @@
+# Multiplexer daemon owning the serial ports of a farm, so that several test
+# processes (parallel pytest sessions, flows) share the boards instead of
+# fighting over the ttys. It opens every configured port once, keeps it
+# open and woken, and leases each board to one client at a time over a Unix
+# domain socket, in the MUX_* frames of hello.transports. A client either
+# relays the bytes of the port both ways, which is how Device drives it
+# (events come whenever the board sends them), or sends a command request
+# and gets back its answer, the input up to the response, in one frame.
+#
+#   python -m hello.mux --configuration farm.yaml --socket /tmp/hello-mux.sock
+#
+# Clients open mux://<socket path>#<device name>, e.g. through pytest
+# --mux <socket path>, which points the configured devices at the daemon.
+
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+
+import serial
+import yaml
+
+from hello.commands import Codec, WakeUp
+from hello.frames import FrameDecoder, RESPONSE, STATUS_ONLY
+from hello.transports import open_transport, mux_frame, mux_frames, MUX_LEASE, MUX_WRITE, MUX_DATA, MUX_RESET, \
+    MUX_RELEASE, MUX_COMMAND, MUX_ANSWER, MUX_OK, MUX_ERROR
+
+
+def default_socket_path():
+    return os.environ.get("HELLO_MUX_SOCKET", "/tmp/hello-mux.sock")
+
+
+def mux_url(socket_path, name):
+    return f"mux://{socket_path}#{name}"
+
+
+def ends_answer(frame):
+    """True for the frame closing the answer to a command: a prompt such as
+    OK00> or ERFA>, or a binary response"""
+    if frame.binary:
+        return frame.kind in (RESPONSE, STATUS_ONLY)
+    return frame.text.startswith(("OK", "ER")) and frame.text.endswith(">")
+
+
+class MuxPort(object):
+    """
+    Board owned by the daemon. A thread of its own reads the port and relays
+    the input to the client holding the lease; without one the input is
+    dropped, and after keepalive idle seconds the board is woken up again.
+    While a command request waits, the input goes to its answer instead.
+    """
+
+    def __init__(self, name, port, baudrate, mode="ascii", keepalive=None, timeout=0.2):
+        self.name = name
+        self.port = port
+        self.baudrate = baudrate
+        self.transport = open_transport(port, baudrate, timeout)
+        self.wake_up = Codec(mode).encode(WakeUp())
+        self.keepalive = keepalive
+        self.holder = None  # Client holding the lease
+        self.answer = None  # Input of the command waiting for its answer
+        self.answer_length = 0  # Bytes of the frames of answer decoded so far
+        self.decoder = FrameDecoder()
+        self.cond = threading.Condition()  # Ordering of the answers and the relayed input
+        self.last_activity = time.monotonic()
+        self.running = True
+        self.transport.write(self.wake_up)
+        self.reader = threading.Thread(target=self._relay, daemon=True)
+        self.reader.start()
+
+    def _relay(self):
+        read = getattr(self.transport, "read_chunk", None) or \
+            (lambda: self.transport.read(self.transport.in_waiting or 1))
+        while self.running:
+            try:
+                data = read()
+            except (serial.SerialException, OSError, TypeError, AttributeError):
+                break  # Port closed under us
+            now = time.monotonic()
+            with self.cond:
+                if data:
+                    self.last_activity = now
+                    if self.answer is not None:
+                        data = self._take_answer(data)
+                    if data and self.holder is not None:
+                        self.holder.send(MUX_DATA, data)
+                elif self.holder is None and self.keepalive and now - self.last_activity >= self.keepalive:
+                    self.transport.write(self.wake_up)
+                    self.last_activity = now
+
+    def _take_answer(self, data):
+        """Add data to the answer of the waiting command, and send the answer
+        once its response is in. Returns the input that came after it"""
+        self.answer += data
+        for frame in self.decoder.feed(data):
+            self.answer_length += len(frame.raw)
+            if ends_answer(frame):
+                rest = bytes(self.answer[self.answer_length:])
+                self._send_answer(self.answer[:self.answer_length])
+                return rest
+        return b""
+
+    def _send_answer(self, answer):
+        self.holder.send(MUX_ANSWER, bytes(answer))
+        self.answer = None
+        self.cond.notify_all()
+
+    def lease(self, client, wait):
+        """Lease the board to client, waiting up to wait seconds for the
+        holder to release it. The answer goes out before any input"""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.holder is None, wait):
+                return False
+            self.holder = client
+            self.transport.reset_input_buffer()
+            client.send(MUX_OK, json.dumps({"port": self.port, "baudrate": self.baudrate}).encode())
+        logging.info(f"{self.name} leased")
+        return True
+
+    def release(self, client):
+        with self.cond:
+            if self.holder is client:
+                self.holder = None
+                self.last_activity = time.monotonic()
+                self.cond.notify_all()
+                logging.info(f"{self.name} released")
+
+    def write(self, client, data):
+        if self.holder is client:
+            self.transport.write(data)
+
+    def command(self, client, data, timeout):
+        """Write data and send its answer once the response is in; after
+        timeout seconds what came so far is sent as the answer"""
+        with self.cond:
+            if self.holder is not client:
+                return
+            self.answer, self.answer_length = bytearray(), 0
+            self.decoder.reset()
+            self.transport.write(data)
+            if not self.cond.wait_for(lambda: self.answer is None, timeout):
+                self._send_answer(self.answer)
+
+    def reset(self, client):
+        """Flush the input; the answer marks where the input after it starts"""
+        with self.cond:
+            if self.holder is client:
+                self.transport.reset_input_buffer()
+                client.send(MUX_OK)
+
+    def close(self):
+        self.running = False
+        self.transport.close()
+        self.reader.join(1)
+
+
+class MuxHandler(socketserver.BaseRequestHandler):
+    """One client connection, which may lease one board at a time"""
+
+    def setup(self):
+        self.send_lock = threading.Lock()
+        self.port = None
+
+    def send(self, kind, payload=b""):
+        with self.send_lock:
+            try:
+                self.request.sendall(mux_frame(kind, payload))
+            except OSError:
+                pass  # Gone; handle() sees the end of the connection
+
+    def handle(self):
+        received = bytearray()
+        while True:
+            try:
+                data = self.request.recv(65536)
+            except OSError:
+                break
+            if not data:
+                break
+            received += data
+            for kind, payload in mux_frames(received):
+                self.dispatch(kind, payload)
+
+    def dispatch(self, kind, payload):
+        if kind == MUX_LEASE:
+            request = json.loads(payload)
+            port = self.server.ports.get(request["device"])
+            if port is None:
+                self.send(MUX_ERROR, f"unknown device {request['device']}".encode())
+            elif self.port is not None:
+                self.send(MUX_ERROR, f"{self.port.name} already leased on this connection".encode())
+            elif port.lease(self, request.get("wait", 0)):
+                self.port = port
+            else:
+                self.send(MUX_ERROR, b"busy")
+        elif self.port is None:
+            self.send(MUX_ERROR, b"no device leased")
+        elif kind == MUX_WRITE:
+            self.port.write(self, payload)
+        elif kind == MUX_COMMAND:
+            request = json.loads(payload)
+            self.port.command(self, bytes.fromhex(request["data"]), request.get("timeout", 5))
+        elif kind == MUX_RESET:
+            self.port.reset(self)
+        elif kind == MUX_RELEASE:
+            self.port.release(self)
+            self.port = None
+
+    def finish(self):
+        if self.port is not None:
+            self.port.release(self)
+
+
+class MuxServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, ports):
+        self.ports = ports
+        if os.path.exists(socket_path):
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                    probe.connect(socket_path)
+                raise Exception(f"A mux daemon is already serving {socket_path}")
+            except ConnectionRefusedError:
+                os.remove(socket_path)  # Left over by a daemon that died
+        super().__init__(socket_path, MuxHandler)
+
+
+class MuxDaemon(object):
+    """
+    Daemon serving the devices of config_data (device1, device2, ... with
+    port, baudrate and optionally parser_mode) at socket_path.
+    """
+
+    def __init__(self, config_data, socket_path=None, keepalive=None):
+        self.socket_path = socket_path or default_socket_path()
+        self.ports = {}
+        try:
+            for name, entry in config_data.items():
+                if name.startswith("device"):
+                    self.ports[name] = MuxPort(name, entry['port'], entry['baudrate'],
+                                               entry.get('parser_mode', "ascii"), keepalive)
+            self.server = MuxServer(self.socket_path, self.ports)
+        except BaseException:
+            for port in self.ports.values():
+                port.close()
+            raise
+        self.thread = None
+
+    def start(self):
+        """Serve on a thread of its own"""
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.thread is not None:
+            self.server.shutdown()
+        self.server.server_close()
+        for port in self.ports.values():
+            port.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Share the serial ports of a device farm between test processes")
+    parser.add_argument("--configuration", required=True, help="Configuration file listing the devices")
+    parser.add_argument("--socket", default=default_socket_path(), help="Unix socket to serve at")
+    parser.add_argument("--keepalive", type=float, default=None,
+                        help="Wake idle boards up after this many seconds without input")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    with open(args.configuration) as file:
+        config_data = yaml.safe_load(file)
+    daemon = MuxDaemon(config_data, args.socket, args.keepalive)
+    logging.info(f"Serving {', '.join(daemon.ports)} at {daemon.socket_path}")
+    try:
+        daemon.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+# Parser mode of the boards: detection with an ascii and a binary ping,
+# run concurrently over all ports, and remembered per port for the session.
+# Only a mode confirmed by a ping is remembered. A port is probed again
+# after an answer showed that the board is in another parser than the one
+# commands are encoded for.
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest_check as check
+
+from hello.commands import SetParser
+
+BINARY_PING = "0x1B 0x2A 0x11 0x1B 0x42"
+BINARY_PONG = "1B 50 1B 51 01"
+
+# Seconds a probe waits for its answer, as long as test_executor.return_timeout.
+# A board in the other parser stays silent, so probes are not timed: their
+# silences would raise the learned deadlines of the real pings
+probe_timeout = 5
+
+
+class ParserModes(object):
+    """Parser mode per port"""
+
+    def __init__(self):
+        self.modes = {}
+        self.lock = threading.Lock()
+
+    def get(self, port):
+        with self.lock:
+            return self.modes.get(port)
+
+    def set(self, port, mode):
+        with self.lock:
+            self.modes[port] = mode
+
+    def forget(self, port):
+        with self.lock:
+            if self.modes.pop(port, None) is not None:
+                logging.info(f"Parser mode of {port} to be detected again")
+
+
+# Shared by all devices of the session
+parser_modes = ParserModes()
+
+
+def parser_mismatch(mode, actual):
+    """True when the answer actual to a command encoded for mode shows that
+    the parser is another one: binary frames to a text command and text to
+    a binary one. Silence proves nothing, the board may only be slow"""
+    if not isinstance(actual, str) or actual == "":
+        return False
+    if mode == "binary":
+        return not actual.startswith("1B")
+    return actual.startswith("1B")
+
+
+def ping(device, mode):
+    """Answer of the board to a ping in the text parsers, or in binary"""
+    if mode == "binary":
+        device.send_command(BINARY_PING, shadowed=True)
+        result = device.read_return_value(BINARY_PONG, check_return=False, timeout=probe_timeout)
+    else:
+        device.send_command("ping", shadowed=True)
+        result = device.read_return_value("PONG!", check_return=False, timeout=probe_timeout)
+    logging.info(f"{'Binary' if mode == 'binary' else 'ASCII'} ping: port = {device.port}, result = {result}")
+    return result["Actual"]
+
+
+def detect_parser_mode(device):
+    actual = ping(device, "ascii")
+    if actual == "":
+        if ping(device, "binary") == BINARY_PONG:
+            return "binary"
+    elif actual == "PONG!":
+        return "ascii"
+    result = device.read_response(check_response=False, timeout=probe_timeout)
+    logging.info(f"Read response: port = {device.port}, result = {result}")
+
+
+def parser_mode(device, refresh=False):
+    """Parser mode of the device, detected on the first call for its port"""
+    mode = None if refresh else parser_modes.get(device.port)
+    if mode is None:
+        mode = detect_parser_mode(device)
+        if mode is not None:
+            parser_modes.set(device.port, mode)
+    return mode
+
+
+def detect_parser_modes(devices, refresh=False):
+    """Parser modes of all devices, {port: mode}; the ports that are not
+    known yet are probed at the same time"""
+    devices = list(devices)
+    with ThreadPoolExecutor(max_workers=max(1, len(devices))) as executor:
+        modes = executor.map(lambda device: parser_mode(device, refresh), devices)
+        return {device.port: mode for device, mode in zip(devices, modes)}
+
+
+def set_parser_mode(device, current_mode, target_mode):
+    """Switch the board from current_mode, as detected (None if it was not),
+    to target_mode, and encode the commands of device for target_mode.
+    A switch is confirmed with a ping; the mode is remembered for the port
+    only when it is confirmed"""
+    confirmed = current_mode is not None and (current_mode == "binary") == (target_mode == "binary")
+    if current_mode == "ascii" or current_mode == "at":
+        if target_mode == "binary":
+            with device.codec.using("ascii"):
+                device.send_receive(SetParser())
+            confirmed = ping(device, "binary") == BINARY_PONG
+    elif current_mode == "binary":
+        if target_mode == "ascii" or target_mode == "at":
+            with device.codec.using("binary"):
+                device.send_receive(SetParser())
+                device.read_return_value(BINARY_PONG, check_return=False)
+
+            with device.codec.using(target_mode):
+                check.is_true(device.wake(4), f"{device.port} silent after switching to {target_mode}")
+            confirmed = ping(device, "ascii") == "PONG!"
+    device.codec.mode = target_mode
+    if current_mode is not None:
+        check.is_true(confirmed, f"{device.port} did not switch to {target_mode}")
+    if confirmed:
+        parser_modes.set(device.port, target_mode)
+    else:
+        parser_modes.forget(device.port)
@@ -0,0 +1,92 @@
+# Devices opened once per test session and leased to tests, so every test
+# does not pay for opening the port, identify() and waking the board up.
+# The configuration lists the devices as device1, device2, ... with their
+# port and baudrate, like the --configuration file of the tests.
+
+import logging
+import threading
+
+from hello.test_executor import Device
+
+
+def reset_device(device):
+    """Default reset hook: drop unread input and the per-test harness state.
+    The board itself is not reset. Its parameters are still forgotten (see
+    hello.shadow): a test may have changed them behind the shadow's back"""
+    device.reset_input_buffer()
+    device.shadow.invalidate("device leased again")
+    device.joined = False
+    device.last_command = None
+    device.tfailed.clear()
+    device.read_strings.clear()
+    device.rssi_list.clear()
+    device.transmit_status.clear()
+    device.transmit_strings.clear()
+
+
+class DevicePool(object):
+    """
+    Session-wide pool of the configured devices.
+    lease() opens and identifies a device the first time it is asked for,
+    afterwards it only points the device at the results file of the test
+    and runs the reset hook, reset(device), to bring it to a known state.
+    """
+
+    def __init__(self, config_data, results_filepath="Results.csv", reset=reset_device):
+        self.config_data = config_data
+        self.results_filepath = results_filepath
+        self.reset = reset
+        self.devices = {}  # Name in the configuration -> open Device
+        self.leased = set()
+        self.setups = set()  # (name, key) of the setups done by once()
+        self.lock = threading.Lock()
+
+    def lease(self, name, results_filepath=None):
+        """Device configured as name, e.g. "device1", for one test"""
+        results_filepath = results_filepath or self.results_filepath
+        with self.lock:
+            if name in self.leased:
+                raise Exception(f"Device {name} is already leased")
+            self.leased.add(name)
+        try:
+            device = self.devices.get(name)
+            if device is None:
+                entry = self.config_data[name]
+                device = Device(name[len("device"):] or name, entry['port'], entry['baudrate'],
+                                results_filepath=results_filepath)
+                device.identify()
+                self.devices[name] = device
+            else:
+                device.retarget(results_filepath)
+                if self.reset is not None:
+                    self.reset(device)
+            logging.info(f"Leased {name}: {device.port}")
+            return device
+        except BaseException:
+            self.release(name)
+            raise
+
+    def once(self, name, key, setup):
+        """Run setup(device) on the leased device only the first time key is
+        asked for in the session, e.g. waking the board and setting its parser.
+        This assumes the board is never reset during the session, as with the
+        default reset hook. The parser mode learned for its port (see
+        hello.parser_mode) is kept on the same assumption. A reset hook that
+        resets the board has to clear setups and forget that mode"""
+        if (name, key) not in self.setups:
+            setup(self.devices[name])
+            self.setups.add((name, key))
+
+    def release(self, name):
+        with self.lock:
+            self.leased.discard(name)
+        device = self.devices.get(name)
+        if device is not None:
+            device.spans.flush()
+
+    def close(self):
+        for device in self.devices.values():
+            device.close()
+        self.devices.clear()
+        self.leased.clear()
+        self.setups.clear()
@@ -0,0 +1,458 @@
+# Single-thread reactor for device farms: the ports of all boards are
+# registered with one selector (epoll on Linux), the bytes that arrive are
+# split into frames per device, and every device runs the lines of its lane
+# as a state machine that waits for its board without blocking. One thread,
+# and one core, serves the whole farm.
+#
+# ReactorFlowExecutor runs a test file like FlowTestExecutor(concurrent=True)
+# does, with the reactor in place of a thread per lane. To see how far it
+# scales:
+#
+#   python -m hello.benchmark --reactor 1 8 32 64
+
+import logging
+import os
+import selectors
+import time
+from collections import deque
+
+from hello import answers, test_executor
+from hello.commands import encode_line
+from hello.frames import FrameDecoder, expected_candidates
+from hello.matcher import EventMatcher, Match, EXPECTED, ERROR, OTHER
+from hello.test_executor import FlowTestExecutor, end_string, _declaration_, _toDevice_, _response_, _event_, \
+    _returned_, _sendChar_, _toConsoleIgnore_
+from hello.timeouts import percentile
+from hello.transports import open_transport
+
+
+class ReactorDevice(object):
+    """
+    Board served by a Reactor. start() hands it the lines of its lane, which
+    advance() runs one after the other; a line that waits for the board
+    sets a deadline and a handler for the next message instead of blocking.
+    guard is the pause before each command, serial_timeout like Device.
+    """
+
+    def __init__(self, newid, newport, newbaud, transport=None, guard=None):
+        self.devtype = "Unknown"
+        self.stackversion = None
+        self.execversion = None
+        self.id = newid
+        self.port = newport
+        self.baud = newbaud
+        # Only configures the port: the reactor reads its descriptor itself
+        self.device = transport if transport is not None else open_transport(newport, newbaud, 0)
+        self.fd = self.device.fileno()
+        os.set_blocking(self.fd, False)
+        self.guard = test_executor.serial_timeout if guard is None else guard
+        self.decoder = FrameDecoder()
+        self.frames = deque()
+        self.outgoing = bytearray()  # Bytes the port had no room for yet, see on_writable()
+        self.partial = None  # Binary frames read so far of a message spanning several
+        self.last_byte = 0.0
+        self.tfailed = []  # List with failed test lines
+        self.joined = False  # Store whether the device has joined a LoRaWAN network
+        self.last_command = None
+        self.read_strings = []
+        self.rssi_list = []
+        self.transmit_status = []
+        self.transmit_strings = []
+        self.mode = "-"
+        self.device_result = {
+            "DeviceID": self.id,
+            "DeviceType": self.devtype,
+            "ExecVersion": self.execversion,
+            "StackVersion": self.stackversion,
+            "Mode": self.mode,
+            "Command": self.last_command,
+            "Actual": None,
+            "Expected": None,
+            "Result": None,
+        }
+        self.lines = deque()
+        self.write_result = None
+        self.waiting = None  # Handler of the line waiting for the board, waiting(now) -> done
+        self.deadline = None
+        self.written_at = None
+        self.latencies = []  # Seconds from each command to its answer
+        self.closed = False
+
+    @property
+    def done(self):
+        return self.waiting is None and not self.lines
+
+    def start(self, lane, write_result):
+        """Run lane, a list of (line_num, test_line); write_result(row) gets
+        the result rows"""
+        self.lines.extend(lane)
+        self.write_result = write_result
+
+    def next_timer(self):
+        """Time at which advance() has something to do without input, or None"""
+        timers = [self.deadline] if self.waiting is not None and self.deadline is not None else []
+        if self.decoder.pending:
+            timers.append(self.last_byte + test_executor.serial_timeout)
+        return min(timers) if timers else None
+
+    ########
+    ## I/O ##
+    ########
+
+    def on_readable(self, now):
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.closed = True  # Port went away: the waits run into their deadlines
+            return
+        self.frames.extend(self.decoder.feed(data))
+        self.last_byte = now
+
+    def on_writable(self, now):
+        self._flush()
+
+    def _write(self, data):
+        self.outgoing += data
+        self._flush()
+
+    def _flush(self):
+        try:
+            while self.outgoing:
+                del self.outgoing[:os.write(self.fd, self.outgoing)]
+        except BlockingIOError:
+            pass  # UART buffer full: the reactor waits for room, see Reactor.watch()
+
+    def _reset_input(self):
+        self.frames.clear()
+        self.decoder.reset()
+        self.partial = None
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except OSError:
+            pass
+
+    def _line(self):
+        """Next non-blank frame as a string, None if none has come"""
+        while self.frames:
+            frame = self.frames.popleft()
+            if frame.binary or frame.payload.strip():
+                return bytes.decode(frame.raw.strip(), errors="ignore")
+        return None
+
+    def _message(self, now, expected):
+        """Next message as a string like Device.read_message, None if it is
+        not complete yet"""
+        candidates = expected_candidates(expected)
+        while self.frames:
+            frame = self.frames.popleft()
+            if not frame.binary and not frame.payload.strip():
+                continue
+            if self.partial is None:
+                if not frame.binary:
+                    return bytes.decode(frame.raw.strip(), errors="ignore")
+                self.partial = frame.raw
+            else:
+                self.partial += frame.raw if frame.binary else frame.raw.strip()
+            if not answers.expects_more(self.partial, candidates):
+                return self._complete(candidates)
+        if self.partial is not None and now >= self.deadline:
+            return self._complete(candidates)
+        return None
+
+    def _complete(self, candidates):
+        raw, self.partial = self.partial, None
+        return answers.binary_message(raw, candidates)
+
+    ###################
+    ## State machine ##
+    ###################
+
+    def advance(self, now):
+        """Run lines until one waits for the board"""
+        if self.decoder.pending and now - self.last_byte >= test_executor.serial_timeout:
+            self.frames.extend(self.decoder.flush())  # Unterminated text once the port stays quiet
+        while not self.done:
+            if self.waiting is not None:
+                if not self.waiting(now):
+                    return
+                self.waiting = None
+                self.deadline = None
+                continue
+            line_num, test_line = self.lines.popleft()
+            self._run_line(now, line_num, test_line)
+
+    def _wait(self, now, timeout, handler):
+        self.deadline = now + timeout
+        self.waiting = handler
+
+    def _result(self, **values):
+        self.device_result.update(values)
+        if self.device_result["Result"] != "Discard":
+            self.write_result(dict(self.device_result))
+
+    def _run_line(self, now, line_num, test_line):
+        action = test_line.split("]", 1)[1]
+        argument = action[1:].strip()
+        if action[0] == _declaration_:
+            self._identify(now)
+        elif action[0] in (_toDevice_, _toConsoleIgnore_):
+            self._command(now, argument, ignore=action[0] == _toConsoleIgnore_)
+        elif action[0] == _response_:
+            self._read_response(now)
+        elif action[0] == _returned_:
+            self._read_return_value(now, argument)
+        elif action[0] == _event_:
+            self._read_event(now, argument, line_num, test_line)
+        elif action[0] == _sendChar_:
+            self._send_string(now, argument)
+        else:
+            logging.warning(f"Unknown operation: {test_line.strip()}")
+
+    def _identify(self, now):
+        logging.info(f"DEVICE {self.id}, {self.port}")
+        self._reset_input()
+        self._write(str.encode("version" + end_string))
+
+        def read_lines(now):
+            line = self._line()
+            while line is not None:
+                answers.identify_line(self, line)
+                self.deadline = now + test_executor.serial_timeout  # Until the port goes quiet
+                line = self._line()
+            if now < self.deadline:
+                return False
+            self._result()
+            return True
+
+        self._wait(now, test_executor.serial_timeout, read_lines)
+
+    def _command(self, now, command, ignore=False):
+        def send(now):
+            if now < self.deadline:
+                return False
+            if not answers.skips_command(self, command):
+                self._reset_input()
+                logging.info(f"[{self.id}]>>{command}")
+                self._write(encode_line(command))
+                self.written_at = time.monotonic()
+                self.last_command = command
+                self._result(Command=command, Expected=None, Actual=None, Result="Discard")
+            if ignore:
+                self._wait(now, 2, drain)
+            return not ignore
+
+        def drain(now):
+            # Like Device.flush_buffer: let the answers come and drop them
+            if now < self.deadline:
+                return False
+            self._reset_input()
+            logging.info("-Flush buffer-")
+            self.mode = "-"
+            self.device_result["Mode"] = self.mode
+            self.write_result({"DeviceID": self.id, "Command": self.device_result["Command"], "Result": None})
+            return True
+
+        self._wait(now, self.guard, send)
+
+    def _answered(self):
+        if self.written_at is not None:
+            self.latencies.append(time.monotonic() - self.written_at)
+            self.written_at = None
+
+    def _read_response(self, now, expected_response="OK00>"):
+        if answers.skips_answer(self):
+            return
+
+        def read(now):
+            read_from_radio = self._line()
+            if read_from_radio is None:
+                if now < self.deadline:
+                    return False
+                read_from_radio = ""
+            self._answered()
+            # Failures are reported in the result rows only, not to pytest_check
+            answers.response_result(self, read_from_radio, expected_response, soft_check=False)
+            self._result()
+            return True
+
+        self._wait(now, test_executor.response_timeout, read)
+
+    def _read_return_value(self, now, return_value):
+        if answers.skips_answer(self):
+            return
+
+        def read(now):
+            read_from_radio = self._message(now, return_value)
+            if read_from_radio is None:
+                if now < self.deadline:
+                    return False
+                read_from_radio = ""
+            self._answered()
+            answers.return_value_result(self, read_from_radio, return_value, soft_check=False)
+            self._result()
+            return True
+
+        self._wait(now, test_executor.return_timeout, read)
+
+    def _read_event(self, now, event, line_num, test_line):
+        if answers.skips_event(self, event):
+            return
+        matcher = EventMatcher.of(event)
+        last = [Match(OTHER, None, "")]
+
+        def read(now):
+            message = self._message(now, matcher.expected)
+            while message is not None:
+                match = answers.event_match(self, matcher, message)
+                if match.kind in (EXPECTED, ERROR):
+                    return finish(match)
+                last[0] = match
+                message = self._message(now, matcher.expected)
+            if now >= self.deadline:
+                return finish(last[0])
+            return False
+
+        def finish(match):
+            answers.event_result(self, match, event, test_line, line_num + 1)
+            self._result()
+            return True
+
+        self._wait(now, test_executor.event_timeout, read)
+
+    def _send_string(self, now, string_to_send):
+        def read(now):
+            read_from_radio = self._line()
+            if read_from_radio is None:
+                if now < self.deadline:
+                    return False
+                read_from_radio = ""
+            if read_from_radio != _sendChar_:
+                result = "FAILED"
+                logging.info(f"\tFAILED : string send : Expected $; Rcvd << {read_from_radio}")
+            else:
+                self._reset_input()
+                result = "PASSED"
+                logging.info(f"[{self.id}]<<{read_from_radio}{string_to_send}")
+                self._write(str.encode(string_to_send + end_string))
+                self.transmit_strings.append(string_to_send)
+            self._result(Expected="$", Actual=read_from_radio, Result=result)
+            return True
+
+        self._wait(now, test_executor.response_timeout, read)
+
+    def close(self):
+        self.device.close()
+
+
+class Reactor(object):
+    """
+    Event loop over the ports of many ReactorDevices, on the calling thread.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()  # epoll on Linux
+        self.devices = []
+
+    def add(self, device):
+        self.selector.register(device.fd, selectors.EVENT_READ, device)
+        self.devices.append(device)
+
+    def remove(self, device):
+        self.selector.unregister(device.fd)
+        self.devices.remove(device)
+
+    def watch(self, device):
+        """Wait for room in the port of device too while it has bytes to write"""
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if device.outgoing else 0)
+        if not device.closed and self.selector.get_key(device.fd).events != events:
+            self.selector.modify(device.fd, events, device)
+
+    def run(self):
+        """Serve the devices until every one has run its lines"""
+        now = time.monotonic()
+        for device in self.devices:
+            device.advance(now)
+            self.watch(device)
+        while not all(device.done and (not device.outgoing or device.closed) for device in self.devices):
+            timers = [timer for timer in (device.next_timer() for device in self.devices) if timer is not None]
+            timeout = max(0, min(timers) - time.monotonic()) if timers else None
+            events = self.selector.select(timeout)
+            now = time.monotonic()
+            for key, mask in events:
+                if mask & selectors.EVENT_WRITE:
+                    key.data.on_writable(now)
+                if mask & selectors.EVENT_READ:
+                    key.data.on_readable(now)
+                if key.data.closed:
+                    self.selector.unregister(key.fd)
+            for device in self.devices:
+                if device.waiting is not None or device.lines:
+                    device.advance(now)
+                self.watch(device)
+
+    def close(self):
+        for device in list(self.devices):
+            if not device.closed:
+                self.remove(device)
+            device.close()
+        self.devices.clear()
+        self.selector.close()
+
+
+class ReactorFlowExecutor(FlowTestExecutor):
+    """
+    FlowTestExecutor running the lanes of all devices on one Reactor
+    instead of a thread each. Lines between barriers run at the same time,
+    declarations and interpreter commands on their own.
+    """
+
+    def __init__(self, name, directives, port_list, guard=None):
+        super().__init__(name, directives, port_list, concurrent=True)
+        self.guard = guard
+        self.reactor = Reactor()
+
+    def declare(self, device_id):
+        """New ReactorDevice on the next port of port_list, like TestDevices.newevk"""
+        test = self.test
+        if test.evknum >= len(test.port_list):
+            raise Exception(f"No serial ports available: evknum {test.evknum}, port_list {test.port_list}")
+        device = ReactorDevice(device_id, test.port_list[test.evknum], test.port_list[test.evkbnum], guard=self.guard)
+        test.evklist.append(device)
+        test.evknum += 2
+        test.evkbnum += 2
+        self.reactor.add(device)
+        return device
+
+    def run_lanes(self, result_writer):
+        for lanes in self.split_lanes(self.expand_repeats(self.directives)):
+            if None in lanes:
+                line_num, test_line = lanes[None][0]
+                device_id, _, action = test_line.partition("]")
+                if action[:1] != _declaration_:
+                    line_result = self.process_line(line_num + 1, test_line)
+                    if line_result and line_result.get("Result") != "Discard":
+                        result_writer.writerow(line_result)
+                    continue
+                device_id = device_id.split("[")[1]
+                logging.info("New device found:")
+                self.declare(device_id)
+                lanes = {device_id: lanes[None]}
+            for device_id, lane in lanes.items():
+                self.test.getdev(device_id).start(lane, result_writer.writerow)
+            self.reactor.run()
+
+    def run(self, directives=[]):
+        try:
+            super().run(directives)
+        finally:
+            self.reactor.close()
+
+    def latency_summary(self):
+        """p50/p99 (s) of the command to answer times over all devices"""
+        latencies = [latency for device in self.test.evklist for latency in device.latencies]
+        return {"answers": len(latencies), "p50": percentile(latencies, 50), "p99": percentile(latencies, 99)}
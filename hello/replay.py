@@ -0,0 +1,196 @@
+# Record and replay of serial sessions. RecordingPort wraps a port and
+# writes every chunk read from and written to it, with its time, to a JSON
+# lines transcript; ReplayPort plays a transcript back to a Device without
+# hardware, at full speed or with the recorded timing.
+#
+# Recording is switched on for all ports opened by Device (flows and the
+# pytest suites alike) with $HELLO_RECORD_DIR, or --record-dir in pytest.
+#
+# Transcript: a header {"port", "baud", "started"}, then one line per
+# chunk {"t": seconds since the start, "dir": "r" or "w", "data": hex}.
+
+import json
+import os
+import re
+import threading
+import time
+
+import serial
+
+from hello.transports import open_transport
+
+record_dir = os.environ.get("HELLO_RECORD_DIR")
+
+
+def open_port(port, baud, timeout):
+    """Transport for port, recorded when record_dir is set"""
+    device = open_transport(port, baud, timeout)
+    if not record_dir:
+        return device
+    os.makedirs(record_dir, exist_ok=True)
+    name = re.sub(r"\W+", "_", port).strip("_")
+    return RecordingPort(device, os.path.join(record_dir, f"{name}_{time.strftime('%Y-%m-%d_%H-%M-%S')}.jsonl"))
+
+
+class RecordingPort(object):
+    """
+    Port wrapper appending the traffic of port to a transcript at filepath.
+    Everything else is passed through to the port.
+    """
+
+    def __init__(self, port, filepath):
+        self.port = port
+        self.filepath = filepath
+        self.started = time.monotonic()
+        self.lock = threading.Lock()  # Reader thread and writers
+        if hasattr(port, "read_chunk"):
+            self.read_chunk = self._read_chunk
+        self.transcript = open(filepath, "w")
+        self.transcript.write(json.dumps({"port": getattr(port, "port", None),
+                                          "baud": getattr(port, "baudrate", None),
+                                          "started": time.time()}) + "\n")
+
+    def _record(self, direction, data):
+        if data:
+            line = json.dumps({"t": round(time.monotonic() - self.started, 6), "dir": direction,
+                               "data": bytes(data).hex()})
+            with self.lock:
+                if not self.transcript.closed:
+                    self.transcript.write(line + "\n")
+
+    def read(self, size=1):
+        data = self.port.read(size)
+        self._record("r", data)
+        return data
+
+    def _read_chunk(self):
+        data = self.port.read_chunk()
+        self._record("r", data)
+        return data
+
+    def write(self, data):
+        # Recorded first: the answer can be read before port.write() returns
+        self._record("w", data)
+        return self.port.write(data)
+
+    def fileno(self):
+        # No direct writes to the fd (e.g. os.writev) that would bypass the record
+        raise AttributeError("RecordingPort is written through write()")
+
+    def read_fileno(self):
+        """Descriptor to wait on for input (e.g. async_device), which is still
+        read through read()"""
+        return self.port.fileno()
+
+    def close(self):
+        self.port.close()
+        with self.lock:
+            self.transcript.close()
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+
+def load_transcript(filepath):
+    """(header, [(t, dir, bytes)]) of a transcript"""
+    with open(filepath) as transcript:
+        header = json.loads(transcript.readline())
+        chunks = [(entry["t"], entry["dir"], bytes.fromhex(entry["data"]))
+                  for entry in map(json.loads, transcript) if entry]
+    return header, chunks
+
+
+class ReplayPort(object):
+    """
+    Port playing a transcript back. The bytes read after a write in the
+    recording become readable once as many bytes have been written here,
+    so the answers keep their place in the conversation even if the writes
+    are split or coalesced differently. With timing they also keep their
+    recorded delay after that write; otherwise they come at once.
+    What is written is kept in `written`, for comparison with the recording.
+    """
+
+    def __init__(self, filepath, timing=False, timeout=0.2):
+        self.header, chunks = load_transcript(filepath)
+        self.port = self.header.get("port")
+        self.timing = timing
+        self.timeout = timeout
+        # (bytes written before, time of that write, [(time, bytes read)])
+        self.reads = [(0, 0.0, [])]
+        total = 0
+        for t, direction, data in chunks:
+            if direction == "w":
+                total += len(data)
+                self.reads.append((total, t, []))
+            else:
+                self.reads[-1][2].append((t, data))
+        self.released = 0  # Groups of reads released so far
+        self.written = bytearray()
+        self.pending = []  # (due time, data) released but not due yet
+        self.buffer = bytearray()
+        self.is_open = True
+        self.cond = threading.Condition()
+        self._release()
+
+    def _release(self):
+        now = time.monotonic()
+        while self.released < len(self.reads) and self.reads[self.released][0] <= len(self.written):
+            _, written_at, reads = self.reads[self.released]
+            self.pending += [(now + (t - written_at if self.timing else 0), data) for t, data in reads]
+            self.released += 1
+        self.pending.sort(key=lambda item: item[0])
+
+    def _move_due(self):
+        now = time.monotonic()
+        while self.pending and self.pending[0][0] <= now:
+            self.buffer += self.pending.pop(0)[1]
+
+    @property
+    def finished(self):
+        """True when everything recorded has been read"""
+        with self.cond:
+            self._move_due()
+            return self.released == len(self.reads) and not self.pending and not self.buffer
+
+    @property
+    def in_waiting(self):
+        with self.cond:
+            self._move_due()
+            return len(self.buffer)
+
+    def read(self, size=1):
+        deadline = time.monotonic() + (self.timeout or 0)
+        with self.cond:
+            while True:
+                if not self.is_open:
+                    raise serial.SerialException("Replay port closed")
+                self._move_due()
+                remaining = deadline - time.monotonic()
+                if self.buffer or remaining <= 0:
+                    break
+                if self.pending:
+                    remaining = min(remaining, self.pending[0][0] - time.monotonic())
+                self.cond.wait(max(0, remaining))
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            return data
+
+    def write(self, data):
+        with self.cond:
+            self.written += data
+            self._release()
+            self.cond.notify_all()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        with self.cond:
+            self._move_due()
+            self.buffer.clear()
+
+    def close(self):
+        with self.cond:
+            self.is_open = False
+            self.cond.notify_all()
@@ -0,0 +1,64 @@
+# Shadow of the settable parameters of a board: the last value each set
+# command (Cmd.parameter) was confirmed with. Device elides a set command
+# whose value the board already has, so tests that share a setup on a
+# pooled device do not provision it again.
+#
+# A parameter is only known once its set command has been answered with a
+# pass; it is unknown from the moment it is sent, so the sets of a pipeline
+# are not compared with a value that is about to change. Reset and the
+# parser switch (Cmd.invalidates) forget everything, a command selecting a
+# different stack (Cmd.selects_stack) forgets the parameters.
+#
+# Switched off with $HELLO_SHADOW=0, or --no-shadow in pytest.
+
+import logging
+import os
+
+enabled = os.environ.get("HELLO_SHADOW", "1") != "0"
+
+
+class StateShadow(object):
+    """
+    Parameters of one board, {parameter: value}, and the stack they
+    belong to.
+    """
+
+    def __init__(self):
+        self.enabled = enabled
+        self.values = {}
+        self.stack = None
+        self.elided = 0  # Set commands not sent
+
+    def redundant(self, command):
+        """True if command sets a parameter to the value it has already"""
+        if not self.enabled or command.parameter is None:
+            return False
+        known = self.values.get(command.parameter)
+        if known is None or known != command.shadow_value():
+            return False
+        self.elided += 1
+        return True
+
+    def sending(self, command):
+        """Forget what command may change, before it is written"""
+        if command.invalidates:
+            self.invalidate(type(command).__name__)
+        elif command.selects_stack is not None:
+            if command.selects_stack != self.stack:
+                self.invalidate(f"stack {command.selects_stack}")
+            self.stack = None  # Known again once the stack is confirmed
+        elif command.parameter is not None:
+            self.values.pop(command.parameter, None)
+
+    def confirm(self, command):
+        """Remember the value set by command, answered with a pass"""
+        if command.selects_stack is not None:
+            self.stack = command.selects_stack
+        if command.parameter is not None:
+            self.values[command.parameter] = command.shadow_value()
+
+    def invalidate(self, reason):
+        if self.values or self.stack is not None:
+            logging.info(f"Shadow invalidated: {reason}")
+        self.values.clear()
+        self.stack = None
@@ -0,0 +1,414 @@
+# Simulated EVK behind a pseudo-terminal, for running Device and
+# FlowTestExecutor without hardware. The command set is taken from the
+# Cmd subclasses and COMMAND_MAP in hello.commands.
+
+import heapq
+import inspect
+import os
+import random
+import select
+import socket
+import threading
+import time
+import tty
+
+from hello import commands
+from hello.commands import COMMAND_MAP, RESPONSE_MAP, BINARY_START, BINARY_END, END_STRING, Cmd
+from hello.frames import ESC, RESPONSE_START, STATUS, EVENT_START, EVENT_END
+
+
+# Settable parameters: set command -> parameter, get command -> parameter
+SETTERS = {
+    "sevent": "event",
+    "sconfirm": "confirm",
+    "sappeui": "appeui",
+    "sappkey": "appkey",
+    "sappskey": "appskey",
+    "snwkskey": "nwkskey",
+    "sdevaddr": "devaddr",
+    "sotaa": "otaa",
+}
+GETTERS = {
+    "gevent": "event",
+    "confirm": "confirm",
+    "gappeui": "appeui",
+    "gappkey": "appkey",
+    "gappskey": "appskey",
+    "gnwkskey": "nwkskey",
+    "gdevaddr": "devaddr",
+    "gotaa": "otaa",
+}
+FLAGS = ("event", "confirm", "otaa")  # One byte parameters
+
+OK = "OK00>"
+ERROR_CODES = {
+    "ERFE>": 0xFE,  # Invalid command
+    "ERFD>": 0xFD,  # Empty token
+    "ERFC>": 0xFC,  # Malformed token
+    "ERFB>": 0xFB,  # Parser timeout
+    "ERFA>": 0xFA,  # Modem busy
+    "ERF9>": 0xF9,  # Not enough arguments
+    "ERF8>": 0xF8,  # Arguments out of bounds
+    "ERF7>": 0xF7,  # Modem unable to execute command
+}
+
+EVENT_JOINING = "Joining the LoRaWAN network..."
+EVENT_JOINED = "Joined network"
+EVENT_ABP = "Device set by ABP"
+EVENT_CONFIRMED = "Confirmed message transmitted"
+EVENT_TRANSMITTED = "Message transmitted"
+
+
+def _command_tables():
+    """Command names of the ascii and AT parsers, and binary command codes,
+    each mapped to the lower case ascii name"""
+    ascii_names, at_names, binary_codes = {"version": "version"}, {}, {}
+    for name, entry in COMMAND_MAP.items():
+        if name:
+            ascii_names[entry["ascii"].lower()] = name.lower()
+            at_names[entry["at"]] = name.lower()
+            binary_codes[entry["binary"][0]] = name.lower()
+    for _, cls in inspect.getmembers(commands, inspect.isclass):
+        if issubclass(cls, Cmd) and isinstance(cls.__dict__.get("ascii"), str) and cls.ascii.strip():
+            name = cls.ascii.strip().lower()
+            ascii_names[name] = name
+            at_names[cls.at.strip()] = name
+            if cls.binary:
+                binary_codes[cls.binary[0]] = name
+    return ascii_names, at_names, binary_codes
+
+
+ASCII_NAMES, AT_NAMES, BINARY_CODES = _command_tables()
+
+
+class DeviceSimulator(threading.Thread):
+    """
+    EVK simulator serving the device side of a pty.
+    Open `port` like a serial port. latency and jitter delay every answer
+    (seconds), error_rate is the chance that a command is refused with
+    one of error_codes.
+    """
+
+    def __init__(self, mode="ascii", latency=0.0, jitter=0.0, error_rate=0.0, error_codes=("ERFA>",),
+                 join_delay=0.05, tx_delay=0.05, devid="97 4F 2F 6C E9 02 BE 77", seed=None):
+        super().__init__(daemon=True)
+        self.initial_mode = mode
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_codes = error_codes
+        self.join_delay = join_delay
+        self.tx_delay = tx_delay
+        self.devid = bytes.fromhex(devid)
+        self.random = random.Random(seed)
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        self.outgoing = []  # Heap of (due time, sequence, bytes)
+        self.sequence = 0
+        self.last_answer = 0
+        self.received = []  # Commands as (mode, name, args), for inspection
+        self.running = True
+        self.reset()
+        self.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def reset(self):
+        """Power-on state"""
+        self.mode = self.initial_mode
+        self.stack = "none"
+        self.params = {"event": b"\x01", "confirm": b"\x00", "otaa": b"\x01"}
+        self.joined = False
+        self.payload_length = None  # Set while waiting for the string of sendb
+        self.buffer = bytearray()
+
+    def close(self):
+        self.running = False
+        if self is not threading.current_thread():
+            self.join(1)
+        os.close(self.master)
+        os.close(self.slave)
+
+    ##############
+    ## I/O loop ##
+    ##############
+
+    def run(self):
+        while self.running:
+            timeout = 0.05
+            if self.outgoing:
+                timeout = max(0, min(timeout, self.outgoing[0][0] - time.monotonic()))
+            readable, _, _ = select.select([self.master], [], [], timeout)
+            if readable:
+                try:
+                    data = os.read(self.master, 4096)
+                except OSError:
+                    data = b""
+                if data:
+                    self.buffer += data
+                    self._parse()
+            now = time.monotonic()
+            while self.outgoing and self.outgoing[0][0] <= now:
+                try:
+                    os.write(self.master, heapq.heappop(self.outgoing)[2])
+                except OSError:
+                    pass
+
+    def _schedule(self, data, delay=0.0):
+        heapq.heappush(self.outgoing, (time.monotonic() + delay, self.sequence, data))
+        self.sequence += 1
+
+    def _answer(self, data):
+        """Queue an answer after the configured latency, keeping answers in order"""
+        due = time.monotonic() + self.latency + self.random.uniform(0, self.jitter)
+        self.last_answer = max(due, self.last_answer)
+        heapq.heappush(self.outgoing, (self.last_answer, self.sequence, data))
+        self.sequence += 1
+
+    def _parse(self):
+        while self.buffer:
+            if self.mode == "binary":
+                start = self.buffer.find(BINARY_START)
+                if start == -1:
+                    # Keep a trailing escape that may start the next command
+                    del self.buffer[:-1 if self.buffer.endswith(bytes((ESC,))) else len(self.buffer)]
+                    return
+                end = self.buffer.find(BINARY_END, start + 2)
+                if end == -1:
+                    del self.buffer[:start]
+                    return
+                body = bytes(self.buffer[start + 2:end])
+                del self.buffer[:end + 2]
+                self._binary_command(body)
+            else:
+                end = self.buffer.find(b"\n")
+                if end == -1:
+                    return
+                line = bytes.decode(bytes(self.buffer[:end]), errors="ignore").strip()
+                del self.buffer[:end + 1]
+                self._text_command(line)
+
+    ###################
+    ## Text parsers  ##
+    ###################
+
+    def _text(self, *lines):
+        return "".join(line + END_STRING for line in lines).encode()
+
+    def _text_command(self, line):
+        if self.payload_length is not None:
+            self.payload_length = None
+            self.received.append((self.mode, "sendb string", line))
+            self._answer(self._text(OK))
+            self._transmitted()
+            return
+        if line == "":
+            self._answer(self._text(OK))  # Wake up
+            return
+        name, _, args = line.partition(" ")
+        command = AT_NAMES.get(name) or ASCII_NAMES.get(name.lower())
+        self.received.append((self.mode, command or name, args))
+        if command is None:
+            self._answer(self._text("ERFE>"))
+            return
+        if self._refused():
+            return
+        if command == "version":
+            self._answer(self._text("IDN: AM093 simulator", "EXECUTIVE VER: 1.0.0", "RF STACK  VER: 1.0.0"))
+        elif command in SETTERS:
+            self._store(SETTERS[command], bytes.fromhex("".join(args.split()))
+                        if SETTERS[command] not in FLAGS else bytes((int(args or "0", 16),)))
+            self._answer(self._text(OK))
+        elif command in GETTERS:
+            self._answer(self._text(self._format(GETTERS[command]), OK))
+        elif command == "sendb":
+            self.payload_length = int(args or "0", 16)
+            self._answer(b"$")
+        elif command == "sparser":
+            self._answer(self._text(OK))
+            self.mode = "binary"
+        elif command == "lwjoin":
+            self._join()
+        else:
+            answer = self._common(command)
+            self._answer(self._text(*([answer, OK] if answer is not None else [OK])))
+
+    def _format(self, param):
+        value = self.params.get(param, b"")
+        if param in FLAGS:
+            return f"{value[0]:02X}"
+        if param == "devaddr":
+            return f"{int.from_bytes(value, 'big'):X}"
+        return " ".join(f"{byte:02X}" for byte in value)
+
+    ###################
+    ## Binary parser ##
+    ###################
+
+    def _binary(self, payload=b"", status=0x01):
+        return bytes((ESC, RESPONSE_START)) + payload + bytes((ESC, STATUS, status))
+
+    @staticmethod
+    def _binary_event(text):
+        return bytes((ESC, EVENT_START)) + text.encode() + bytes((ESC, EVENT_END))
+
+    def _binary_command(self, body):
+        command = BINARY_CODES.get(body[0]) if body else None
+        args = body[1:]
+        self.received.append((self.mode, command, args))
+        if command is None:
+            self._answer(self._binary(status=0xFE))
+            return
+        if self._refused():
+            return
+        if command in SETTERS:
+            self._store(SETTERS[command], args)
+            self._answer(self._binary())
+        elif command in GETTERS:
+            self._answer(self._binary(self.params.get(GETTERS[command], b"")))
+        elif command == "sendb":
+            self._answer(self._binary())
+            self._transmitted()
+        elif command == "sparser":
+            self._answer(self._binary())
+            self.mode = "ascii"
+        elif command == "stack":
+            self._answer(self._binary(bytes.fromhex(RESPONSE_MAP["stack"][self.stack])))
+        elif command == "devid":
+            self._answer(self._binary(self.devid))
+        elif command == "lwstatus":
+            self._answer(self._binary(b"\x01" if self.joined else b"\x00"))
+        elif command == "lwjoin":
+            self._join()
+        else:
+            self._common(command)
+            self._answer(self._binary())
+
+    ############
+    ## Shared ##
+    ############
+
+    def _refused(self):
+        if self.error_rate and self.random.random() < self.error_rate:
+            code = self.random.choice(self.error_codes)
+            self._answer(self._binary(status=ERROR_CODES[code]) if self.mode == "binary" else self._text(code))
+            return True
+        return False
+
+    def _store(self, param, value):
+        self.params[param] = value
+        if param in ("otaa", "appeui", "appkey", "appskey", "nwkskey", "devaddr"):
+            self.joined = False
+
+    def _common(self, command):
+        """Commands answered the same way by the text parsers, returns the
+        value line (None when there is none)"""
+        if command == "ping":
+            return "PONG!"
+        if command == "lorawan":
+            self.stack = "lorawan"
+        elif command == "stack":
+            return self.stack
+        elif command == "devid":
+            return " ".join(f"{byte:02X}" for byte in self.devid)
+        elif command == "lwstatus":
+            return "01" if self.joined else "00"
+        elif command == "reset":
+            self.reset()
+        return None
+
+    def _event(self, text, delay):
+        if self.params.get("event") == b"\x00":
+            return
+        data = self._binary_event(text) if self.mode == "binary" else self._text("EVENT " + text)
+        self._schedule(data, max(delay, self.last_answer - time.monotonic()))
+
+    def _join(self):
+        """lwjoin: OTAA joins after join_delay, ABP is set up at once"""
+        if self.mode == "binary":
+            # The response and the first event arrive as one burst
+            self._answer(self._binary() + self._binary_event(EVENT_JOINING))
+        else:
+            self._answer(self._text(OK))
+            self._event(EVENT_JOINING, 0)
+        self.joined = True
+        if self.params.get("otaa") == b"\x00":
+            self._event(EVENT_ABP, 0)
+        else:
+            self._event(EVENT_JOINED, self.join_delay)
+
+    def _transmitted(self):
+        confirmed = self.params.get("confirm") == b"\x01"
+        self._event(EVENT_CONFIRMED if confirmed else EVENT_TRANSMITTED, self.tx_delay)
+
+
+class TcpBridge(threading.Thread):
+    """
+    ser2net stand-in: serves the tty at path (e.g. a DeviceSimulator port)
+    on a local TCP port, to one client at a time. Open `url` with
+    transports.TcpTransport. Output of the tty while no client is
+    connected is dropped, like ser2net does.
+    """
+
+    def __init__(self, path, host="127.0.0.1"):
+        super().__init__(daemon=True)
+        self.fd = os.open(path, os.O_RDWR | os.O_NOCTTY)
+        tty.setraw(self.fd)
+        self.listener = socket.create_server((host, 0))
+        self.url = f"socket://{host}:{self.listener.getsockname()[1]}"
+        self.client = None
+        self.running = True
+        self.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.running = False
+        if self is not threading.current_thread():
+            self.join(1)
+        if self.client is not None:
+            self.client.close()
+        self.listener.close()
+        os.close(self.fd)
+
+    def run(self):
+        while self.running:
+            sources = [self.listener, self.fd] + ([self.client] if self.client is not None else [])
+            readable, _, _ = select.select(sources, [], [], 0.05)
+            if self.listener in readable:
+                if self.client is not None:
+                    self.client.close()
+                self.client, _ = self.listener.accept()
+                self.client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.fd in readable:
+                try:
+                    data = os.read(self.fd, 4096)
+                except OSError:
+                    data = b""
+                if data and self.client is not None:
+                    try:
+                        self.client.sendall(data)
+                    except OSError:
+                        self.client.close()
+                        self.client = None
+            if self.client is not None and self.client in readable:
+                try:
+                    data = self.client.recv(4096)
+                except OSError:
+                    data = b""
+                if data:
+                    os.write(self.fd, data)
+                else:
+                    self.client.close()
+                    self.client = None
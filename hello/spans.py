@@ -0,0 +1,95 @@
+# Per-command timing spans. Each command sent by a Device gets a span with
+# the time it was issued, written, the first byte and the completion of its
+# response and any events read after it. Spans are exported as JSON lines
+# next to the results CSV, e.g. Results.csv -> Results_spans.jsonl
+#
+# All times in the export are milliseconds after "issued"; the gap between
+# "issued" and "write" is the harness waiting before it writes.
+
+import json
+import os
+import threading
+import time
+
+_write_lock = threading.Lock()  # Devices may share a results file
+_started = set()  # Spans files truncated in this session
+
+
+def spans_filepath(results_filepath):
+    return os.path.splitext(results_filepath)[0] + "_spans.jsonl"
+
+
+class Span(object):
+    """Timestamps (time.monotonic) of one command"""
+
+    def __init__(self, device_id, command, mode):
+        self.device_id = device_id
+        self.command = command
+        self.mode = mode
+        self.wall = time.time()
+        self.issued = time.monotonic()
+        self.write = None
+        self.first_byte = None
+        self.response = None
+        self.events = []
+
+    def mark_write(self):
+        self.write = time.monotonic()
+
+    def mark_first_byte(self, timestamp):
+        """Arrival of the first byte of the first frame read for the command"""
+        if self.first_byte is None and timestamp is not None:
+            self.first_byte = timestamp
+
+    def mark_response(self):
+        self.response = time.monotonic()
+
+    def mark_event(self):
+        self.events.append(time.monotonic())
+
+    def _ms(self, timestamp):
+        return None if timestamp is None else round((timestamp - self.issued) * 1000, 3)
+
+    def as_dict(self):
+        return {
+            "device": self.device_id,
+            "command": self.command,
+            "mode": self.mode,
+            "wall": self.wall,
+            "write": self._ms(self.write),
+            "first_byte": self._ms(self.first_byte),
+            "response": self._ms(self.response),
+            "events": [self._ms(event) for event in self.events],
+        }
+
+
+class SpanRecorder(object):
+    """
+    Collects the spans of one device and appends them to filepath.
+    Spans stay open while responses or events may still be read for them,
+    and are written when the next command that is not pipelined starts.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.open_spans = []
+        with _write_lock:
+            if filepath not in _started:
+                _started.add(filepath)
+                with open(self.filepath, mode="w"):
+                    pass
+
+    def begin(self, device_id, command, mode, pipelined=False):
+        if not pipelined:
+            self.flush()
+        span = Span(device_id, command, mode)
+        self.open_spans.append(span)
+        return span
+
+    def flush(self):
+        if not self.open_spans:
+            return
+        lines = "".join(json.dumps(span.as_dict()) + "\n" for span in self.open_spans)
+        self.open_spans.clear()
+        with _write_lock, open(self.filepath, mode="a") as spans_file:
+            spans_file.write(lines)
@@ -3,17 +3,29 @@
 # connected devices and the serial ports of the devices.
 
 import logging
+import os
 import time
 import sys
 import csv
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import serial
 import pytest
-import pytest_check as check
 #import allure
 
 #from tests.lora_commands.commands import Bandwidth, CodingRate, SpreadingFactor
-from hello.commands import Cmd, CmdRtrn, SendBytes
+from hello.commands import CmdRtrn, Codec, SendBytes, WakeUp, encode_line
+from hello.frames import FrameDecoder, expected_candidates
+from hello import answers
+from hello.spans import SpanRecorder, spans_filepath
+from hello.timeouts import TimeoutModel
+from hello.identity import identity_cache
+from hello.shadow import StateShadow
+from hello.parser_mode import parser_modes, parser_mismatch
+from hello.replay import open_port
+from hello.matcher import EventMatcher, Match, EXPECTED, ERROR, OTHER
 
 ######################
 ## GLOBAL VARIABLES ##
@@ -35,6 +47,19 @@ end_string = "\r\n"
 # Serial time out for the AM093 boards
 serial_timeout = 0.2  # 0.1 timeout will lose some packages
 
+# Read deadlines, equal to the old polling budgets (wait count * serial_timeout)
+response_timeout = 60 * serial_timeout
+return_timeout = 25 * serial_timeout
+event_timeout = 120 * serial_timeout
+# Deadlines learned per (port, command, mode, read kind), the budgets above
+# apply until a key has enough samples. Shared by all devices of a session
+timeout_model = TimeoutModel()
+
+# Results files started in this session; each gets its header once, even
+# when several devices or leases of a pooled device write to it
+results_files = set()
+results_files_lock = threading.Lock()
+
 # Special characters and strings
 _comment_ = "//"
 _printOutput_ = "!!"
@@ -48,6 +73,7 @@ _returned_ = "#"
 _sendChar_ = "$"
 _repeat_ = "@R"
 _end_ = "@E"
+_barrier_ = "@B"  # Concurrent runs: wait until every device lane gets here
 
 # # Device response codes:
 # responseCodes = (
@@ -79,22 +105,147 @@ interp_command_pause = "PAUSE"
 interp_command_pause1 = "PAUSE1"
 
 
+class SerialReader(threading.Thread):
+    """
+    Background reader that drains a port into a queue of complete frames:
+    text lines and ESC-delimited binary frames.
+    last_start is the arrival time of the first byte of the frame returned
+    by the last get().
+    """
+
+    def __init__(self, port):
+        super().__init__(daemon=True)
+        self.port = port
+        self.frames = deque()  # (frame, arrival time of its first byte)
+        self.frame_start = None
+        self.last_start = None
+        self.cond = threading.Condition()
+        self.decoder = FrameDecoder()
+        self.running = True
+        self.start()
+
+    def run(self):
+        read_chunk = getattr(self.port, "read_chunk", None)  # One read per burst, see hello.transports
+        while self.running:
+            try:
+                data = read_chunk() if read_chunk is not None else self.port.read(self.port.in_waiting or 1)
+            except (serial.SerialException, OSError, TypeError, AttributeError):
+                break  # Port closed under us
+            now = time.monotonic()
+            with self.cond:
+                if data:
+                    if not self.decoder.pending:
+                        self.frame_start = now
+                    frames = self.decoder.feed(data)
+                else:
+                    # Nothing arrived within the port timeout: hand out the
+                    # partial line, like readline() does when it times out
+                    frames = self.decoder.flush()
+                if frames:
+                    # Frames after the first one in a chunk started in it
+                    self.frames.append((frames[0], self.frame_start))
+                    self.frames.extend((frame, now) for frame in frames[1:])
+                    self.cond.notify_all()
+                if frames and self.decoder.pending:
+                    self.frame_start = now
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+    def get(self, timeout):
+        """Next frame, or None if nothing arrives before the timeout"""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while not self.frames:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.running:
+                    return None
+                self.cond.wait(remaining)
+            frame, self.last_start = self.frames.popleft()
+            return frame
+
+    def clear(self):
+        """Drop everything read so far"""
+        with self.cond:
+            self.frames.clear()
+            self.decoder.reset()
+            self.frame_start = None
+
+    def stop(self):
+        self.running = False
+        if self is not threading.current_thread():
+            self.join(2 * serial_timeout)
+
+
+class WriteQueue(object):
+    """
+    Data waiting to be written to a port. flush() hands all of it to the
+    port in one scatter-gather write, so a burst of pipelined commands
+    reaches the UART as one stream instead of one USB transfer per command.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.buffers = []
+        self.spans = []  # Spans of the queued commands, marked when written
+
+    def put(self, data, span=None):
+        self.buffers.append(data)
+        if span is not None:
+            self.spans.append(span)
+
+    def flush(self, chunk_size=None):
+        """Write everything queued; with chunk_size, in chunks that each
+        drain to the port (tcdrain) before the next, so large payloads keep
+        pace with the UART and its flow control instead of filling buffers"""
+        if not self.buffers:
+            return
+        buffers, spans = self.buffers, self.spans
+        self.buffers, self.spans = [], []
+        for span in spans:
+            span.mark_write()
+        if chunk_size:
+            data = memoryview(b"".join(buffers))
+            for start in range(0, len(data), chunk_size):
+                self.port.write(data[start:start + chunk_size])
+                self.port.flush()
+            return
+        written = 0
+        if hasattr(os, "writev") and len(buffers) > 1:
+            try:
+                written = os.writev(self.port.fileno(), buffers)
+            except (AttributeError, BlockingIOError, OSError, ValueError):
+                written = 0  # No fd, or it is full: the port writes (and waits)
+        data = b"".join(buffers)
+        if written < len(data):
+            self.port.write(data[written:])
+
+
 class Device(object):
     """
     Single test device class and its methods.
     """
 
-    def __init__(self, newid, newport, newbaud, results_filepath="Results.csv"):
-        """Properties of the device"""
+    def __init__(self, newid, newport, newbaud, results_filepath="Results.csv", mode=None, timeouts=None,
+                 transport=None):
+        """Properties of the device
+        transport is an open port object to use instead of opening newport,
+        e.g. a transports.MemoryTransport or a replay.ReplayPort"""
         self.devtype = "Unknown"
         self.stackversion = None
         self.execversion = None
         self.id = newid
         self.port = newport
         self.baud = newbaud
-        self.device = serial.Serial(newport, newbaud, timeout=serial_timeout)
+        self.device = transport if transport is not None else open_port(newport, newbaud, serial_timeout)
+        self.reader = SerialReader(self.device)
+        self.writes = WriteQueue(self.device)
+        self.timeouts = timeouts if timeouts is not None else timeout_model
+        self.identities = identity_cache  # Version lines of the boards seen before
         self.tfailed = []  # List with failed test lines
         self.joined = False  # Store whether the device has joined a LoRaWAN network
+        self.codec = Codec(mode)  # Parser mode of this device, encodes the Cmd objects
+        self.shadow = StateShadow()  # Parameters confirmed by the board, see send_receive()
         self.last_command = None
         self.read_strings = []
         self.rssi_list = []
@@ -112,53 +263,157 @@ class Device(object):
             "Expected": None,
             "Result": None,
         }
+        self.fieldnames = ['DeviceID', 'DeviceType', 'ExecVersion', 'StackVersion', 'Mode', 'Command', 'Actual',
+                           'Expected', 'Result']
+        self.spans = None  # Timing of each command
+        self.span = None  # Span of the command whose answers are being read
+        self.retarget(results_filepath)
+
+    def retarget(self, results_filepath):
+        """Write the results (and spans) of the following commands to
+        results_filepath; the header is written the first time it is used"""
+        if self.spans is not None:
+            self.spans.flush()
         self.results_filepath = results_filepath
-        with open(self.results_filepath, mode="w", newline="") as result_file:
-            self.fieldnames = ['DeviceID', 'DeviceType', 'ExecVersion', 'StackVersion', 'Mode', 'Command', 'Actual',
-                               'Expected', 'Result']
-            self.result_writer = csv.DictWriter(result_file, fieldnames=self.fieldnames, restval='',
-                                                extrasaction='ignore')
-            self.result_writer.writeheader()
+        self.spans = SpanRecorder(spans_filepath(results_filepath))
+        with results_files_lock:
+            if results_filepath in results_files:
+                return
+            results_files.add(results_filepath)
+            with open(self.results_filepath, mode="w", newline="") as result_file:
+                csv.DictWriter(result_file, fieldnames=self.fieldnames, restval='',
+                               extrasaction='ignore').writeheader()
+
+    def read_frame(self, timeout):
+        """Next frame that is not a blank line, or None on timeout"""
+        self.writes.flush()  # Commands still queued are answered first
+        deadline = time.monotonic() + timeout
+        while True:
+            frame = self.reader.get(max(0, deadline - time.monotonic()))
+            if frame is None or frame.binary or frame.payload.strip():
+                if frame is not None and self.span is not None:
+                    self.span.mark_first_byte(self.reader.last_start)
+                return frame
+
+    def readline(self, timeout):
+        """Next non-blank line from the reader, stripped, or b"" on timeout"""
+        frame = self.read_frame(timeout)
+        return frame.raw.strip() if frame else b""
+
+    def read_message(self, expected, timeout):
+        """Next message as a string: text lines decoded, binary frames in hex.
+        Binary frames are collected until they cover the expected value, which
+        may span several frames (e.g. a response followed by an event).
+        expected may be a tuple of values, any of which may be coming"""
+        deadline = time.monotonic() + timeout
+        frame = self.read_frame(timeout)
+        if frame is None:
+            return ""
+        if not frame.binary:
+            return bytes.decode(frame.raw.strip(), errors="ignore")
+        raw = frame.raw
+        candidates = expected_candidates(expected)
+        while answers.expects_more(raw, candidates):
+            frame = self.read_frame(max(0, deadline - time.monotonic()))
+            if frame is None:
+                break
+            raw += frame.raw if frame.binary else frame.raw.strip()
+        return answers.binary_message(raw, candidates)
+
+    def _latency_key(self, kind):
+        """Timeout model key of a read for the last command"""
+        parts = (self.last_command or "").split()
+        if self.codec.mode == "binary" and len(parts) > 2:
+            name = parts[2]  # Command code after the 0x1B 0x2A start
+        else:
+            name = parts[0].lower() if parts else ""
+        return (self.port, name, self.codec.mode, kind)
+
+    def _timed_read(self, kind, default, read, timeout=None):
+        """read(timeout) with the learned deadline, recording the latency
+        of the answer, or how long the read waited in vain. An explicit
+        timeout is used as it is, and the read is not recorded"""
+        if timeout is not None:
+            return read(timeout)
+        key = self._latency_key(kind)
+        started = time.monotonic()
+        message = read(self.timeouts.deadline(key, default))
+        if message:
+            self._observe(key, started)
+        else:
+            self.timeouts.miss(key, time.monotonic() - started)
+        return message
+
+    def _observe(self, key, started):
+        """Record the latency of the frame read last, by a read that started
+        at started: from the write of its command (the start of the read
+        when that is unknown) to its arrival. Answers that were in before
+        their read started, pipelined or buffered, count from the write
+        too, not as the near-zero wait of their read"""
+        span = self.span
+        sent = span.write if span is not None and span.write is not None else started
+        arrived = self.reader.last_start if self.reader.last_start is not None else time.monotonic()
+        if arrived >= sent:
+            self.timeouts.observe(key, arrived - sent)
+
+    def reset_input_buffer(self):
+        """Discard unread input, both in the port and in the reader queue"""
+        self.device.reset_input_buffer()
+        self.reader.clear()
 
     #@allure.tag("version")
-    def identify(self):
-        """Get the details of the device connected to the port"""
+    def identify(self, refresh=False):
+        """Get the details of the device connected to the port
+        A board in the identity cache, found by its USB serial number, is not
+        queried; otherwise (or with refresh) the version lines are read until
+        the port goes quiet and cached when the board has a serial number"""
         logging.info("DEVICE " + self.id + ", " + self.port)
-        self.device.reset_input_buffer()
-        self.device.write(str.encode("version" + end_string))
-        time.sleep(serial_timeout)
-        while self.device.in_waiting > 0:
-            read_from_radio = bytes.decode(self.device.readline().strip())
-            if read_from_radio.find("IDN: ") != -1:
-                self.devtype = read_from_radio.split("IDN: ")[1]
-                logging.info(read_from_radio)
-                self.device_result.update(DeviceType=self.devtype)
-            elif read_from_radio.find("EXECUTIVE VER:") != -1:
-                self.execversion = read_from_radio.split("EXECUTIVE VER:")[1]
-                logging.info(read_from_radio)
-                self.device_result.update(ExecVersion=self.execversion)
-            elif read_from_radio.find("RF STACK  VER:") != -1:
-                self.stackversion = read_from_radio.split("RF STACK  VER:")[1]
-                logging.info(read_from_radio)
-                self.device_result.update(StackVersion=self.stackversion)
+        key = self.identities.key(self.port)
+        lines = self.identities.get(key) if key is not None and not refresh else None
+        if lines is not None:
+            logging.info("Identity from cache")
+        else:
+            self.reset_input_buffer()
+            self.device.write(str.encode("version" + end_string))
+            lines = []
+            while True:
+                read_from_radio = bytes.decode(self.readline(serial_timeout))
+                if read_from_radio == "":
+                    break
+                lines.append(read_from_radio)
+            if lines and key is not None:
+                self.identities.put(key, lines)
+
+        for read_from_radio in lines:
+            answers.identify_line(self, read_from_radio)
 
         print(" ")
         return self.device_result
 
     #@allure.tag("sending commands")
-    def send_command(self, command):
-        """Send the command to the device (>)"""
-        time.sleep(serial_timeout)
-        if self.joined and command in ["lwjoin", "lwstatus"]:
+    def send_command(self, command, pipelined=False, wire=None, queued=False, shadowed=False):
+        """Send the command to the device (>)
+        A pipelined command follows other commands whose responses are still
+        unread, so it neither waits nor discards the input.
+        wire is the encoded command when the caller has it already.
+        A queued command is written with the next ones, at the latest when
+        the first answer is read.
+        The shadow is dropped unless the command is accounted for in it
+        (shadowed): a command given as text may change anything"""
+        if not shadowed:
+            self.shadow.invalidate(f"command {command.strip()}")
+        self.span = self.spans.begin(self.id, command, self.codec.mode, pipelined=pipelined)
+        if not pipelined:
+            time.sleep(serial_timeout)
+        if answers.skips_command(self, command):
             pass
         else:
-            self.device.reset_input_buffer()
+            if not pipelined:
+                self.reset_input_buffer()
             logging.info(f"[{self.id}]>>{command}")
-            if command[0:2] != "0x":
-                self.device.write(str.encode(command + end_string))
-            else:
-                bin_command = [int(x, 16) for x in command.split()]
-                self.device.write(serial.to_bytes(bin_command))
+            self.writes.put(wire if wire is not None else encode_line(command), self.span)
+            if not queued:
+                self.writes.flush()
             self.last_command = command
             self.device_result.update(
                 {
@@ -171,104 +426,86 @@ class Device(object):
             return self.device_result
 
     #@allure.tag("read_response")
-    def read_response(self, expected_response="OK00>", test_line="", check_response=True):
+    def read_response(self, expected_response="OK00>", test_line="", check_response=True, timeout=None):
         """Read the response from the device (~)
         If the last command was successful the device responds with 'OK00'
-        If unsuccessful the device responds with error codes"""
-        wait = 0
-        time.sleep(serial_timeout)
-
-        if self.joined and self.last_command == "lwstatus":
+        If unsuccessful the device responds with error codes.
+        timeout replaces the learned deadline for a read that may well go
+        unanswered, e.g. a probe; it does not teach the timeout model"""
+        if answers.skips_answer(self):
             pass
         else:
-            read_from_radio = bytes.decode(self.device.readline().strip())
-
-            while read_from_radio == "" and wait < 60:
-                # Wait for buffer to be populated
-                print(".", end="", flush=True)
-                read_from_radio = bytes.decode(self.device.readline().strip())
-                wait = wait + 1
-            logging.info(f"[{self.id}]<<{read_from_radio}")
-
-            result = None
-
-            if check_response:
-                check.equal(read_from_radio, expected_response)
-
-                if read_from_radio != expected_response:
-                    result = "FAILED"
-                    # logging.info(
-                    #     f'\tFAILED : {read_from_radio} != {expected_response}, at line {line_num + 1}')
-                    # # Store the line that failed
-                    # self.tfailed.append((line_num + 1, test_line))
-
-                    logging.info(f'\tFAILED : {read_from_radio} != {expected_response}')
-
-                    if "sendb" in self.last_command:
-                        self.transmit_status.append(["No-Tx", self.mode])
-                else:
-                    result = "PASSED"
-                    logging.info('\tPASSED')
-                    if "sendb" in self.last_command:
-                        self.transmit_status.append(["Tx-Ok", self.mode])
-
-            self.device_result.update(
-                {"Expected": expected_response, "Actual": read_from_radio, "Result": result})  # , "Command": None})
-
-            return self.device_result
+            read_from_radio = bytes.decode(self._timed_read("response", response_timeout, self.readline, timeout))
+            if self.span is not None:
+                self.span.mark_response()
+            return answers.response_result(self, read_from_radio, expected_response, check_response)
 
    # @allure.tag("read event")
-    def read_event(self, event, test_line=""):
+    def read_event(self, event, test_line="", timeout=None, predicate=None, settle=0, line=None):
         """Read the event message from the device (?)
-        Event message and confirmation has a delay"""
-        wait = 0
-
-        if self.joined and event in ["Joining the LoRaWAN network...", "1B 53 4A 6F 69 6E 65 64 20 6E 65 74 77 6F 72 6B 1B 54"]:
+        Messages are read until one is the event (or satisfies predicate) or
+        is an error code, or the deadline passes. timeout defaults to the
+        learned event deadline. settle is a pause after the event, for
+        tests that need the device to settle; it is API only, the ? lines
+        of flow scripts do not pause and scripts use ##PAUSE instead.
+        line is the number of test_line in its script, for the failures"""
+        if answers.skips_event(self, event):
             pass
         else:
-            read_from_radio = bytes.decode(self.device.readline().strip())
-            
-            while (read_from_radio == "" and wait < 120):
-                read_from_radio1 = self.device.readline().strip()
-
-                if read_from_radio1.startswith(b'\x1b'):
-                    read_from_radio = (read_from_radio1.hex(" ")).upper()
-                else:
-                    read_from_radio = bytes.decode(read_from_radio1)
-                print(".", end="", flush=True)  # Wait for buffer to be populated
-                wait = wait + 1
-            print("\n" + "[" + self.id + "]<<" + read_from_radio)
-            
-            if (read_from_radio != event):
-                result = "FAILED"
-                print("\tFAILED " + read_from_radio + " != " + event + ", at line " + str(line_num+1))
-                self.tfailed.append((line_num+1, test_line))  # Store the line that failed
-            else:
-                result = "PASSED"
-        
-            time.sleep(5)
-            self.device_result.update(
-                {"Expected": event, "Actual": read_from_radio, "Result": result})  # , "Command": None})
-            return self.device_result
+            match = self.wait_event(EventMatcher.of(event), timeout, predicate)
+            line = line if line is not None else line_num + 1
+            device_result = answers.event_result(self, match, event, test_line, line)
+            if settle:
+                time.sleep(settle)
+            return device_result
+
+    def wait_event(self, matcher, timeout=None, predicate=None):
+        """Wait for any of the events expected by matcher (or a message that
+        satisfies predicate), stopping early at an error code. Returns the
+        Match of the message that ended the wait, else of the last message
+        read (kind OTHER with message "" if nothing came)"""
+        key = self._latency_key("event")
+        started = time.monotonic()
+        deadline = started + (timeout if timeout is not None else self.timeouts.deadline(key, event_timeout))
+        match = Match(OTHER, None, "")
+        while time.monotonic() < deadline:
+            message = self.read_message(matcher.expected, max(0, deadline - time.monotonic()))
+            if not message:
+                break
+            match = answers.event_match(self, matcher, message, predicate)
+            if match.kind == EXPECTED:
+                self._observe(key, started)
+                if self.span is not None:
+                    self.span.mark_event()
+                break
+            if match.kind == ERROR:
+                break
+        if match.kind not in (EXPECTED, ERROR) and timeout is None:
+            self.timeouts.miss(key, time.monotonic() - started)
+        return match
 
     def read_multiple_lines(self, return_value=None, test_line=""):
         """Read the value from the device (*)
         For commands requesting data, the device returns a value with mulitple lines"""
-        time.sleep(serial_timeout)
         with open(self.results_filepath, mode="a", newline="") as result_file:
             result_writer = csv.DictWriter(result_file, fieldnames=self.fieldnames, restval='',
                                            extrasaction='ignore')
         lines = []
         read_from_radio = []
         wait = 0
+        # The first line may take a full response time; after that the
+        # block ends at the first gap of serial_timeout
+        timeout = response_timeout
         while True and wait < 60:
-            read_from_radio1 = self.device.read_until(
-                b"\n"
-            )  # .decode('utf-8').strip()  # Read until newline
-            if not read_from_radio1:
+            frame = self.reader.get(timeout)
+            if frame is None:
                 break
+            read_from_radio1 = frame.raw  # Newline included
+            timeout = serial_timeout
             lines.append(read_from_radio1)
             wait += 1
+        if lines and self.span is not None:
+            self.span.mark_response()
         
         for i in lines:
                 read_from_radio.append(bytes.decode(i, errors='ignore'))
@@ -282,66 +519,25 @@ class Device(object):
         return read_from_radio
 
    # @allure.tag("read_return_value")
-    def read_return_value(self, return_value, test_line="", check_return=True):
+    def read_return_value(self, return_value, test_line="", check_return=True, timeout=None):
         """Read the return value from the device (#)
-        For commands requesting data, the device returns a value"""
-        time.sleep(serial_timeout)
-        wait = 0
-
-        if self.joined and self.last_command == "lwstatus":
+        For commands requesting data, the device returns a value.
+        timeout is as in read_response"""
+        if answers.skips_answer(self):
             pass
         else:
-            read_from_radio1 = self.device.readline().strip()
-            while read_from_radio1 == b'' and wait < 25:
-                read_from_radio1 = self.device.readline().strip()
-                # Wait for buffer to be populated
-                print(".", end="", flush=True)
-                wait = wait + 1
-            if read_from_radio1.startswith(b"\x1b"):
-                read_from_radio = (read_from_radio1.hex(" ")).upper()
-            else:
-                read_from_radio = bytes.decode(read_from_radio1)
-
-            logging.info(f"[{self.id}]<<{read_from_radio}")
-            if check_return:
-                check.equal(read_from_radio, return_value)
-
-            if self.last_command == "geta":
-                if read_from_radio:
-                    # check.equal(read_from_radio, return_value)
-                    read_string = [read_from_radio, self.mode] if read_from_radio == return_value else [
-                        read_from_radio + " --- fail", self.mode]
-                else:
-                    read_string = ["No-Rx", self.mode]
-                self.read_strings.append(read_string)
-
-            if return_value and read_from_radio != return_value:
-                result = "FAILED"
-                logging.info(f'\tFAILED : {read_from_radio} != {return_value}')
-                # Store the line that failed
-                # self.tfailed.append((line_num + 1, test_line))
-            else:
-                # check.equal(read_from_radio, return_value)
-                result = "PASSED"
-                logging.info('\tPASSED')
-                self.joined = True if self.last_command == "lwstatus" else False
-                if self.last_command == "rssi":
-                    rssi = read_from_radio if self.read_strings[-1][0] != "No-Rx" else "--"
-                    self.rssi_list.append(rssi)
-                if self.last_command == "mode":
-                    self.mode = read_from_radio
-                    self.device_result.update({"Mode": self.mode})
-
-            self.device_result.update(
-                {"Expected": return_value, "Actual": read_from_radio, "Result": result})  # , "Command": None})
-            return self.device_result
+            read_from_radio = self._timed_read("return", return_timeout,
+                                               lambda timeout: self.read_message(return_value, timeout), timeout)
+            if self.span is not None:
+                self.span.mark_response()
+            return answers.return_value_result(self, read_from_radio, return_value, check_return)
 
     #@allure.tag("sending string")
-    def send_string(self, string_to_send, test_line=""):
-        """Send a string to the device ($)"""
-        read_from_radio = bytes.decode(self.device.readline().strip())
-        while read_from_radio == "":
-            read_from_radio = bytes.decode(self.device.readline().strip())
+    def send_string(self, string_to_send, test_line="", chunk_size=None):
+        """Send a string to the device ($)
+        string_to_send may be bytes; with chunk_size it is written in chunks
+        that each drain to the port before the next one"""
+        read_from_radio = bytes.decode(self._timed_read("prompt", response_timeout, self.readline))
 
         if read_from_radio != _sendChar_:
             result = "FAILED"
@@ -351,10 +547,12 @@ class Device(object):
             # Store the line that failed
             # self.tfailed.append((line_num + 1, test_line))
         else:
-            self.device.reset_input_buffer()
+            self.reset_input_buffer()
             result = "PASSED"
             logging.info(f"[{self.id}]<<{read_from_radio}{string_to_send}")
-            self.device.write(str.encode(string_to_send + end_string))
+            data = string_to_send if isinstance(string_to_send, bytes) else str.encode(string_to_send)
+            self.writes.put(data + str.encode(end_string))
+            self.writes.flush(chunk_size)
             self.transmit_strings.append(string_to_send)
 
         # time.sleep(2)
@@ -363,10 +561,63 @@ class Device(object):
         )
         return self.device_result
 
+    def send_payloads(self, payloads, chunk_size=64, event=None):
+        """Send payloads (str or bytes, e.g. a payload size sweep from a
+        generator) back-to-back with sendb. Each payload is encoded in bulk
+        and written in chunks of chunk_size, after the "$" prompt of the text
+        parsers. event is the event to wait for after each transmission,
+        which also keeps late events out of the next prompt.
+        Returns the number of payloads sent"""
+        count = 0
+        with open(self.results_filepath, mode="a", newline="") as result_file:
+            result_writer = csv.DictWriter(result_file, fieldnames=self.fieldnames, restval='',
+                                           extrasaction='ignore')
+            for payload in payloads:
+                command = SendBytes(len(payload), payload)
+                line, data = command.stream_parts(self.codec.mode)
+                label = f"sendb {len(payload):02X}"  # Binary frames are not rendered in hex
+                logging.info(f"Send/Receive [{self.id}]: {label}")
+                self.reset_input_buffer()
+                self._write_result(result_writer, self.send_command(label, pipelined=True, wire=line, queued=True,
+                                                                    shadowed=True))
+                if data is None:
+                    self.writes.flush(chunk_size)
+                else:
+                    self.writes.flush()
+                    self._write_result(result_writer, self.send_string(payload, chunk_size=chunk_size))
+                self._receive(command, result_writer)
+                if event is not None:
+                    self._write_result(result_writer, self.read_event(event))
+                count += 1
+        return count
+
+    def wake(self, count=8, timeout=response_timeout):
+        """Wake the board up: write count wake-ups in one go, then drain the
+        answers until all count prompts are in, or the port goes quiet after
+        the first one, or the deadline passes. True if the board answered"""
+        self.reset_input_buffer()
+        logging.info(f"[{self.id}]>>WakeUp x{count}")
+        self.device.write(self.codec.encode(WakeUp()) * count)
+        self.last_command = ""
+        deadline = time.monotonic() + timeout
+        prompts = 0
+        while prompts < count:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            frame = self.read_frame(remaining if prompts == 0 else min(remaining, serial_timeout))
+            if frame is None:
+                break
+            text = frame.text
+            if frame.binary or (text.startswith(("OK", "ER")) and text.endswith(">")):
+                prompts += 1
+        logging.info(f"[{self.id}]<<{prompts} prompts")
+        return prompts > 0
+
     def flush_buffer(self):
         """Wait and clear the responses and or returns from the device (%)"""
         time.sleep(2)
-        self.device.reset_input_buffer()
+        self.reset_input_buffer()
         logging.info("-Flush buffer-")
         self.mode = "-"
         self.device_result.update({"Mode": self.mode})
@@ -375,37 +626,101 @@ class Device(object):
 
     def close(self):
         """Close the port the device is connected to"""
+        self.reader.stop()
         self.device.close()
+        self.spans.flush()
 
     def send_receive(self, command):
+        """Send the command and read its answers; a set command whose value
+        the board has already (see hello.shadow) is not sent"""
+        if self.shadow.redundant(command):
+            logging.info(f"Send/Receive [{self.id}] (elided, already set): {command}")
+            return
         logging.info(f"Send/Receive [{self.id}]: {command}")
 
         with open(self.results_filepath, mode="a", newline="") as result_file:
             result_writer = csv.DictWriter(result_file, fieldnames=self.fieldnames, restval='',
                                            extrasaction='ignore')
-            if command.command is not None:
-                device_result = self.send_command(command.command)
-                if device_result["Result"] != "Discard":
-                    result_writer.writerow(device_result)
-
-                if Cmd.mode != "binary" and type(command) is SendBytes:
-                    device_result = self.send_string(command.string)
-                    if device_result["Result"] != "Discard":
-                        result_writer.writerow(device_result)
-
-            if isinstance(command, CmdRtrn):
-                check_return = False if command.return_value is None else True
-                device_result = self.read_return_value(command.return_value, check_return=check_return)
-                if device_result["Result"] != "Discard":
-                    result_writer.writerow(device_result)
-
-            if command.response:
-                if Cmd.mode == "binary":
-                    device_result = self.read_return_value(command.response)
-                else:
-                    device_result = self.read_response(command.response)
-                if device_result["Result"] != "Discard":
-                    result_writer.writerow(device_result)
+            self._send(command, result_writer)
+            self._receive(command, result_writer)
+
+    def send_receive_pipelined(self, commands, window=4):
+        """Send/receive a sequence of commands, writing up to window commands
+        back-to-back before reading their responses and return values, which
+        the device sends in the same order. Commands that cannot share the
+        line with others (Cmd.pipelined is False) are sent on their own"""
+        pending = []
+        with open(self.results_filepath, mode="a", newline="") as result_file:
+            result_writer = csv.DictWriter(result_file, fieldnames=self.fieldnames, restval='',
+                                           extrasaction='ignore')
+            for command in commands:
+                if self.shadow.redundant(command):
+                    logging.info(f"Send/Receive [{self.id}] (elided, already set): {command}")
+                    continue
+                if not command.pipelined or self.codec.command(command) is None:
+                    self._receive_pending(pending, result_writer)
+                    logging.info(f"Send/Receive [{self.id}]: {command}")
+                    self._send(command, result_writer)
+                    self._receive(command, result_writer)
+                    continue
+                logging.info(f"Send/Receive [{self.id}] (pipelined): {command}")
+                self._send(command, result_writer, pipelined=bool(pending), queued=True)
+                pending.append((command, self.last_command, self.span))
+                if len(pending) >= window:
+                    self._receive_pending(pending, result_writer)
+            self._receive_pending(pending, result_writer)
+
+    def _receive_pending(self, pending, result_writer):
+        for command, last_command, span in pending:
+            self.last_command = last_command  # The read checks depend on it
+            self.span = span
+            self._receive(command, result_writer)
+        pending.clear()
+
+    @staticmethod
+    def _write_result(result_writer, device_result):
+        if device_result and device_result["Result"] != "Discard":
+            result_writer.writerow(device_result)
+
+    def _send(self, command, result_writer, pipelined=False, queued=False):
+        text = self.codec.command(command)
+        self.shadow.sending(command)
+        if text is not None:
+            self._write_result(result_writer, self.send_command(text, pipelined=pipelined,
+                                                                wire=self.codec.encode(command), queued=queued,
+                                                                shadowed=True))
+
+            if self.codec.mode != "binary" and type(command) is SendBytes:
+                self._write_result(result_writer, self.send_string(command.string))
+
+    def _receive(self, command, result_writer):
+        passed = True
+        if isinstance(command, CmdRtrn):
+            return_value = self.codec.return_value(command)
+            check_return = False if return_value is None else True
+            device_result = self.read_return_value(return_value, check_return=check_return)
+            passed = passed and bool(device_result) and device_result["Result"] == "PASSED"
+            self._check_parser(device_result)
+            self._write_result(result_writer, device_result)
+
+        response = self.codec.response(command)
+        if response:
+            if self.codec.mode == "binary":
+                device_result = self.read_return_value(response)
+            else:
+                device_result = self.read_response(response)
+            passed = passed and bool(device_result) and device_result["Result"] == "PASSED"
+            self._check_parser(device_result)
+            self._write_result(result_writer, device_result)
+            if passed:
+                self.shadow.confirm(command)
+
+    def _check_parser(self, device_result):
+        """Have the parser mode detected again when the answer shows that
+        the board is not in the mode the commands are encoded for"""
+        if device_result and parser_mismatch(self.codec.mode, device_result["Actual"]):
+            parser_modes.forget(self.port)
+            self.shadow.invalidate("parser mismatch")
 
 
 class TestDevices(object):
@@ -507,13 +822,17 @@ class TestDevices(object):
 
 
 class FlowTestExecutor:
-    def __init__(self, name, directives, port_list):
+    def __init__(self, name, directives, port_list, concurrent=False):
         self.name = name
         self.directives = directives
         self.port_list = port_list
+        # Run the lines of different devices in parallel lanes
+        self.concurrent = concurrent
 
         self.test = TestDevices(self.port_list)
         self.devices = []
+        # Writes shared by the lanes: the result rows and the unknown lines
+        self.lock = threading.Lock()
 
     @staticmethod
     def interpreter_command(icommand):
@@ -556,20 +875,24 @@ class FlowTestExecutor:
             logging.info("---------Repeat---------")
         elif test_line[:2] == _end_:
             logging.info("----------End-----------")
+        elif test_line[:2] == _barrier_:
+            logging.info("--------Barrier---------")
         elif test_line.find("[") < test_line.find("]"):  # Device number and action
             device_id, device_action = test_line.split(
                 "]"
             )  # Identify device number and operation to perform
             device_id = device_id.split("[")[1]
-            return self.device_operation(device_id, device_action, test_line)
+            return self.device_operation(device_id, device_action, test_line, line_num)
         else:  # Error in processing the line
             logging.info(f"Unknown line {line_num}: {test_line}")
-            test_lines_not_exec.append(line_num)
+            with self.lock:
+                test_lines_not_exec.append(line_num)
 
         return {"Result": "Discard"}  # return 0
 
-    def device_operation(self, device_id, device_action, test_line):
-        """Operation to be performed by the device."""
+    def device_operation(self, device_id, device_action, test_line, line_num=None):
+        """Operation to be performed by the device.
+        line_num is the number of test_line, kept with a failed event"""
 
         if device_action[0] == _declaration_:  # New device found
             # logging.info(test_line)
@@ -589,7 +912,7 @@ class FlowTestExecutor:
         elif device_action[0] == _event_:  # Event message from the device
             event = device_action[1:].strip()
             device_result = self.test.getdev(device_id).read_event(
-                event, test_line=test_line
+                event, test_line=test_line, line=line_num
             )
         elif device_action[0] == _returned_:  # Return value from the device
             return_value = device_action[1:].strip()
@@ -615,6 +938,88 @@ class FlowTestExecutor:
 
         return device_result
 
+    @staticmethod
+    def expand_repeats(directives):
+        """Flatten REPEAT n ... END blocks into a list of (line_num, test_line)"""
+        lines = []
+        repeat_lines = None
+        repeat_times = 0
+        for line_num, test_line in enumerate(directives):
+            if "REPEAT" in test_line:
+                repeat_times = int(test_line.partition(" ")[2].strip())
+                repeat_lines = []
+            elif repeat_lines is None:
+                lines.append((line_num, test_line))
+            elif "END" in test_line:
+                lines.extend(repeat_lines * repeat_times)
+                repeat_lines = None
+            else:
+                repeat_lines.append((line_num, test_line))
+        return lines
+
+    @staticmethod
+    def lane_id(test_line):
+        """Device a line runs on, "" for lines without effect and None for
+        lines every lane has to wait for (barriers, declarations, interpreter
+        commands)"""
+        if test_line.strip() == "" or test_line[:2] == _comment_:
+            return ""
+        if test_line[:1] != "@" and test_line[:2] not in (_interp_command_, _printOutput_) \
+                and test_line.find("[") < test_line.find("]"):
+            device_id, device_action = test_line.split("]")
+            if device_action[:1] != _declaration_:
+                return device_id.split("[")[1]
+        return None
+
+    @classmethod
+    def split_lanes(cls, lines):
+        """Split the lines into segments run one after the other. A segment
+        maps each device id to its lane of lines; a synchronising line gets a
+        segment of its own under the None key"""
+        segments = []
+        lanes = {}
+        for line_num, test_line in lines:
+            device_id = cls.lane_id(test_line)
+            if device_id == "":
+                continue
+            if device_id is not None:
+                lanes.setdefault(device_id, []).append((line_num, test_line))
+                continue
+            if lanes:
+                segments.append(lanes)
+                lanes = {}
+            if test_line[:2] != _barrier_:
+                segments.append({None: [(line_num, test_line)]})
+        if lanes:
+            segments.append(lanes)
+        return segments
+
+    def run_lanes(self, result_writer):
+        """Run the directives with one thread per device lane. A lane keeps
+        its own line number, and only its own device records failures"""
+
+        def run_lane(lane):
+            for line_num, test_line in lane:
+                try:
+                    line_result = self.process_line(line_num + 1, test_line)
+                except:
+                    logging.error(f"-------Error at line-------- {line_num + 1}{test_line}")
+                    raise
+                if line_result and line_result.get("Result") != "Discard":
+                    with self.lock:
+                        result_writer.writerow(line_result)
+
+        segments = self.split_lanes(self.expand_repeats(self.directives))
+        workers = max(len(lanes) for lanes in segments) if segments else 1
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for lanes in segments:
+                if len(lanes) == 1:
+                    run_lane(next(iter(lanes.values())))
+                    continue
+                # Barrier: the next segment starts once every lane is done
+                for future in [pool.submit(run_lane, lane) for lane in lanes.values()]:
+                    future.result()
+
     def run(self, directives=[]):
         test_time = time.strftime("%d-%m-%Y_%H-%M-%S")
 
@@ -651,8 +1056,14 @@ class FlowTestExecutor:
             )
             result_writer.writeheader()
 
+            sequential_lines = self.directives
+            line_num, test_line = 0, ""
             try:
-                for line_num, test_line in enumerate(self.directives):
+                if self.concurrent:
+                    self.run_lanes(result_writer)
+                    sequential_lines = []  # Already executed in the lanes
+
+                for line_num, test_line in enumerate(sequential_lines):
                     if "REPEAT" in test_line:
                         repeat_times = int(test_line.partition(" ")[2].strip())
                         repeat = True
@@ -670,7 +1081,7 @@ class FlowTestExecutor:
                                     line_result = self.process_line(
                                         line_num + 1, test_line
                                     )
-                                    if line_result["Result"] == "Discard":
+                                    if line_result is None or line_result["Result"] == "Discard":
                                         pass
                                     else:
                                         result_writer.writerow(line_result)
@@ -681,28 +1092,31 @@ class FlowTestExecutor:
                             repeat_lines.append((line_num, test_line))
                             continue
                     line_result = self.process_line(line_num + 1, test_line)
-                    if line_result.get('Result') == "Discard" or line_result is None:
+                    if line_result is None or line_result.get('Result') == "Discard":
                         pass
                     else:
                         result_writer.writerow(line_result)
 
             except:
-                logging.error(
-                    f"-------Error at line-------- {line_num + 1}{test_line}")
+                if not self.concurrent:  # A lane logs the line it failed at
+                    logging.error(
+                        f"-------Error at line-------- {line_num + 1}{test_line}")
                 error_line = 1
                 raise
 
-        # f.close()
+            # The summary and the closing of the ports follow an error too
+            finally:
+                logging.info("=======================================================")
+                logging.info(f"SUMMARY: {test_file_name}")
+                failures_present = self.test.testsummary()
+                if len(test_lines_not_exec) != 0:
+                    logging.warning(
+                        "WARNING! Some commands might not have been executed at lines:")
+                    logging.info(" ".join(map(str, test_lines_not_exec)))
 
-        logging.info("=======================================================")
-        logging.info(f"SUMMARY: {test_file_name}")
-        failures_present = self.test.testsummary()
-        if len(test_lines_not_exec) != 0:
-            logging.warning(
-                "WARNING! Some commands might not have been executed at lines:")
-            logging.info(" ".join(map(str, test_lines_not_exec)))
+                self.test.clean()
 
-        self.test.clean()
+        # f.close()
 
     def test_summary(self):
         """Summary of test results for a device"""
@@ -1,17 +1,25 @@
 """sample test"""
 import unittest
+import os
+import types
 
 from hello import hello
 
 import time
-import logging
+import threading
 
 import pytest
-
-from hello.test_executor import Device
+import pytest_check as check
+
+from hello.test_executor import SerialReader, WriteQueue
+from hello.frames import FrameDecoder, TEXT, RESPONSE, EVENT as EVENT_FRAME, expected_candidates
+from hello.timeouts import TimeoutModel
+from hello.matcher import EventMatcher, Match, EXPECTED, ERROR, EVENT, OTHER, join_events
+from hello.parser_mode import detect_parser_modes, set_parser_mode
+from hello import answers
 #add Gevent command
-from hello.commands import Cmd, SendBytes, Lorawan, Stack, Ping, Sevent, Sconfirm, Confirm, Devid, \
-    Sappeui, Gappeui, Sappkey, Gappkey, Sotaa, Gotaa, Lwjoin, Lwjoinbin, WakeUp, SetParser, Lwstatus, Sappskey, Gappskey, \
+from hello.commands import Cmd, Codec, SendBytes, Lorawan, Stack, Ping, Sevent, Sconfirm, Confirm, Devid, \
+    Sappeui, Gappeui, Sappkey, Gappkey, Sotaa, Gotaa, Lwjoin, Lwjoinbin, SetParser, Lwstatus, Sappskey, Gappskey, \
         Snwkskey, Gnwkskey, Sdevaddr, Gdevaddr, Lwjoinbinabp
 
 
@@ -34,6 +42,270 @@ class Testworld(unittest.TestCase):
         self.assertEqual(hello('hello'), 'hello hello')
 
 
+class FakePort:
+    """serial.Serial stand-in fed from the test"""
+
+    def __init__(self, timeout=0.05):
+        self.timeout = timeout
+        self.data = bytearray()
+        self.cond = threading.Condition()
+
+    @property
+    def in_waiting(self):
+        return len(self.data)
+
+    def feed(self, data):
+        with self.cond:
+            self.data += data
+            self.cond.notify_all()
+
+    def read(self, size=1):
+        with self.cond:
+            if not self.data:
+                self.cond.wait(self.timeout)
+            chunk = bytes(self.data[:size])
+            del self.data[:size]
+            return chunk
+
+
+class TestTimeoutModel(unittest.TestCase):
+
+    def test_default_until_enough_samples(self):
+        timeouts = TimeoutModel(quantile=100, margin=0.5, slack=0.1, min_samples=3)
+        timeouts.observe("key", 0.2)
+        timeouts.observe("key", 0.4)
+        self.assertEqual(timeouts.deadline("key", 12), 12)
+        timeouts.observe("key", 0.3)
+        self.assertAlmostEqual(timeouts.deadline("key", 12), 0.7)
+        timeouts.observe("key", 1.0)
+        self.assertAlmostEqual(timeouts.deadline("key", 12), 1.6)
+
+    def test_miss_widens_deadline(self):
+        timeouts = TimeoutModel(quantile=100, margin=0.5, slack=0.1, min_samples=3)
+        for latency in (0.2, 0.3, 0.4):
+            timeouts.observe("key", latency)
+        deadline = timeouts.deadline("key", 12)
+        timeouts.miss("key", deadline)
+        self.assertAlmostEqual(timeouts.deadline("key", 12), deadline * 1.5 + 0.1)
+
+
+class TestEventMatcher(unittest.TestCase):
+
+    def test_classify(self):
+        matcher = EventMatcher(["EVENT Joined network", "1B 53 4A 6F 69 6E 65 64 20 6E 65 74 77 6F 72 6B 1B 54"])
+        cases = {
+            "EVENT Joined network": (EXPECTED, "EVENT Joined network"),
+            "1B 53 4A 6F 69 6E 65 64 20 6E 65 74 77 6F 72 6B 1B 54": (EXPECTED, "1B 53 4A 6F 69 6E 65 64 20 6E 65 74 77 6F 72 6B 1B 54"),
+            "ERFA>": (ERROR, "ERFA>"),
+            "1B 50 1B 51 FA": (ERROR, "ERFA>"),
+            "EVENT Message transmitted": (EVENT, "Message transmitted"),
+            "1B 53 4D 1B 54": (EVENT, "M"),
+            "OK00>": (OTHER, None),
+            "": (OTHER, None),
+        }
+        for message, expected in cases.items():
+            self.assertEqual(tuple(matcher.classify(message)[:2]), expected, message)
+
+    def test_compiled_once(self):
+        self.assertIs(EventMatcher.of("EVENT Joined network"), EventMatcher.of("EVENT Joined network"))
+
+    def test_join_events(self):
+        self.assertIn("Joining the LoRaWAN network...", join_events)
+        self.assertIn("1B 53 4A 6F 69 6E 65 64 20 6E 65 74 77 6F 72 6B 1B 54", join_events)
+        self.assertNotIn("EVENT Joined network", join_events)
+        self.assertNotIn("EVENT Message transmitted", join_events)
+
+
+class TestAnswers(unittest.TestCase):
+
+    def setUp(self):
+        self.device = types.SimpleNamespace(id="1", joined=False, last_command=None, mode="-", tfailed=[],
+                                            read_strings=[], rssi_list=[], transmit_status=[], device_result={})
+
+    def test_return_values(self):
+        for command, value in (("mode", "LoRa"), ("geta", "12345"), ("rssi", "-40"), ("lwstatus", "01")):
+            self.device.last_command = command
+            answers.return_value_result(self.device, value, value, soft_check=False)
+        self.assertEqual(self.device.mode, "LoRa")
+        self.assertEqual(self.device.read_strings, [["12345", "LoRa"]])
+        self.assertEqual(self.device.rssi_list, ["-40"])
+        self.assertTrue(self.device.joined)
+        self.assertTrue(answers.skips_answer(self.device))
+        self.assertTrue(answers.skips_command(self.device, "lwjoin"))
+        self.assertTrue(answers.skips_event(self.device, "Joining the LoRaWAN network..."))
+
+    def test_failed_event(self):
+        match = Match(OTHER, None, "EVENT Message transmitted")
+        result = answers.event_result(self.device, match, "EVENT Joined network", "[1]?EVENT Joined network", 7)
+        self.assertEqual((result["Actual"], result["Result"]), ("EVENT Message transmitted", "FAILED"))
+        self.assertEqual(self.device.tfailed, [(7, "[1]?EVENT Joined network")])
+
+    def test_binary_message(self):
+        candidates = expected_candidates("1B 50 1B 51 01")
+        self.assertTrue(answers.expects_more(bytes.fromhex("1B 50"), candidates))
+        self.assertFalse(answers.expects_more(bytes.fromhex("1B 50 1B 51 01"), candidates))
+        self.assertEqual(answers.binary_message(bytes.fromhex("1B 50 1B 51 01"), candidates), "1B 50 1B 51 01")
+        self.assertEqual(answers.binary_message(bytes.fromhex("1B 50 1B 51 FA"), candidates), "1B 50 1B 51 FA")
+
+
+class TestSerialReader(unittest.TestCase):
+
+    def setUp(self):
+        self.port = FakePort()
+        self.reader = SerialReader(self.port)
+
+    def tearDown(self):
+        self.reader.stop()
+
+    def test_buffered_lines(self):
+        """lines already read come back without waiting"""
+        self.port.feed(b"OK00>\r\nPONG!\r\n")
+        self.assertEqual(self.reader.get(1).raw, b"OK00>\r\n")
+        self.assertEqual(self.reader.get(0).raw, b"PONG!\r\n")
+
+    def test_partial_line_after_idle(self):
+        """an unterminated line is handed out once the port goes quiet"""
+        self.port.feed(b"$")
+        self.assertEqual(self.reader.get(1).raw, b"$")
+
+    def test_binary_frame_without_newline(self):
+        self.port.feed(bytes.fromhex("1B 50 01 1B 51 01"))
+        frame = self.reader.get(1)
+        self.assertEqual(frame.kind, RESPONSE)
+        self.assertEqual(frame.payload, b"\x01")
+
+    def test_timeout(self):
+        self.assertIsNone(self.reader.get(0.1))
+
+    def test_clear(self):
+        self.port.feed(b"ERFE>\r\n")
+        time.sleep(0.1)
+        self.reader.clear()
+        self.assertIsNone(self.reader.get(0.1))
+
+
+class TestFrameDecoder(unittest.TestCase):
+
+    def test_response_split_across_reads(self):
+        decoder = FrameDecoder()
+        self.assertEqual(decoder.feed(bytes.fromhex("1B 50 12 34")), [])
+        frames = decoder.feed(bytes.fromhex("1B 51 01"))
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(frames[0].kind, RESPONSE)
+        self.assertEqual(frames[0].payload, bytes.fromhex("12 34"))
+        self.assertEqual(frames[0].status, 0x01)
+        self.assertEqual(frames[0].hex(), "1B 50 12 34 1B 51 01")
+
+    def test_response_then_event(self):
+        data = bytes.fromhex("1B 50 1B 51 01 1B 53") + b"Joined network" + bytes.fromhex("1B 54")
+        frames = FrameDecoder().feed(data)
+        self.assertEqual([f.kind for f in frames], [RESPONSE, EVENT_FRAME])
+        self.assertEqual(frames[1].text, "Joined network")
+        self.assertEqual(b"".join(f.raw for f in frames), data)
+
+    def test_text_lines(self):
+        decoder = FrameDecoder()
+        frames = decoder.feed(b"EVENT Joined network\r\nOK0")
+        self.assertEqual([(f.kind, f.text) for f in frames], [(TEXT, "EVENT Joined network")])
+        self.assertEqual([f.text for f in decoder.flush()], ["OK0"])
+
+
+
+class TestCommandEncoding(unittest.TestCase):
+
+    def setUp(self):
+        self.old_mode = Cmd.mode
+
+    def tearDown(self):
+        Cmd.mode = self.old_mode
+
+    def test_binary(self):
+        Cmd.mode = "binary"
+        self.assertEqual(Sappeui("12 34 56 78 12 34 56 78").encode(),
+                         bytes.fromhex("1B 2A A7 12 34 56 78 12 34 56 78 1B 42"))
+        self.assertEqual(Sevent(enabled=True).encode(), bytes.fromhex("1B 2A 4F 01 1B 42"))
+        self.assertEqual(SendBytes(5, "12345").command, "0x1B 0x2A 0x20 0x31 0x32 0x33 0x34 0x35 0x1B 0x42")
+
+    def test_binary_devaddr(self):
+        # One byte per hex pair, where the hex strings of before sent "0x006cf06d"
+        Cmd.mode = "binary"
+        self.assertEqual(Sdevaddr("006cf06d").encode(), bytes.fromhex("1B 2A AC 00 6C F0 6D 1B 42"))
+        self.assertEqual(Sdevaddr("006cf06d").command, "0x1B 0x2A 0xAC 0x00 0x6C 0xF0 0x6D 0x1B 0x42")
+
+    def test_ascii(self):
+        Cmd.mode = "ascii"
+        self.assertEqual(Sconfirm(enabled=True).encode(), b" sconfirm 01\r\n")
+        Cmd.mode = "at"
+        self.assertEqual(Sconfirm(enabled=True).encode(), b" AT+F 01\r\n")
+
+    def test_cached(self):
+        Cmd.mode = "binary"
+        self.assertIs(Sotaa(enabled=True).encode(), Sotaa(enabled=True).encode())
+        self.assertNotEqual(SendBytes(5, "12345").encode(), SendBytes(5, "54321").encode())
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_modes_are_per_codec(self):
+        ascii_codec, binary_codec = Codec("ascii"), Codec("binary")
+        command = Gappeui("12 34 56 78 12 34 56 78")
+        self.assertEqual(ascii_codec.encode(command), b" gAppEUI\r\n")
+        self.assertEqual(binary_codec.encode(command), bytes.fromhex("1B 2A 63 1B 42"))
+        self.assertEqual(ascii_codec.return_value(command), "12 34 56 78 12 34 56 78")
+        self.assertEqual(binary_codec.return_value(command), "1B 50 12 34 56 78 12 34 56 78 1B 51 01")
+        self.assertEqual(ascii_codec.response(command), "OK00>")
+        self.assertEqual(binary_codec.response(command), "")
+        self.assertEqual(binary_codec.response(Sotaa(enabled=True)), "1B 50 1B 51 01")
+
+    def test_using(self):
+        codec = Codec("binary")
+        with codec.using("ascii"):
+            self.assertEqual(codec.command(SetParser()), "sparser")
+        self.assertEqual(codec.mode, "binary")
+
+
+class RecordingPort:
+    """Port stand-in recording its write() calls, optionally backed by a pipe"""
+
+    def __init__(self, fd=None):
+        self.fd = fd
+        self.writes = []
+
+    def fileno(self):
+        if self.fd is None:
+            raise AttributeError("no fd")
+        return self.fd
+
+    def write(self, data):
+        self.writes.append(bytes(data))
+
+
+class TestWriteQueue(unittest.TestCase):
+
+    def test_scatter_gather_write(self):
+        read_fd, write_fd = os.pipe()
+        try:
+            port = RecordingPort(write_fd)
+            queue = WriteQueue(port)
+            for command in (b"ping\r\n", b"confirm\r\n", b"devid\r\n"):
+                queue.put(command)
+            queue.flush()
+            self.assertEqual(os.read(read_fd, 100), b"ping\r\nconfirm\r\ndevid\r\n")
+            self.assertEqual(port.writes, [])
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+    def test_single_write_without_fd(self):
+        port = RecordingPort()
+        queue = WriteQueue(port)
+        queue.put(b"ping\r\n")
+        queue.put(b"confirm\r\n")
+        queue.flush()
+        queue.flush()
+        self.assertEqual(port.writes, [b"ping\r\nconfirm\r\n"])
+
+
 def pause(ticks=120, period=0.03):
     wait = 0
     while wait < ticks:
@@ -43,54 +315,14 @@ def pause(ticks=120, period=0.03):
     print("")
 
 
-def detect_parser_mode(device: Device):
-    device.send_command("ping")
-    result = device.read_return_value("PONG!", check_return=False)
-    logging.info(f"ASCII ping: port = {device.port}, result = {result}")
-    if result["Actual"] == "":
-        device.send_command("0x1B 0x2A 0x11 0x1B 0x42")
-        result = device.read_return_value("1B 50 1B 51 01", check_return=False)
-        logging.info(f"Binary ping: port = {device.port}, result = {result}")
-        if result["Actual"] == "1B 50 1B 51 01":
-            return "binary"
-    elif result["Actual"] == "PONG!":
-        return "ascii"
-    result = device.read_response(check_response=False)
-    logging.info(f"Read response: port = {device.port}, result = {result}")
-
-
-def set_parser_mode(device, current_mode, target_mode):
-    if current_mode == "ascii" or current_mode == "at":
-        if target_mode == "binary":
-            old_mode = Cmd.mode
-            Cmd.mode = "ascii"
-            device.send_receive(SetParser())
-            Cmd.mode = old_mode
-    elif current_mode == "binary":
-        if target_mode == "ascii" or target_mode == "at":
-            old_mode = Cmd.mode
-            Cmd.mode = "binary"
-            device.send_receive(SetParser())
-            device.read_return_value("1B 50 1B 51 01", check_return=False)
-            Cmd.mode = old_mode
-
-            device.send_receive(WakeUp())
-            device.send_receive(WakeUp())
-            device.send_receive(WakeUp())
-            device.send_receive(WakeUp())
-            device.read_response()
-
-
 class TestLorawanCommands:
     @pytest.fixture
-    def devices(self, config_data, results_filepath):
-        dev1 = Device("1", config_data['device1']['port'], config_data['device1']['baudrate'],
-                      results_filepath=results_filepath)
-        dev1.identify()
-        dev2 = Device("2", config_data['device2']['port'], config_data['device2']['baudrate'],
-                      results_filepath=results_filepath)
-        dev2.identify()
-        return dev1, dev2
+    def devices(self, device_pool, results_filepath):
+        dev1 = device_pool.lease("device1", results_filepath)
+        dev2 = device_pool.lease("device2", results_filepath)
+        yield dev1, dev2
+        device_pool.release("device1")
+        device_pool.release("device2")
 
     @pytest.fixture
     def device1(self, devices):
@@ -101,49 +333,48 @@ class TestLorawanCommands:
         return devices[1]
 
     @pytest.fixture
-    def parser(self, parser_mode):
-        Cmd.mode = "ascii"
+    def parser(self, devices, parser_mode):
+        for device in devices:
+            device.codec.mode = "ascii"
 
         def _parser():
-            Cmd.mode = parser_mode
-            return Cmd.mode
+            for device in devices:
+                device.codec.mode = parser_mode
+            return parser_mode
 
         return _parser
 
     @pytest.fixture
-    def wake_devices(self, device1, parser):
-        device1.send_receive(WakeUp())
-        device1.send_receive(WakeUp())
-        device1.send_receive(WakeUp())
-        device1.send_receive(WakeUp())
-        device1.send_receive(WakeUp())
-        device1.send_receive(WakeUp())
-        device1.send_receive(WakeUp())
-        device1.send_receive(WakeUp())
-
+    def wake_devices(self, devices, device1, parser, device_pool):
+        # Pooled devices stay awake between tests
+        device_pool.once("device1", "wake", lambda device: check.is_true(device.wake(8)))
         config_mode = parser()
-        set_parser_mode(device1, detect_parser_mode(device1), config_mode)
+        # Probed on all ports at once, then remembered per port
+        current_modes = detect_parser_modes(devices)
+        set_parser_mode(device1, current_modes[device1.port], config_mode)
 
     @pytest.fixture
     def prepare_stack(self, wake_devices, device1):
         device1.send_receive(Lorawan())
         device1.send_receive(Stack("lorawan"))
 
-        device1.send_receive(Ping("PONG!"))
+        device1.send_receive_pipelined([
+            Ping("PONG!"),
 
-        device1.send_receive(Sevent(enabled=False))
-        #device1.send_receive(Gevent(enabled=False))
+            Sevent(enabled=False),
+            #Gevent(enabled=False),
 
-        device1.send_receive(Sevent(enabled=True))
-        #device1.send_receive(Gevent(enabled=True))
+            Sevent(enabled=True),
+            #Gevent(enabled=True),
 
-        device1.send_receive(Sconfirm(enabled=False))
-        device1.send_receive(Confirm(enabled=False))
+            Sconfirm(enabled=False),
+            Confirm(enabled=False),
 
-        device1.send_receive(Sconfirm(enabled=True))
-        device1.send_receive(Confirm(enabled=True))
+            Sconfirm(enabled=True),
+            Confirm(enabled=True),
 
-        device1.send_receive(Devid("97 4F 2F 6C E9 02 BE 77"))
+            Devid("97 4F 2F 6C E9 02 BE 77"),
+        ], window=4)
 
     def test_otaa_lwjoin(self, device1,parser_mode):
         device1.send_receive(Sappeui("12 34 56 78 12 34 56 78"))
@@ -0,0 +1,924 @@
+"""Tests on the EVK simulator, the transports, the reactor, the mux and the
+farm. They run on ptys, termios, Unix sockets and fcntl locks, so they are
+skipped where those are missing (Windows)."""
+import asyncio
+import contextlib
+import csv
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import pytest
+import serial
+
+if os.name != "posix":
+    pytest.skip("needs a POSIX system", allow_module_level=True)
+
+from hello import benchmark, replay, test_executor
+from hello.async_device import AsyncDevice
+from hello.commands import Cmd, SendBytes, Lorawan, Stack, Ping, Sevent, Sconfirm, Confirm, Devid, Sappeui, \
+    Gappeui, Sotaa, Gotaa, Sdevaddr, Gdevaddr, Reset
+from hello.farm import FarmLease
+from hello.identity import IdentityCache
+from hello.matcher import EventMatcher, EXPECTED
+from hello.mux import MuxDaemon, mux_url
+from hello.parser_mode import parser_modes, parser_mismatch, detect_parser_modes, set_parser_mode
+from hello.pool import DevicePool
+from hello.reactor import Reactor, ReactorDevice, ReactorFlowExecutor
+from hello.simulator import DeviceSimulator
+from hello.spans import spans_filepath
+from hello.test_executor import Device, FlowTestExecutor
+from hello.timeouts import TimeoutModel
+from hello.transports import MemoryTransport, FdTransport, MuxTransport, open_transport
+
+
+class TestFlowLanes(unittest.TestCase):
+
+    def test_expand_repeats(self):
+        lines = FlowTestExecutor.expand_repeats(["[1]>ping", "REPEAT 2", "[1]>geta", "[1]~", "END", "[1]~"])
+        self.assertEqual([line for _, line in lines], ["[1]>ping", "[1]>geta", "[1]~", "[1]>geta", "[1]~", "[1]~"])
+
+    def test_split_lanes(self):
+        directives = ["[1]&", "[2]&", "// setup", "[1]>sendb 05", "[2]>autorx 1", "[1]$hello",
+                      "[2]~", "@B", "[2]#hello", "##PAUSE", "[1]>ping"]
+        segments = FlowTestExecutor.split_lanes(enumerate(directives))
+        lanes = [{key: [line for _, line in lane] for key, lane in segment.items()} for segment in segments]
+        self.assertEqual(lanes, [
+            {None: ["[1]&"]},
+            {None: ["[2]&"]},
+            {"1": ["[1]>sendb 05", "[1]$hello"], "2": ["[2]>autorx 1", "[2]~"]},
+            {"2": ["[2]#hello"]},
+            {None: ["##PAUSE"]},
+            {"1": ["[1]>ping"]},
+        ])
+
+
+    def test_lines_skipped_once_joined(self):
+        # read_return_value marks the device joined on lwstatus; the lines
+        # skipped after that produce no result row
+        directives = ["[1]&", "[1]>lwstatus", "[1]#00", "[1]~", "[1]?Joining the LoRaWAN network..."]
+        with tempfile.TemporaryDirectory() as work_dir, DeviceSimulator() as simulator:
+            cwd = os.getcwd()
+            os.chdir(work_dir)
+            try:
+                FlowTestExecutor("joined", directives, [simulator.port, 115200]).run()
+            finally:
+                os.chdir(cwd)
+            [results] = [os.path.join(work_dir, name) for name in os.listdir(work_dir) if name.startswith("Result_")]
+            with open(results) as result_file:
+                commands = [line.split(",")[5] for line in result_file.readlines()[1:]]
+        self.assertEqual(commands, ["", "lwstatus"])
+
+    @staticmethod
+    def lanes_executor(directives, *simulators):
+        ports = [value for simulator in simulators for value in (simulator.port, 115200)]
+        return FlowTestExecutor("lanes", directives, ports, concurrent=True)
+
+    @staticmethod
+    def run_flow(executor):
+        """Run the executor from a temporary directory, for its results file"""
+        with tempfile.TemporaryDirectory() as work_dir:
+            cwd = os.getcwd()
+            os.chdir(work_dir)
+            try:
+                executor.run()
+            finally:
+                os.chdir(cwd)
+
+    def test_lane_failures_keep_their_lines(self):
+        directives = ["[1]&", "[2]&", "[1]>ping", "[1]#PONG!", "[1]~", "[2]>lwjoin", "[2]?EVENT Joined network"]
+        with DeviceSimulator() as simulator1, DeviceSimulator(error_rate=1.0) as simulator2:
+            executor = self.lanes_executor(directives, simulator1, simulator2)
+            self.run_flow(executor)
+        device1, device2 = executor.test.evklist
+        self.assertEqual(device1.tfailed, [])
+        self.assertEqual(device2.tfailed, [(7, "[2]?EVENT Joined network")])
+
+    def test_lane_error_still_summarised(self):
+        directives = ["[1]&", "[1]>ping", "[1]#PONG!", "[1]~", "[2]>ping"]  # Device 2 was never declared
+        with DeviceSimulator() as simulator:
+            executor = self.lanes_executor(directives, simulator)
+            with self.assertLogs(level="INFO") as logs, self.assertRaises(Exception):
+                self.run_flow(executor)
+        self.assertTrue(any("SUMMARY" in line for line in logs.output))
+        self.assertTrue(any("Error at line-------- 5" in line for line in logs.output))
+        self.assertFalse(executor.test.evklist[0].device.is_open)
+
+
+class PtyResponder(threading.Thread):
+    """Answers every command line written to a pty with the given lines"""
+
+    def __init__(self, master, answers):
+        super().__init__(daemon=True)
+        self.master = master
+        self.answers = answers
+        self.commands = []
+        self.start()
+
+    def run(self):
+        buffer = b""
+        while True:
+            try:
+                buffer += os.read(self.master, 1024)
+            except OSError:
+                return
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                self.commands.append(line.strip())
+                os.write(self.master, self.answers(line.strip()))
+
+
+class TestPipelining(unittest.TestCase):
+
+    def setUp(self):
+        # The slave stays open until the Device has opened the port: reading
+        # the master of a pty without an open slave fails with EIO
+        self.master, self.slave = os.openpty()
+        self.slave_name = os.ttyname(self.slave)
+        self.results = tempfile.NamedTemporaryFile(suffix=".csv", delete=False).name
+        self.old_mode, Cmd.mode = Cmd.mode, "ascii"
+
+    def tearDown(self):
+        Cmd.mode = self.old_mode
+        if self.slave is not None:
+            os.close(self.slave)
+        os.close(self.master)
+        os.remove(self.results)
+        os.remove(spans_filepath(self.results))
+
+    def test_responses_matched_in_order(self):
+        def answers(line):
+            if line == b"confirm":
+                time.sleep(0.05)
+                return b"01\r\nOK00>\r\n"
+            return b"OK00>\r\n"
+
+        responder = PtyResponder(self.master, answers)
+        device = Device("1", self.slave_name, 115200, results_filepath=self.results)
+        os.close(self.slave)
+        self.slave = None
+        try:
+            device.send_receive_pipelined([Sconfirm(enabled=True), Confirm(enabled=True),
+                                           Sevent(enabled=True), Sotaa(enabled=True)], window=4)
+        finally:
+            device.close()
+        self.assertEqual(responder.commands, [b"sconfirm 01", b"confirm", b"sevent 1", b"sOTAA 01"])
+        with open(self.results) as result_file:
+            results = [line.split(",")[-1].strip() for line in result_file.readlines()[1:]]
+        self.assertEqual(results, ["PASSED"] * 5)
+
+
+class TestSimulator(unittest.TestCase):
+
+    def setUp(self):
+        self.results = tempfile.NamedTemporaryFile(suffix=".csv", delete=False).name
+
+    def tearDown(self):
+        os.remove(self.results)
+        os.remove(spans_filepath(self.results))
+
+    def run_commands(self, mode, commands):
+        with DeviceSimulator(mode=mode) as simulator:
+            device = Device("1", simulator.port, 115200, results_filepath=self.results, mode=mode)
+            try:
+                for command in commands:
+                    device.send_receive(command)
+            finally:
+                device.close()
+        with open(self.results) as result_file:
+            return [line.rsplit(",", 1)[-1].strip() for line in result_file.readlines()[1:]]
+
+    def test_ascii(self):
+        results = self.run_commands("ascii", [Ping("PONG!"), Sappeui("12 34 56 78 12 34 56 78"),
+                                              Gappeui("12 34 56 78 12 34 56 78"), Sdevaddr("006cf06d"),
+                                              Gdevaddr("6CF06D")])
+        self.assertEqual(results, ["PASSED"] * 8)
+
+    def test_binary(self):
+        results = self.run_commands("binary", [Ping("PONG!"), Devid("97 4F 2F 6C E9 02 BE 77"),
+                                               Sotaa(enabled=False), Gotaa(enabled=False)])
+        self.assertEqual(results, ["PASSED"] * 4)
+
+    def test_spans(self):
+        self.run_commands("ascii", [Ping("PONG!"), Sappeui("12 34 56 78 12 34 56 78")])
+        with open(spans_filepath(self.results)) as spans_file:
+            spans = [json.loads(line) for line in spans_file]
+        self.assertEqual([span["command"] for span in spans], ["ping", " sAppEUI 12 34 56 78 12 34 56 78"])
+        for span in spans:
+            self.assertLessEqual(span["write"], span["first_byte"])
+            self.assertLessEqual(span["first_byte"], span["response"])
+
+    def test_learned_timeouts(self):
+        timeouts = TimeoutModel(min_samples=3)
+        with DeviceSimulator() as simulator:
+            device = Device("1", simulator.port, 115200, results_filepath=self.results, mode="ascii",
+                            timeouts=timeouts)
+            try:
+                for _ in range(3):
+                    device.send_receive(Ping("PONG!"))
+            finally:
+                device.close()
+        key = (simulator.port, "ping", "ascii", "response")
+        self.assertLess(timeouts.deadline(key, 12), 1)
+        self.assertEqual(timeouts.deadline((simulator.port, "lwjoin", "ascii", "event"), 24), 24)
+
+    def test_pipelined_reads_timed_from_write(self):
+        # The answers of a pipeline are in before their reads start; their
+        # latency still counts from the write, not from the read
+        timeouts = TimeoutModel()
+        with DeviceSimulator(latency=0.05) as simulator:
+            device = Device("1", simulator.port, 115200, results_filepath=self.results, mode="ascii",
+                            timeouts=timeouts)
+            try:
+                device.send_receive_pipelined([Ping("PONG!")] * 4, window=4)
+            finally:
+                device.close()
+        samples = timeouts.samples[(simulator.port, "ping", "ascii", "return")]
+        self.assertEqual(len(samples), 4)
+        self.assertGreaterEqual(min(samples), 0.04)
+
+    def test_read_event_returns_on_match(self):
+        with DeviceSimulator(join_delay=0.1) as simulator:
+            device = Device("1", simulator.port, 115200, results_filepath=self.results, mode="ascii")
+            try:
+                device.send_command("lwjoin")
+                device.read_response()
+                with mock.patch.object(device, "read_message", wraps=device.read_message) as read_message:
+                    result = device.read_event("EVENT Joined network", timeout=10)  # Joining is skipped
+                self.assertEqual(result["Result"], "PASSED")
+                self.assertEqual(read_message.call_count, 2)  # Joining, Joined: no read after the match
+            finally:
+                device.close()
+
+    def test_read_event_stops_at_error(self):
+        with DeviceSimulator(error_rate=1.0, error_codes=("ERFA>",)) as simulator:
+            device = Device("1", simulator.port, 115200, results_filepath=self.results, mode="ascii")
+            try:
+                device.send_command("lwjoin")
+                with mock.patch.object(device, "read_message", wraps=device.read_message) as read_message:
+                    result = device.read_event("EVENT Joined network", timeout=10)
+                self.assertEqual((result["Actual"], result["Result"]), ("ERFA>", "FAILED"))
+                self.assertEqual(read_message.call_count, 1)
+            finally:
+                device.close()
+
+    def test_identity_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir, DeviceSimulator() as simulator:
+            device = Device("1", simulator.port, 115200, results_filepath=self.results, mode="ascii")
+            device.identities = cache = IdentityCache(os.path.join(cache_dir, "identity.json"))
+            try:
+                device.identify()  # A pty has no USB serial number: queried, not cached
+                self.assertEqual(device.devtype, "AM093 simulator")
+                self.assertIsNone(cache.key(simulator.port))
+                self.assertFalse(os.path.exists(cache.filepath))
+
+                with mock.patch("hello.identity.usb_serial_number", return_value="A1B2C3"):
+                    key = cache.key(simulator.port)
+                    cache.put(key, ["IDN: AM093 simulator", "EXECUTIVE VER: 0.9.0", "RF STACK  VER: 1.0.0"])
+                    device.identify(refresh=True)  # Firmware changed: queried, cache refreshed
+                    self.assertEqual(device.execversion, " 1.0.0")
+                    self.assertEqual(IdentityCache(cache.filepath).get(key)[1], "EXECUTIVE VER: 1.0.0")
+
+                    del simulator.received[:]
+                    device.identify()  # Known board: no query
+                    self.assertEqual(simulator.received, [])
+                    self.assertEqual(device.devtype, "AM093 simulator")
+            finally:
+                device.close()
+
+    def test_wake(self):
+        for mode in ("ascii", "binary"):
+            with DeviceSimulator(mode=mode) as simulator:
+                device = Device("1", simulator.port, 115200, results_filepath=self.results, mode=mode)
+                try:
+                    with mock.patch.object(device, "read_frame", wraps=device.read_frame) as read_frame:
+                        self.assertTrue(device.wake(8))
+                    self.assertEqual(read_frame.call_count, 8)  # Done at the last prompt, no wait for quiet
+                    device.send_receive(Ping("PONG!"))  # No wake-up answers left over
+                    self.assertEqual(device.device_result["Result"], "PASSED")
+                finally:
+                    device.close()
+
+    def test_wake_silent_board(self):
+        with DeviceSimulator(latency=1) as simulator:
+            device = Device("1", simulator.port, 115200, results_filepath=self.results, mode="ascii")
+            try:
+                self.assertFalse(device.wake(2, timeout=0.3))
+            finally:
+                device.close()
+
+    def test_send_payloads(self):
+        sizes = (1, 51, 115, 222)
+        events = {"ascii": "EVENT Message transmitted",
+                  "binary": (b"\x1bS" + b"Message transmitted" + b"\x1bT").hex(" ").upper()}
+        for mode in ("ascii", "binary"):
+            with DeviceSimulator(mode=mode, tx_delay=0) as simulator:
+                simulator.params["confirm"] = b"\x00"
+                device = Device("1", simulator.port, 115200, results_filepath=self.results, mode=mode)
+                try:
+                    payloads = ("ABCDEFGHIJ"[size % 10] * size for size in sizes)
+                    self.assertEqual(device.send_payloads(payloads, chunk_size=32, event=events[mode]), len(sizes))
+                finally:
+                    device.close()
+            if mode == "binary":
+                sent = [args.decode() for _, name, args in simulator.received if name == "sendb"]
+            else:
+                sent = [args for _, name, args in simulator.received if name == "sendb string"]
+            self.assertEqual(sent, ["ABCDEFGHIJ"[size % 10] * size for size in sizes])
+        with open(self.results) as result_file:
+            results = [line.rsplit(",", 1)[-1].strip() for line in result_file.readlines()[1:]]
+        # Per payload: "$" prompt (text only), response, event
+        self.assertEqual(results, ["PASSED"] * (3 * len(sizes) + 2 * len(sizes)))
+
+    def test_wait_for_any_event(self):
+        with DeviceSimulator(tx_delay=0.05) as simulator:
+            device = Device("1", simulator.port, 115200, results_filepath=self.results, mode="ascii")
+            try:
+                device.send_receive(SendBytes(5, "12345"))
+                match = device.wait_event(EventMatcher(["EVENT Message transmitted",
+                                                        "EVENT Confirmed message transmitted"]), timeout=2)
+                self.assertEqual((match.kind, match.name), (EXPECTED, "EVENT Message transmitted"))
+            finally:
+                device.close()
+
+    def test_error_injection(self):
+        with DeviceSimulator(error_rate=1.0, error_codes=("ERFA>",)) as simulator:
+            device = Device("1", simulator.port, 115200, results_filepath=self.results)
+            try:
+                device.send_command("ping")
+                self.assertEqual(device.read_response(check_response=False)["Actual"], "ERFA>")
+            finally:
+                device.close()
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_percentile(self):
+        samples = [5, 1, 4, 2, 3]
+        self.assertEqual(benchmark.percentile(samples, 50), 3)
+        self.assertEqual(benchmark.percentile(samples, 99), 5)
+        self.assertIsNone(benchmark.percentile([], 50))
+
+    def test_rows(self):
+        rows = benchmark.benchmark(modes=["binary"], families=["set", "get"], iterations=2)
+        self.assertEqual([(row["transport"], row["mode"], row["family"], row["commands"]) for row in rows],
+                         [("serial", "binary", "set", 2), ("serial", "binary", "get", 2)])
+        self.assertTrue(all(row["p50_ms"] <= row["p99_ms"] for row in rows))
+
+    def test_roundtrips(self):
+        rows = benchmark.roundtrips(transports=["fd", "tcp"], iterations=3)
+        self.assertEqual([(row["transport"], row["roundtrips"]) for row in rows], [("fd", 3), ("tcp", 3)])
+
+
+class TestDevicePool(unittest.TestCase):
+
+    def setUp(self):
+        self.results_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.results_dir.cleanup()
+
+    def test_lease_reuses_the_open_device(self):
+        first, second = (os.path.join(self.results_dir.name, name) for name in ("first.csv", "second.csv"))
+        with DeviceSimulator() as simulator:
+            pool = DevicePool({"device1": {"port": simulator.port, "baudrate": 115200}})
+            try:
+                device = pool.lease("device1", first)
+                device.codec.mode = "ascii"
+                device.send_receive(Ping("PONG!"))
+                with self.assertRaises(Exception):
+                    pool.lease("device1", second)
+                device.send_receive(Sappeui("12 34 56 78 12 34 56 78"))
+                self.assertTrue(device.shadow.values)
+                pool.release("device1")
+                self.assertIs(pool.lease("device1", second), device)
+                self.assertFalse(device.shadow.values)  # Not trusted across tests
+                device.send_receive(Ping("PONG!"))
+                pool.release("device1")
+                self.assertIs(pool.lease("device1", first), device)
+                device.send_receive(Ping("PONG!"))
+            finally:
+                pool.close()
+        self.assertEqual([name for _, name, _ in simulator.received].count("version"), 1)
+        with open(first) as result_file:
+            self.assertEqual(result_file.read().count("DeviceID"), 1)  # One header for both leases
+
+
+class TestParserMode(unittest.TestCase):
+
+    def setUp(self):
+        self.results_dir = tempfile.TemporaryDirectory()
+        parser_modes.modes.clear()
+
+    def tearDown(self):
+        parser_modes.modes.clear()
+        self.results_dir.cleanup()
+
+    def test_detected_concurrently_and_remembered(self):
+        with DeviceSimulator(mode="ascii") as ascii_sim, DeviceSimulator(mode="binary") as binary_sim:
+            devices = [Device(str(number), simulator.port, 115200,
+                              results_filepath=os.path.join(self.results_dir.name, "results.csv"))
+                       for number, simulator in enumerate((ascii_sim, binary_sim))]
+            try:
+                modes = detect_parser_modes(devices)
+                self.assertEqual(modes, {ascii_sim.port: "ascii", binary_sim.port: "binary"})
+                received = len(ascii_sim.received) + len(binary_sim.received)
+                self.assertEqual(detect_parser_modes(devices), modes)
+                self.assertEqual(len(ascii_sim.received) + len(binary_sim.received), received)
+            finally:
+                for device in devices:
+                    device.close()
+
+    def test_probes_not_timed(self):
+        timeouts = TimeoutModel()
+        with DeviceSimulator(mode="binary") as simulator:
+            device = Device("1", simulator.port, 115200, timeouts=timeouts,
+                            results_filepath=os.path.join(self.results_dir.name, "results.csv"))
+            try:
+                self.assertEqual(detect_parser_modes([device]), {simulator.port: "binary"})
+            finally:
+                device.close()
+        self.assertEqual(timeouts.samples, {})  # Not even the silence of the ascii ping
+
+    def test_switch_remembered_once_confirmed(self):
+        for current, target in (("ascii", "binary"), ("binary", "ascii")):
+            with self.subTest(target=target), DeviceSimulator(mode=current) as simulator:
+                device = Device("1", simulator.port, 115200, mode=current,
+                                results_filepath=os.path.join(self.results_dir.name, f"{target}.csv"))
+                try:
+                    set_parser_mode(device, current, target)
+                finally:
+                    device.close()
+                self.assertEqual(simulator.mode, target)
+                self.assertEqual(parser_modes.get(simulator.port), target)
+
+    def test_undetected_mode_not_remembered(self):
+        with DeviceSimulator(mode="ascii") as simulator:
+            device = Device("1", simulator.port, 115200, results_filepath=os.path.join(self.results_dir.name, "r.csv"))
+            try:
+                set_parser_mode(device, None, "ascii")
+            finally:
+                device.close()
+            self.assertEqual(device.codec.mode, "ascii")
+            self.assertIsNone(parser_modes.get(simulator.port))
+
+    def test_mismatch(self):
+        self.assertFalse(parser_mismatch("ascii", ""))
+        self.assertTrue(parser_mismatch("ascii", "1B 51 FE"))
+        self.assertTrue(parser_mismatch("binary", "ERFE>"))
+        self.assertFalse(parser_mismatch("ascii", "ERFA>"))
+        self.assertFalse(parser_mismatch("binary", "1B 50 1B 51 01"))
+        self.assertFalse(parser_mismatch("ascii", None))
+
+
+class TestTransports(unittest.TestCase):
+
+    def setUp(self):
+        self.results_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.results_dir.cleanup()
+
+    def ping(self, port, transport):
+        results = os.path.join(self.results_dir.name, f"{type(transport).__name__}.csv")
+        device = Device("1", port, 115200, results_filepath=results, mode="ascii", transport=transport)
+        try:
+            device.send_receive(Ping("PONG!"))
+        finally:
+            device.close()
+        with open(results) as result_file:
+            return [line.rsplit(",", 1)[-1].strip() for line in result_file.readlines()[1:]]
+
+    def test_simulated_transports(self):
+        for kind in ("serial", "fd", "pty", "tcp"):
+            with self.subTest(kind=kind), contextlib.ExitStack() as stack:
+                simulator = stack.enter_context(DeviceSimulator())
+                self.assertEqual(self.ping(simulator.port, benchmark.open_simulated(stack, simulator, kind)),
+                                 ["PASSED", "PASSED"])
+
+    def test_memory_pair(self):
+        port, board = MemoryTransport.pair()
+
+        def answer():
+            command = b""
+            while not command.endswith(b"\r\n"):
+                command += board.read_chunk()
+            if command == b"ping\r\n":
+                board.write(b"PONG!\r\nOK00>\r\n")
+
+        responder = threading.Thread(target=answer, daemon=True)
+        responder.start()
+        self.assertEqual(self.ping(port.port, port), ["PASSED", "PASSED"])
+        responder.join(1)
+        self.assertEqual(port.in_waiting, 0)
+
+    def test_close_wakes_a_read(self):
+        with DeviceSimulator() as simulator:
+            port = FdTransport(simulator.port, timeout=None)
+            errors = []
+
+            def read():
+                try:
+                    port.read_chunk()
+                except OSError as error:
+                    errors.append(error)
+
+            reader = threading.Thread(target=read)
+            reader.start()
+            time.sleep(0.05)
+            port.close()
+            reader.join(1)
+            self.assertFalse(reader.is_alive())
+            self.assertEqual(len(errors), 1)
+
+    def test_reset_between_select_and_read(self):
+        # Input flushed by reset_input_buffer() after the select() of a
+        # read: the read comes back empty instead of blocking
+        for kind in ("fd", "tcp"):
+            with self.subTest(kind=kind), contextlib.ExitStack() as stack:
+                simulator = stack.enter_context(DeviceSimulator())
+                port = benchmark.open_simulated(stack, simulator, kind)
+                port.write(b"ping\r\n")
+                time.sleep(0.1)  # The answer is in
+                wait_readable, readable = port._wait_readable, []
+
+                def flushed():
+                    readable.append(wait_readable())
+                    port.reset_input_buffer()
+                    return readable[-1]
+
+                port._wait_readable = flushed
+                chunks = []
+                reader = threading.Thread(target=lambda: chunks.append(port.read_chunk()), daemon=True)
+                reader.start()
+                reader.join(2)
+                self.assertEqual((readable, chunks), ([True], [b""]))
+                port.close()
+
+    def test_open_transport(self):
+        with DeviceSimulator() as simulator:
+            self.assertIsInstance(open_transport(simulator.port, 115200, 0.2), serial.Serial)
+            with self.assertRaises(ValueError):
+                open_transport(simulator.port, 115200, 0.2, "carrier pigeon")
+
+
+class TestReactor(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.work_dir.name)  # FlowTestExecutor writes its results here
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.work_dir.cleanup()
+
+    def test_flow(self):
+        directives = ["[1]&", "[2]&", "[1]>ping", "[1]#PONG!", "[1]~", "[2]>ping", "[2]#PONG!", "[2]~", "@B",
+                      "[1]>lwjoin", "[1]~", "[1]?EVENT Joined network",
+                      "[2]>sendb 05", "[2]$12345", "[2]~", "[2]?EVENT Message transmitted"]
+        with DeviceSimulator(join_delay=1) as first, DeviceSimulator(latency=0.1) as second:
+            executor = ReactorFlowExecutor("reactor", directives, [first.port, 115200, second.port, 115200], guard=0)
+            executor.run()
+        with open(next(name for name in os.listdir() if name.startswith("Result_"))) as result_file:
+            rows = [line.strip().split(",") for line in result_file.readlines()[1:]]
+        # The lanes wait at the same time: the second one is done while the
+        # first still waits for its join
+        self.assertEqual([(row[0], row[-1]) for row in rows if row[-1]], [
+            ("1", "PASSED"), ("1", "PASSED"), ("2", "PASSED"), ("2", "PASSED"),
+            ("1", "PASSED"), ("2", "PASSED"), ("2", "PASSED"), ("2", "PASSED"), ("1", "PASSED")])
+        self.assertEqual(rows[0][1], "AM093 simulator")  # Identified
+        self.assertEqual(executor.latency_summary()["answers"], 4)
+
+    def test_timeout(self):
+        with DeviceSimulator() as simulator:
+            reactor = Reactor()
+            device = ReactorDevice("1", simulator.port, 115200, guard=0)
+            reactor.add(device)
+            rows = []
+            device.start([(0, "[1]#never")], rows.append)
+            old_timeout, test_executor.return_timeout = test_executor.return_timeout, 0.1
+            try:
+                reactor.run()
+            finally:
+                test_executor.return_timeout = old_timeout
+                reactor.close()
+        self.assertEqual((rows[0]["Actual"], rows[0]["Result"]), ("", "FAILED"))
+
+    def test_write_waits_in_selector(self):
+        # A write larger than the pty buffer waits for room in the selector,
+        # and the other boards are served meanwhile
+        master, slave = os.openpty()
+        reactor = Reactor()
+        rows = []
+        try:
+            with DeviceSimulator() as simulator:
+                slow = ReactorDevice("1", os.ttyname(slave), 115200, guard=0,
+                                     transport=open_transport(os.ttyname(slave), 115200, 0, kind="pty"))
+                fast = ReactorDevice("2", simulator.port, 115200, guard=0)
+                reactor.add(slow)
+                reactor.add(fast)
+                command = "x" * 65536
+                slow.start([(0, f"[1]>{command}"), (1, "[1]~")], rows.append)
+                fast.start([(2, "[2]>ping"), (3, "[2]#PONG!"), (4, "[2]~")], rows.append)
+
+                def board():
+                    # Takes the long command only once the other board has answered
+                    deadline = time.monotonic() + 5
+                    while len(rows) < 2 and time.monotonic() < deadline:
+                        time.sleep(0.01)
+                    received = b""
+                    while not received.endswith(b"\r\n"):
+                        received += os.read(master, 65536)
+                    os.write(master, b"OK00>\r\n")
+
+                responder = threading.Thread(target=board, daemon=True)
+                responder.start()
+                reactor.run()
+                responder.join(5)
+        finally:
+            reactor.close()
+            os.close(master)
+            os.close(slave)
+        results = [(row["DeviceID"], row["Result"]) for row in rows if row["Result"] != "Discard"]
+        self.assertEqual(results, [("2", "PASSED"), ("2", "PASSED"), ("1", "PASSED")])
+
+    def test_scaling(self):
+        rows = benchmark.scaling(counts=[4], iterations=3)
+        self.assertEqual([(row["devices"], row["commands"], row["passed"]) for row in rows], [(4, 12, 12)])
+
+
+class TestMux(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.work_dir.name, "mux.sock")
+        self.results = os.path.join(self.work_dir.name, "results.csv")
+
+    def tearDown(self):
+        self.work_dir.cleanup()
+
+    def test_lease_and_share(self):
+        with DeviceSimulator() as simulator, \
+                MuxDaemon({"device1": {"port": simulator.port, "baudrate": 115200}}, self.socket_path) as daemon:
+            port = daemon.ports["device1"].transport
+            for _ in range(2):
+                device = Device("1", mux_url(self.socket_path, "device1"), 115200, results_filepath=self.results,
+                                mode="ascii")
+                try:
+                    device.send_receive(Ping("PONG!"))
+                    with self.assertRaises(OSError):
+                        MuxTransport(self.socket_path, "device1", wait=0.1)  # Leased to device
+                finally:
+                    device.close()
+            self.assertIs(daemon.ports["device1"].transport, port)  # Opened once
+        with open(self.results) as result_file:
+            self.assertEqual([line.rsplit(",", 1)[-1].strip() for line in result_file.readlines()[1:]],
+                             ["PASSED"] * 4)
+
+    def test_waiting_lease(self):
+        with DeviceSimulator() as simulator, \
+                MuxDaemon({"device1": {"port": simulator.port, "baudrate": 115200}}, self.socket_path):
+            first = MuxTransport(self.socket_path, "device1")
+            leases = []
+            waiting = threading.Thread(target=lambda: leases.append(MuxTransport(self.socket_path, "device1", wait=5)))
+            waiting.start()
+            time.sleep(0.1)
+            self.assertEqual(leases, [])
+            first.close()
+            waiting.join(5)
+            self.assertEqual(len(leases), 1)
+            second = leases[0]
+            second.write(b"ping\r\n")
+            answer = b""
+            while not answer.endswith(b"OK00>\r\n"):
+                answer += second.read_chunk()
+            self.assertEqual(answer, b"PONG!\r\nOK00>\r\n")
+            second.close()
+
+    def test_command(self):
+        with DeviceSimulator() as simulator, \
+                MuxDaemon({"device1": {"port": simulator.port, "baudrate": 115200}}, self.socket_path):
+            transport = MuxTransport(self.socket_path, "device1")
+            try:
+                self.assertEqual(transport.command(b"ping\r\n"), b"PONG!\r\nOK00>\r\n")
+                self.assertEqual(transport.command(b"lwjoin\r\n"), b"OK00>\r\n")
+                events = b""
+                while not events.endswith(b"EVENT Joined network\r\n"):
+                    events += transport.read_chunk()  # Input after the answer is relayed
+                self.assertTrue(events.startswith(b"EVENT Joining"))
+                self.assertEqual(transport.command(b"pi", timeout=0.2), b"")  # No end of line, no answer
+            finally:
+                transport.close()
+
+    def test_unknown_device(self):
+        with DeviceSimulator() as simulator, \
+                MuxDaemon({"device1": {"port": simulator.port, "baudrate": 115200}}, self.socket_path):
+            with self.assertRaises(OSError):
+                MuxTransport(self.socket_path, "device9")
+
+
+class TestFarmLease(unittest.TestCase):
+
+    def setUp(self):
+        self.lock_dir = tempfile.TemporaryDirectory()
+        self.inventory = {"lock_dir": self.lock_dir.name, "pairs": [
+            {"device1": {"port": f"/dev/ttyUSB{2 * pair}", "baudrate": 115200},
+             "device2": {"port": f"/dev/ttyUSB{2 * pair + 1}", "baudrate": 115200}} for pair in range(2)]}
+
+    def tearDown(self):
+        self.lock_dir.cleanup()
+
+    def test_disjoint_pairs(self):
+        first, second, third = (FarmLease(self.inventory, owner=f"gw{number}", poll=0.05) for number in range(3))
+        self.assertEqual(first.acquire()["device1"]["port"], "/dev/ttyUSB0")
+        self.assertEqual(second.acquire()["device1"]["port"], "/dev/ttyUSB2")
+        with self.assertRaises(Exception):
+            third.acquire()  # Both pairs leased
+        first.release()
+        self.assertEqual(third.acquire()["device1"]["port"], "/dev/ttyUSB0")
+        second.release()
+        third.release()
+
+    def test_wait_for_a_pair(self):
+        holders = [FarmLease(self.inventory, owner=f"gw{number}") for number in range(2)]
+        for holder in holders:
+            holder.acquire()
+        waiting = FarmLease(self.inventory, owner="gw2", wait=5, poll=0.05)
+        threading.Timer(0.1, holders[1].release).start()
+        self.assertEqual(waiting.acquire()["device2"]["port"], "/dev/ttyUSB3")
+        holders[0].release()
+        waiting.release()
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.transcript = os.path.join(self.work_dir.name, "session.jsonl")
+
+    def tearDown(self):
+        self.work_dir.cleanup()
+
+    def session(self, port, transport):
+        results = os.path.join(self.work_dir.name, f"{type(transport).__name__}.csv")
+        device = Device("1", port, 115200, results_filepath=results, mode="ascii", transport=transport)
+        try:
+            device.send_receive(Ping("PONG!"))
+            device.send_receive_pipelined([Sappeui("12 34 56 78 12 34 56 78"), Gappeui("12 34 56 78 12 34 56 78")])
+            device.send_receive(SendBytes(5, "12345"))
+            device.read_event("EVENT Message transmitted")
+        finally:
+            device.close()
+        with open(results) as result_file:
+            return [line.rsplit(",", 1)[-1].strip() for line in result_file.readlines()[1:]]
+
+    def test_record_and_replay(self):
+        with DeviceSimulator() as simulator:
+            port = replay.RecordingPort(serial.Serial(simulator.port, 115200, timeout=0.2), self.transcript)
+            recorded = self.session(simulator.port, port)
+        self.assertEqual(set(recorded), {"PASSED"})
+        _, chunks = replay.load_transcript(self.transcript)
+        self.assertEqual(chunks[0][1:], ("w", b"ping\r\n"))
+
+        replay_port = replay.ReplayPort(self.transcript)
+        replayed = self.session(simulator.port, replay_port)
+        self.assertEqual(replay_port.written, b"".join(data for _, direction, data in chunks if direction == "w"))
+        self.assertTrue(replay_port.finished)
+        self.assertEqual(replayed, recorded)
+
+
+class TestStateShadow(unittest.TestCase):
+
+    def setUp(self):
+        self.results = tempfile.NamedTemporaryFile(suffix=".csv", delete=False).name
+
+    def tearDown(self):
+        os.remove(self.results)
+        os.remove(spans_filepath(self.results))
+
+    def test_redundant_sets_elided(self):
+        with DeviceSimulator() as simulator:
+            device = Device("1", simulator.port, 115200, results_filepath=self.results, mode="ascii")
+            try:
+                device.send_receive(Lorawan())
+                # The second sevent is not compared with the value before the first
+                device.send_receive_pipelined([Sevent(enabled=False), Sevent(enabled=True), Sotaa(enabled=True)])
+                device.send_receive_pipelined([Sevent(enabled=True), Sotaa(enabled=True),
+                                               Sappeui("12 34 56 78 12 34 56 78")])
+                device.send_receive(Sappeui("1234567812345678"))
+                device.send_receive(Lorawan())  # Same stack, the parameters stay known
+                device.send_receive(Sotaa(enabled=True))
+                device.send_receive(Reset())
+                device.send_receive(Sotaa(enabled=True))
+                device.send_receive(Gotaa(enabled=True))
+            finally:
+                device.close()
+            self.assertEqual([command for _, command, _ in simulator.received],
+                             ["lorawan", "sevent", "sevent", "sotaa", "sappeui", "lorawan", "reset", "sotaa", "gotaa"])
+        self.assertEqual(device.shadow.elided, 4)
+        with open(self.results) as result_file:
+            results = [line.rsplit(",", 1)[-1].strip() for line in result_file.readlines()[1:]]
+        self.assertEqual(set(results), {"PASSED"})
+
+    def test_stack_query_keeps_shadow_binary(self):
+        with DeviceSimulator(mode="binary") as simulator:
+            device = Device("1", simulator.port, 115200, results_filepath=self.results, mode="binary")
+            try:
+                for _ in range(3):
+                    device.send_receive(Lorawan())
+                    device.send_receive(Stack("lorawan"))
+                    device.send_receive(Sotaa(enabled=True))
+            finally:
+                device.close()
+            self.assertEqual([command for _, command, _ in simulator.received],
+                             ["lorawan", "stack", "sotaa", "lorawan", "stack", "lorawan", "stack"])
+        self.assertEqual(device.shadow.elided, 2)
+
+    def test_text_command_invalidates(self):
+        with DeviceSimulator() as simulator:
+            device = Device("1", simulator.port, 115200, results_filepath=self.results, mode="ascii")
+            try:
+                device.send_receive(Sotaa(enabled=True))
+                device.send_command("sOTAA 00")
+                device.read_response()
+                device.send_receive(Sotaa(enabled=True))
+            finally:
+                device.close()
+            self.assertEqual([args for _, command, args in simulator.received if command == "sotaa"],
+                             ["01", "00", "01"])
+
+
+class TestAsyncDevice(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.master, slave = os.openpty()
+        self.slave_name = os.ttyname(slave)
+        os.close(slave)
+        self.results = tempfile.NamedTemporaryFile(suffix=".csv", delete=False).name
+        self.old_mode, Cmd.mode = Cmd.mode, "ascii"
+
+    async def asyncTearDown(self):
+        Cmd.mode = self.old_mode
+        os.close(self.master)
+        os.remove(self.results)
+
+    async def test_send_receive(self):
+        loop = asyncio.get_running_loop()
+        received = []
+
+        def answer():
+            received.append(os.read(self.master, 1024))
+            os.write(self.master, b"PONG!\r\nOK00>\r\n")
+
+        loop.add_reader(self.master, answer)
+        try:
+            async with AsyncDevice("1", self.slave_name, 115200, results_filepath=self.results) as device:
+                await device.send_receive(Ping("PONG!"))
+                self.assertEqual(device.device_result["Result"], "PASSED")
+        finally:
+            loop.remove_reader(self.master)
+        self.assertEqual(received, [b"ping\r\n"])
+
+    async def test_read_timeout(self):
+        async with AsyncDevice("1", self.slave_name, 115200, results_filepath=self.results) as device:
+            self.assertIsNone(await device.read_frame(0.1))
+
+    async def test_recorded_and_timed(self):
+        # The port is opened like the ports of Device: recorded with
+        # record_dir, and the reads feed the timeout model
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.master, lambda: os.read(self.master, 1024) and os.write(self.master, b"PONG!\r\nOK00>\r\n"))
+        timeouts = TimeoutModel()
+        try:
+            with tempfile.TemporaryDirectory() as record_dir, mock.patch.object(replay, "record_dir", record_dir):
+                device = AsyncDevice("1", self.slave_name, 115200, results_filepath=self.results, timeouts=timeouts)
+                device.reset_input_buffer()  # Before open() too
+                async with device:
+                    await device.send_receive(Ping("PONG!"))
+                [transcript] = os.listdir(record_dir)
+                _, chunks = replay.load_transcript(os.path.join(record_dir, transcript))
+        finally:
+            loop.remove_reader(self.master)
+        self.assertEqual(b"".join(data for _, direction, data in chunks if direction == "w"), b"ping\r\n")
+        self.assertEqual(b"".join(data for _, direction, data in chunks if direction == "r"), b"PONG!\r\nOK00>\r\n")
+        self.assertEqual(len(timeouts.samples[(self.slave_name, "ping", "ascii", "response")]), 1)
+
+    async def test_shared_results(self):
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.master, lambda: os.read(self.master, 1024) and os.write(self.master, b"PONG!\r\nOK00>\r\n"))
+        try:
+            async with AsyncDevice("1", self.slave_name, 115200, results_filepath=self.results) as device:
+                await device.send_receive(Ping("PONG!"))
+        finally:
+            loop.remove_reader(self.master)
+        # A second device on the same file adds to the rows of the first
+        async with AsyncDevice("2", self.slave_name, 115200, results_filepath=self.results):
+            pass
+        with open(self.results, newline="") as result_file:
+            rows = list(csv.DictReader(result_file))
+        self.assertEqual([(row["DeviceID"], row["Result"]) for row in rows], [("1", "PASSED")] * 2)
@@ -0,0 +1,62 @@
+# Read deadlines learned from observed latencies. Every successful read
+# records the latency of its answer, from the write of the command; once
+# a key has enough samples its deadline is a high percentile of them plus
+# a margin, so fast commands fail fast and slow ones (lwjoin and its
+# events) get the time they actually take. Until then the legacy fixed
+# budgets are used. A read that timed out counts as a sample of the time
+# it waited, a lower bound of the latency, so after a miss the deadline
+# grows by the margin instead of staying too short.
+
+import math
+import threading
+from collections import deque
+
+
+def percentile(samples, q):
+    """Nearest-rank percentile, q in 0..100"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class TimeoutModel(object):
+    """
+    Latency samples per key, e.g. (port, command, mode, read kind).
+    deadline = percentile(quantile) * (1 + margin) + slack, in seconds.
+    """
+
+    def __init__(self, quantile=99.9, margin=0.5, slack=0.2, min_samples=20, window=1000):
+        self.quantile = quantile
+        self.margin = margin
+        self.slack = slack
+        self.min_samples = min_samples
+        self.window = window
+        self.samples = {}
+        self.deadlines = {}  # Cache, dropped for a key when it gets a sample
+        self.lock = threading.Lock()  # Shared by the devices of concurrent lanes
+
+    def observe(self, key, latency):
+        with self.lock:
+            self.samples.setdefault(key, deque(maxlen=self.window)).append(latency)
+            self.deadlines.pop(key, None)
+
+    def miss(self, key, waited):
+        """A read of key that gave up after waited seconds"""
+        self.observe(key, waited)
+
+    def deadline(self, key, default):
+        """Learned deadline for key, or default while there are too few samples"""
+        with self.lock:
+            if key not in self.deadlines:
+                samples = self.samples.get(key, ())
+                if len(samples) < self.min_samples:
+                    return default
+                self.deadlines[key] = percentile(samples, self.quantile) * (1 + self.margin) + self.slack
+            return self.deadlines[key]
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+            self.deadlines.clear()
@@ -0,0 +1,480 @@
+# Transports a Device talks to its board through. All of them look like a
+# serial.Serial to Device: read(size), write(data), in_waiting, flush(),
+# reset_input_buffer(), close() and fileno() where there is a descriptor.
+# The native ones also have read_chunk(), which returns everything that
+# arrived within the timeout with one select() and one read, where pyserial
+# needs a read of the first byte and another one for the rest.
+#
+#   serial  pyserial, the default
+#   fd      raw termios descriptor, select() and os.read()
+#   pty     the same on a pseudo-terminal, which has no line speed
+#   tcp     ser2net-style TCP port, chosen by a socket://host:port url
+#   memory  connected pair in memory, for unit tests (MemoryTransport.pair())
+#   mux     board leased from a hello.mux daemon, chosen by a
+#           mux://<socket path>#<device name> url
+#
+# The default kind is $HELLO_TRANSPORT, or --transport in pytest.
+# fd, pty and mux need a POSIX system; elsewhere there are serial and tcp.
+
+import errno
+import json
+import os
+import select
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+import serial
+
+try:
+    import fcntl
+    import termios
+    import tty
+except ImportError:  # Windows
+    fcntl = termios = tty = None
+
+default_kind = os.environ.get("HELLO_TRANSPORT", "serial")
+
+CHUNK_SIZE = 4096
+URL_SCHEMES = ("socket://", "tcp://")
+MUX_SCHEME = "mux://"
+
+# Frames between a hello.mux daemon and its clients: a type byte, the
+# length of the payload (4 bytes, big endian) and the payload
+MUX_HEADER = struct.Struct(">cI")
+MUX_LEASE = b"L"  # Client: {"device": name, "wait": seconds}, answered by MUX_OK {"port", "baudrate"} or MUX_ERROR
+MUX_WRITE = b"W"  # Client: bytes for the port
+MUX_DATA = b"D"  # Daemon: bytes from the port
+MUX_RESET = b"R"  # Client: drop unread input, answered by MUX_OK once the port is flushed
+MUX_RELEASE = b"X"  # Client: done with the board
+MUX_COMMAND = b"C"  # Client: {"data": hex, "timeout": seconds}, answered by MUX_ANSWER
+MUX_ANSWER = b"A"  # Daemon: the port input up to the response to a MUX_COMMAND
+MUX_OK = b"K"
+MUX_ERROR = b"E"
+
+
+def _bytes_waiting(fd):
+    return struct.unpack("I", fcntl.ioctl(fd, termios.FIONREAD, b"\0\0\0\0"))[0]
+
+
+class FdTransport(object):
+    """
+    Serial port opened as a raw termios descriptor. Reads wait in select()
+    for at most timeout seconds; close() wakes a waiting read up. The
+    descriptor is non-blocking, so a read whose input was flushed between
+    the select() and the read comes back empty instead of hanging.
+    """
+
+    def __init__(self, port, baudrate=115200, timeout=0.2):
+        if termios is None:
+            raise OSError(errno.ENOTSUP, "The fd and pty transports need termios")
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.fd = os.open(port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        try:
+            self._configure()
+        except (OSError, termios.error, ValueError):
+            os.close(self.fd)
+            raise
+        self.cancel_read, self.cancel_write = os.pipe()
+        self.lock = threading.Lock()  # Held by a read, so close() cannot pull the fd from under it
+        self.is_open = True
+
+    def _configure(self):
+        tty.setraw(self.fd)
+        attributes = termios.tcgetattr(self.fd)
+        attributes[2] |= termios.CLOCAL | termios.CREAD
+        attributes[2] &= ~getattr(termios, "CRTSCTS", 0)
+        speed = self._speed()
+        if speed is not None:
+            attributes[4] = attributes[5] = speed
+        termios.tcsetattr(self.fd, termios.TCSANOW, attributes)
+
+    def _speed(self):
+        speed = getattr(termios, f"B{self.baudrate}", None)
+        if speed is None:
+            raise ValueError(f"Unsupported baudrate {self.baudrate}")
+        return speed
+
+    def _wait_readable(self):
+        if not self.is_open:
+            raise OSError(errno.EBADF, "Port closed")
+        readable, _, _ = select.select([self.fd, self.cancel_read], [], [], self.timeout)
+        if self.cancel_read in readable or not self.is_open:
+            raise OSError(errno.EBADF, "Port closed")
+        return bool(readable)
+
+    def read(self, size=1):
+        with self.lock:
+            if not self._wait_readable():
+                return b""
+            try:
+                return os.read(self.fd, size)
+            except BlockingIOError:
+                return b""  # Flushed by reset_input_buffer() meanwhile
+
+    def read_chunk(self):
+        return self.read(CHUNK_SIZE)
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(self.fd, view):]
+            except BlockingIOError:
+                select.select([], [self.fd], [])
+        return len(data)
+
+    def fileno(self):
+        return self.fd
+
+    @property
+    def in_waiting(self):
+        return _bytes_waiting(self.fd)
+
+    def flush(self):
+        termios.tcdrain(self.fd)
+
+    def reset_input_buffer(self):
+        termios.tcflush(self.fd, termios.TCIFLUSH)
+
+    def close(self):
+        if not self.is_open:
+            return
+        self.is_open = False
+        os.write(self.cancel_write, b"\0")
+        with self.lock:
+            os.close(self.fd)
+            os.close(self.cancel_read)
+            os.close(self.cancel_write)
+
+
+class PtyTransport(FdTransport):
+    """
+    FdTransport on a pseudo-terminal, e.g. the simulator. The baudrate is
+    only kept: a pty has no line speed and some systems refuse to set one.
+    """
+
+    def _speed(self):
+        return None
+
+
+class TcpTransport(object):
+    """
+    Serial port served over TCP by ser2net or the like, as raw bytes.
+    Nagle is off, so each command goes out as soon as it is written.
+    """
+
+    def __init__(self, host, port, timeout=0.2, connect_timeout=5):
+        self.host = host
+        self.port = f"socket://{host}:{port}"
+        self.timeout = timeout
+        self.socket = socket.create_connection((host, port), timeout=connect_timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.settimeout(None)
+        self.is_open = True
+
+    def _wait_readable(self):
+        if not self.is_open:
+            raise OSError(errno.EBADF, "Connection closed")
+        readable, _, _ = select.select([self.socket], [], [], self.timeout)
+        return bool(readable)
+
+    def read(self, size=1):
+        if not self._wait_readable():
+            return b""
+        try:
+            data = self.socket.recv(size, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return b""  # Drained by reset_input_buffer() meanwhile
+        if not data:
+            raise OSError(errno.ECONNRESET, f"{self.port} closed the connection")
+        return data
+
+    def read_chunk(self):
+        return self.read(CHUNK_SIZE)
+
+    def write(self, data):
+        self.socket.sendall(data)
+        return len(data)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    @property
+    def in_waiting(self):
+        return _bytes_waiting(self.socket.fileno())
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        # Without touching the blocking mode, which a waiting read shares
+        try:
+            while select.select([self.socket], [], [], 0)[0]:
+                if not self.socket.recv(CHUNK_SIZE, socket.MSG_DONTWAIT):
+                    break
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def close(self):
+        if not self.is_open:
+            return
+        self.is_open = False
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)  # Wakes a waiting read up
+        except OSError:
+            pass
+        self.socket.close()
+
+
+class MemoryTransport(object):
+    """
+    One end of a connected pair in memory: what is written to one end is
+    read from the other. MemoryTransport.pair() makes both ends.
+    """
+
+    def __init__(self, timeout=0.2, port="memory"):
+        self.port = port
+        self.timeout = timeout
+        self.peer = None
+        self.incoming = bytearray()
+        self.cond = threading.Condition()
+        self.is_open = True
+
+    @classmethod
+    def pair(cls, timeout=0.2):
+        first, second = cls(timeout, "memory:0"), cls(timeout, "memory:1")
+        first.peer, second.peer = second, first
+        return first, second
+
+    def read(self, size=1):
+        with self.cond:
+            self.cond.wait_for(lambda: self.incoming or not self.is_open, self.timeout)
+            if not self.is_open:
+                raise OSError(errno.EBADF, "Port closed")
+            data = bytes(self.incoming[:size])
+            del self.incoming[:size]
+            return data
+
+    def read_chunk(self):
+        return self.read(CHUNK_SIZE)
+
+    def write(self, data):
+        if not self.is_open:
+            raise OSError(errno.EBADF, "Port closed")
+        with self.peer.cond:
+            if self.peer.is_open:
+                self.peer.incoming += data
+                self.peer.cond.notify_all()
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        with self.cond:
+            return len(self.incoming)
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        with self.cond:
+            self.incoming.clear()
+
+    def close(self):
+        with self.cond:
+            self.is_open = False
+            self.cond.notify_all()
+
+
+def mux_frame(kind, payload=b""):
+    return MUX_HEADER.pack(kind, len(payload)) + payload
+
+
+def mux_frames(buffer):
+    """Complete frames at the start of buffer, (kind, payload) each; they
+    are removed from it"""
+    frames = []
+    while len(buffer) >= MUX_HEADER.size:
+        kind, length = MUX_HEADER.unpack_from(buffer)
+        end = MUX_HEADER.size + length
+        if len(buffer) < end:
+            break
+        frames.append((kind, bytes(buffer[MUX_HEADER.size:end])))
+        del buffer[:end]
+    return frames
+
+
+class MuxTransport(object):
+    """
+    Board owned by a hello.mux daemon, leased over its Unix socket. The
+    lease waits up to wait seconds while another client holds the board;
+    it ends with close() or when the connection drops. Reads and writes
+    relay the bytes of the port, which the daemon keeps open; command()
+    sends a command and gets its answer back in one request.
+    """
+
+    def __init__(self, socket_path, name, timeout=0.2, wait=60):
+        self.socket_path = socket_path
+        self.name = name
+        self.port = f"{MUX_SCHEME}{socket_path}#{name}"
+        self.timeout = timeout
+        self.received = bytearray()  # Frames not complete yet
+        self.incoming = bytearray()
+        self.answers = deque()  # Answers to command(), in order
+        self.resets = 0  # Resets sent and not answered yet: the data before their answer is dropped
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        if not hasattr(socket, "AF_UNIX"):
+            raise OSError(errno.ENOTSUP, "The mux transport needs Unix domain sockets")
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(socket_path)
+        self.is_open = True
+        try:
+            self._lease(wait)
+        except BaseException:
+            self.socket.close()
+            self.is_open = False
+            raise
+
+    def _lease(self, wait):
+        self._send(MUX_LEASE, json.dumps({"device": self.name, "wait": wait}).encode())
+        self.socket.settimeout(wait + 5)
+        while True:
+            data = self.socket.recv(CHUNK_SIZE)
+            if not data:
+                raise OSError(errno.ECONNRESET, f"{self.socket_path} closed the connection")
+            self.received += data
+            leased = False
+            for kind, payload in mux_frames(self.received):
+                if leased:
+                    if kind == MUX_DATA:
+                        self.incoming += payload  # Came in with the answer
+                elif kind == MUX_ERROR:
+                    raise OSError(errno.EBUSY, f"{self.name}: {payload.decode(errors='ignore')}")
+                elif kind == MUX_OK:
+                    leased = True
+                    lease = json.loads(payload)
+                    self.device_port, self.baudrate = lease["port"], lease["baudrate"]
+            if leased:
+                self.socket.settimeout(None)
+                return
+
+    def _send(self, kind, payload=b""):
+        with self.send_lock:
+            self.socket.sendall(mux_frame(kind, payload))
+
+    def _receive(self):
+        """Take in the frames that arrive within the timeout"""
+        if not self.is_open:
+            raise OSError(errno.EBADF, "Connection closed")
+        readable, _, _ = select.select([self.socket], [], [], self.timeout)
+        if not readable:
+            return
+        with self.lock:  # A reader thread and command() may both be waiting
+            try:
+                data = self.socket.recv(65536, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return  # Taken in by the other one
+            if not data:
+                raise OSError(errno.ECONNRESET, f"{self.socket_path} closed the connection")
+            self.received += data
+            for kind, payload in mux_frames(self.received):
+                if kind == MUX_OK and self.resets:
+                    self.resets -= 1
+                elif kind == MUX_DATA and not self.resets:
+                    self.incoming += payload
+                elif kind == MUX_ANSWER:
+                    self.answers.append(payload)
+
+    def command(self, data, timeout=5):
+        """Write data as one request and return its answer: the input up to
+        the response (a prompt such as OK00> or ERFA>, or a binary
+        response), collected by the daemon for up to timeout seconds. What
+        comes before and after the answer is read as usual"""
+        self._send(MUX_COMMAND, json.dumps({"data": bytes(data).hex(), "timeout": timeout}).encode())
+        deadline = time.monotonic() + timeout + 5
+        while True:
+            with self.lock:
+                if self.answers:
+                    return self.answers.popleft()
+            if time.monotonic() > deadline:
+                raise OSError(errno.ETIMEDOUT, f"{self.socket_path} did not answer {self.name}")
+            self._receive()
+
+    def read(self, size=1):
+        if not self.incoming:
+            self._receive()
+        with self.lock:
+            data = bytes(self.incoming[:size])
+            del self.incoming[:size]
+            return data
+
+    def read_chunk(self):
+        return self.read(65536)
+
+    def read_fileno(self):
+        """Descriptor to wait on for input (e.g. async_device), which is still
+        read through read(): the socket carries frames, not the port bytes"""
+        return self.socket.fileno()
+
+    def write(self, data):
+        self._send(MUX_WRITE, bytes(data))
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        with self.lock:
+            return len(self.incoming)
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        with self.lock:
+            self.incoming.clear()
+            self.resets += 1
+        self._send(MUX_RESET)
+
+    def close(self):
+        if not self.is_open:
+            return
+        self.is_open = False
+        try:
+            self._send(MUX_RELEASE)
+            self.socket.shutdown(socket.SHUT_RDWR)  # Wakes a waiting read up
+        except OSError:
+            pass
+        self.socket.close()
+
+
+TRANSPORTS = {
+    "fd": FdTransport,
+    "pty": PtyTransport,
+} if termios is not None else {}
+
+
+def parse_url(url):
+    """(host, port) of a socket://host:port url"""
+    host, _, number = url.split("://", 1)[1].rpartition(":")
+    return host.strip("[]"), int(number)
+
+
+def open_transport(port, baudrate, timeout, kind=None):
+    """Open port with the transport of kind, default_kind when None.
+    socket:// and tcp:// urls always go over TcpTransport, mux:// urls over
+    MuxTransport"""
+    if port.startswith(URL_SCHEMES):
+        return TcpTransport(*parse_url(port), timeout=timeout)
+    if port.startswith(MUX_SCHEME):
+        socket_path, _, name = port[len(MUX_SCHEME):].rpartition("#")
+        return MuxTransport(socket_path, name, timeout=timeout)
+    kind = kind or default_kind
+    if kind == "serial":
+        return serial.Serial(port, baudrate, timeout=timeout)
+    if kind not in TRANSPORTS:
+        raise ValueError(f"Unknown transport {kind}, choose from serial, {', '.join(TRANSPORTS)}")
+    return TRANSPORTS[kind](port, baudrate, timeout)